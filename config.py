@@ -23,10 +23,108 @@ AUTO_REMOVE_TORRENTS_INTERVAL = 600
 PT_TRANSFER_INTERVAL = 300
 # TMDB信息缓存定时保存时间，默认10分钟
 METAINFO_SAVE_INTERVAL = 600
+# TMDB信息缓存在内存中保留的最大条数，超出时淘汰最久未使用的
+METAINFO_CACHE_MAX_SIZE = 10000
+# TMDB信息缓存有效期，过期后重新查询，识别到的默认30天，未识别到的默认1天，单位秒
+METAINFO_CACHE_TTL = 30 * 86400
+METAINFO_CACHE_NEGATIVE_TTL = 86400
+# 名称解析结果缓存的最大条数，RSS、搜索中重复出现的名称不再重复解析
+METAINFO_PARSE_CACHE_SIZE = 5000
+# 批量识别时并行检索TMDB的线程数
+TMDB_QUERY_THREADS = 10
+# RSS及Jackett边下载边识别，每凑够多少条识别一次
+RSS_IDENTIFY_BATCH_SIZE = 50
+# RSS已处理过的种子链接保留天数，超过后清理
+RSS_SEEN_EXPIRE_DAYS = 30
+# RSS并行处理的站点数
+RSS_FETCH_THREADS = 5
+# RSS同一域名同时处理的站点数，以及两次请求的最小间隔，单位秒
+RSS_DOMAIN_THREADS = 1
+RSS_DOMAIN_INTERVAL = 1
+# 对外HTTP请求的默认超时时间，单位秒
+HTTP_TIMEOUT = 10
+# 每个站点的会话连接池数量及每个池的最大连接数
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 20
+# HTTP请求失败时的重试次数，重试间隔按指数退避递增
+HTTP_RETRY_TIMES = 3
+HTTP_RETRY_BACKOFF = 0.5
+# 启用异步引擎并行检索Jackett，默认关闭，需自行安装aiohttp（pip install aiohttp）后改为True，未安装时仍使用多线程
+# 异步引擎按HTTP_RETRY_TIMES、HTTP_RETRY_BACKOFF重试，并按ASYNC_HTTP_LIMIT_PER_HOST限制每个站点的连接数
+ASYNC_ENGINE_ENABLE = False
+# 异步引擎的最大连接数及每个站点的最大连接数
+ASYNC_HTTP_LIMIT = 100
+ASYNC_HTTP_LIMIT_PER_HOST = 10
+# Jackett每个Indexer检索结果的缓存时间，单位秒，有效期内相同的检索不再请求Indexer，为0时不缓存
+JACKETT_CACHE_TTL = 600
+# Jackett检索结果最多缓存的检索次数（按Indexer分别计数）
+JACKETT_CACHE_MAX_SIZE = 200
+# Emby媒体库索引每页获取的条数
+EMBY_INDEX_PAGE_SIZE = 1000
+# Emby媒体库索引增量更新及全量更新的间隔，单位秒
+EMBY_INDEX_REFRESH_INTERVAL = 600
+EMBY_INDEX_FULL_REFRESH_INTERVAL = 6 * 3600
+# 媒体库文件索引的目录层数，分类/媒体目录/季目录/文件共4层
+LIBRARY_INDEX_DEPTH = 4
+# 媒体库文件索引全量重建的间隔，单位秒，用于修正程序外的文件变化
+LIBRARY_INDEX_REFRESH_INTERVAL = 3600
+# 转移文件的并行线程数
+TRANSFER_THREADS = 4
+# 复制模式下每个目的磁盘同时复制的文件数
+TRANSFER_DEVICE_THREADS = 1
+# 复制文件时每次在内核中复制的字节数
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# 复制大文件时输出进度的间隔，单位秒
+COPY_PROGRESS_INTERVAL = 30
+# 复制中的临时文件后缀，复制完成后再改为正式文件名
+COPY_TEMP_SUFFIX = ".nt-part"
+# 保存复制进度用于断点续传的间隔，单位秒
+COPY_JOURNAL_INTERVAL = 10
+# 未完成的复制超过多少天未继续则清理临时文件
+COPY_JOURNAL_EXPIRE_DAYS = 7
+# 复制完成后是否抽样校验源文件与目的文件内容一致，续传前同样校验已复制的部分
+COPY_VERIFY = False
+# 抽样校验的块数及每块大小
+COPY_VERIFY_SAMPLES = 16
+COPY_VERIFY_SAMPLE_SIZE = 1024 * 1024
+# 数据库被其它线程锁定时的等待时间，单位秒
+DB_BUSY_TIMEOUT = 30
+# 数据库每个连接的页缓存大小及内存映射大小，单位字节
+DB_CACHE_SIZE = 16 * 1024 * 1024
+DB_MMAP_SIZE = 256 * 1024 * 1024
+# 数据库连接池的最大连接数，各线程用完连接后放回，连接都在使用中时等待
+DB_POOL_SIZE = 8
+# 数据库每个连接缓存的预编译语句数
+DB_CACHED_STATEMENTS = 200
+# 识别转移历史总数的缓存时间，单位秒，以及最多缓存的查询条件数
+HISTORY_COUNT_CACHE_TTL = 60
+HISTORY_COUNT_CACHE_SIZE = 100
+# 识别转移历史按关键字查询时最多统计的条数
+HISTORY_COUNT_LIMIT = 10000
+# 检索结果保留时间，单位秒，以及内存中最多保留的检索次数
+SEARCH_SESSION_TTL = 86400
+SEARCH_SESSION_MAX_SIZE = 20
+# 检索结果是否同时保存到数据库，内存中淘汰后或程序重启后仍可查看及下载
+SEARCH_SESSION_SPILL = True
 # 配置文件定时生效时间，默认10分钟
 RELOAD_CONFIG_INTERVAL = 600
-# SYNC目录监控聚合转移时间，默认5分钟
+# SYNC目录监控聚合转移时间，目录中有文件超过这个时间仍未稳定时，先转移已稳定的文件，默认5分钟
 SYNC_TRANSFER_INTERVAL = 300
+# SYNC目录监控文件稳定时间，最后一次变化后大小及修改时间在这段时间内不再变化才转移，单位秒
+SYNC_EVENT_DEBOUNCE = 10
+# SYNC目录监控检查待转移文件的间隔，单位秒
+SYNC_EVENT_CHECK_INTERVAL = 2
+# SYNC目录监控记录已转移文件的最大数量
+SYNC_SEEN_MAX_SIZE = 10000
+# SYNC目录监控转移队列的最大批次数，队列满时文件留在等待列表中，不会丢失
+SYNC_QUEUE_SIZE = 100
+# SYNC目录监控的转移线程数
+SYNC_TRANSFER_WORKERS = 2
+# SYNC目录监控转移队列满时输出告警的间隔，单位秒
+SYNC_QUEUE_WARN_INTERVAL = 60
+# SYNC目录监控转移失败后重新转移的次数及间隔，单位秒，超过次数后不再转移，直到文件再次变化
+SYNC_RETRY_TIMES = 3
+SYNC_RETRY_INTERVAL = 300
 # fanart的api，用于拉取封面图片
 FANART_MOVIE_API_URL = 'http://webservice.fanart.tv/v3/movies/%s?api_key=d2d31f9ecabea050fc7d68aa3146015f'
 FANART_TV_API_URL = 'http://webservice.fanart.tv/v3/tv/%s?api_key=d2d31f9ecabea050fc7d68aa3146015f'
@@ -1,7 +1,6 @@
-import requests
-
 from config import Config
 from utils.functions import singleton
+from utils.http_utils import RequestUtils
 
 
 @singleton
@@ -27,7 +26,7 @@ class Bark:
             if not self.__server or not self.__apikey:
                 return False, "参数未配置"
             sc_url = "%s/%s/%s/%s" % (self.__server, self.__apikey, title, text)
-            res = requests.get(sc_url, timeout=10)
+            res = RequestUtils().request("get", sc_url)
             if res:
                 ret_json = res.json()
                 code = ret_json['code']
@@ -1,8 +1,8 @@
 from urllib.parse import urlencode
-import requests
 
 from config import Config
 from utils.functions import singleton
+from utils.http_utils import RequestUtils
 
 
 @singleton
@@ -27,7 +27,7 @@ class ServerChan:
             if not self.__sckey:
                 return False, "参数未配置"
             sc_url = "https://sctapi.ftqq.com/%s.send?%s" % (self.__sckey, urlencode(values))
-            res = requests.get(sc_url, timeout=10)
+            res = RequestUtils().request("get", sc_url)
             if res:
                 ret_json = res.json()
                 errno = ret_json['code']
@@ -1,8 +1,8 @@
 from urllib.parse import urlencode
-import requests
 
 from config import Config
 from utils.functions import singleton
+from utils.http_utils import RequestUtils
 
 
 @singleton
@@ -40,7 +40,7 @@ class Telegram:
                 values = {"chat_id": self.__telegram_chat_id, "text": caption}
                 sc_url = "https://api.telegram.org/bot%s/sendMessage?" % self.__telegram_token
 
-            res = requests.get(sc_url + urlencode(values), timeout=10)
+            res = RequestUtils().request("get", sc_url + urlencode(values))
             if res:
                 ret_json = res.json()
                 errno = ret_json['ok']
@@ -1,9 +1,9 @@
 from datetime import datetime
 import threading
-import requests
 
 from config import Config
 from utils.functions import singleton
+from utils.http_utils import RequestUtils
 
 lock = threading.Lock()
 
@@ -47,7 +47,7 @@ class WeChat(object):
             try:
                 token_url = "https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid=%s&corpsecret=%s" \
                             % (self.__corpid, self.__corpsecret)
-                res = requests.get(token_url, timeout=10)
+                res = RequestUtils().request("get", token_url)
                 if res:
                     ret_json = res.json()
                     if ret_json['errcode'] == 0:
@@ -81,7 +81,7 @@ class WeChat(object):
         }
         headers = {'content-type': 'charset=utf8'}
         try:
-            res = requests.post(message_url, json=req_json, headers=headers)
+            res = RequestUtils().request("post", message_url, json=req_json, headers=headers)
             if res:
                 ret_json = res.json()
                 if ret_json['errcode'] == 0:
@@ -117,7 +117,7 @@ class WeChat(object):
         }
         headers = {'content-type': 'charset=utf8'}
         try:
-            res = requests.post(message_url, json=req_json, headers=headers)
+            res = RequestUtils().request("post", message_url, json=req_json, headers=headers)
             if res:
                 ret_json = res.json()
                 if ret_json['errcode'] == 0:
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+
+import log
+from config import Config, LIBRARY_INDEX_DEPTH, LIBRARY_INDEX_REFRESH_INTERVAL
+from utils.functions import singleton
+
+lock = threading.Lock()
+build_lock = threading.Lock()
+
+
+# 路径索引，同时记录每个目录下的子路径，移除目录时只处理其下的路径
+class PathIndex(object):
+    __paths = None
+    __children = None
+
+    def __init__(self):
+        self.__paths = set()
+        self.__children = {}
+
+    def __contains__(self, path):
+        return path in self.__paths
+
+    def __len__(self):
+        return len(self.__paths)
+
+    def add(self, path):
+        if path in self.__paths:
+            return
+        self.__paths.add(path)
+        self.__children.setdefault(os.path.dirname(path), set()).add(path)
+
+    def update(self, paths):
+        for path in paths:
+            self.add(path)
+
+    # 移除路径及其下级
+    def discard(self, path):
+        children = self.__children.get(os.path.dirname(path))
+        if children:
+            children.discard(path)
+        sub_paths = [path]
+        while sub_paths:
+            sub_path = sub_paths.pop()
+            self.__paths.discard(sub_path)
+            sub_paths.extend(self.__children.pop(sub_path, ()))
+
+
+@singleton
+class LibraryIndex(object):
+    __roots = []
+    # 媒体库目录下已存在的目录及文件
+    __paths = None
+    __index_time = None
+    # 重建索引期间收到的变化，重建完成后补上
+    __pending = None
+
+    def __init__(self):
+        self.init_config()
+
+    def init_config(self):
+        config = Config()
+        self.__roots = []
+        media = config.get_config('media')
+        if media:
+            for media_path in [media.get('movie_path'), media.get('tv_path'), media.get('anime_path')]:
+                if media_path and os.path.normpath(media_path) not in self.__roots:
+                    self.__roots.append(os.path.normpath(media_path))
+
+    # 扫描目录，返回其下depth层以内的所有目录及文件
+    def __scan_path(self, path, depth):
+        paths = set()
+        if depth <= 0:
+            return paths
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    paths.add(os.path.normpath(entry.path))
+                    if depth > 1 and entry.is_dir():
+                        paths.update(self.__scan_path(entry.path, depth - 1))
+        except OSError as e:
+            log.debug("【INDEX】扫描目录出错：%s" % str(e))
+        return paths
+
+    # 返回路径所在的媒体库目录及相对层级，不在媒体库中时返回None
+    def __get_root_depth(self, path):
+        for root in self.__roots:
+            if path == root:
+                return root, 0
+            if path.startswith(root.rstrip(os.sep) + os.sep):
+                return root, os.path.relpath(path, root).count(os.sep) + 1
+        return None, None
+
+    # 全量重建索引，重建期间照常使用旧索引，调用前需将__pending置为列表
+    def __rebuild(self):
+        start_time = time.time()
+        paths = PathIndex()
+        for root in self.__roots:
+            if os.path.exists(root):
+                paths.add(root)
+                paths.update(self.__scan_path(root, LIBRARY_INDEX_DEPTH))
+        with lock:
+            for add_flag, path in self.__pending:
+                if add_flag:
+                    self.__add_path(paths, path)
+                else:
+                    paths.discard(path)
+            self.__pending = None
+            self.__paths = paths
+            self.__index_time = start_time
+        log.info("【INDEX】媒体库索引更新完成，共 %s 个目录及文件，耗时 %.1f 秒" % (len(paths), time.time() - start_time))
+
+    # 索引不存在时同步建立，过期时在后台重建
+    def __check_index(self):
+        if self.__paths is None:
+            with build_lock:
+                if self.__paths is None:
+                    self.__pending = []
+                    self.__rebuild()
+        elif self.__pending is None and time.time() - self.__index_time > LIBRARY_INDEX_REFRESH_INTERVAL:
+            with lock:
+                if self.__pending is not None:
+                    return
+                self.__pending = []
+            threading.Thread(target=self.__rebuild, daemon=True).start()
+
+    # 判断路径是否存在，媒体库目录内的从索引中查询，其它的直接查询文件系统
+    def exists(self, path):
+        if not path:
+            return False
+        path = os.path.normpath(path)
+        root, depth = self.__get_root_depth(path)
+        if not root or depth > LIBRARY_INDEX_DEPTH:
+            return os.path.exists(path)
+        self.__check_index()
+        return path in self.__paths
+
+    # 将路径及上级目录加入索引，是目录时同时加入下级
+    def __add_path(self, paths, path):
+        root, depth = self.__get_root_depth(path)
+        if not root or depth > LIBRARY_INDEX_DEPTH:
+            return
+        paths.add(path)
+        parent = os.path.dirname(path)
+        while parent != root and parent not in paths and self.__get_root_depth(parent)[0]:
+            paths.add(parent)
+            parent = os.path.dirname(parent)
+        if os.path.isdir(path):
+            paths.update(self.__scan_path(path, LIBRARY_INDEX_DEPTH - depth))
+
+    # 新增或转移了文件、目录
+    def add(self, path):
+        if not path or self.__paths is None:
+            return
+        path = os.path.normpath(path)
+        with lock:
+            self.__add_path(self.__paths, path)
+            if self.__pending is not None:
+                self.__pending.append((True, path))
+
+    # 删除或移走了文件、目录
+    def remove(self, path):
+        if not path or self.__paths is None:
+            return
+        path = os.path.normpath(path)
+        with lock:
+            self.__paths.discard(path)
+            if self.__pending is not None:
+                self.__pending.append((False, path))
+
+    # 启动时在后台建立索引，不监控目录变化，以免大媒体库超出inotify的监控数量限制、网络存储上监控不到服务端的变化
+    # 程序内的转移、删除实时更新索引，其它变化靠定时重建修正
+    def run_service(self):
+        if self.__paths is not None or not self.__roots:
+            return
+        threading.Thread(target=self.__check_index, daemon=True).start()
+        log.info("【RUN】媒体库索引开始建立...")
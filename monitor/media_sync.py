@@ -1,11 +1,15 @@
 import os
 import threading
-from time import sleep
+import time
+from collections import OrderedDict
+from queue import Queue, Empty
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 from watchdog.observers.polling import PollingObserver
-from config import RMT_MEDIAEXT, Config
+from config import RMT_MEDIAEXT, Config, SYNC_TRANSFER_INTERVAL, SYNC_EVENT_DEBOUNCE, SYNC_EVENT_CHECK_INTERVAL, \
+    SYNC_SEEN_MAX_SIZE, SYNC_QUEUE_SIZE, SYNC_TRANSFER_WORKERS, SYNC_QUEUE_WARN_INTERVAL, SYNC_RETRY_TIMES, \
+    SYNC_RETRY_INTERVAL
 import log
 from rmt.filetransfer import FileTransfer
 from utils.functions import get_dir_files_by_ext, singleton, is_invalid_path, is_path_in_path
@@ -23,8 +27,24 @@ class Sync(object):
     __sync_path = None
     __unknown_path = None
     __sync_sys = "LINUX"
-    __synced_files = []
-    __need_sync_paths = {}
+    # 已转移过的文件及其大小、修改时间，超过上限时淘汰最早的
+    __synced_files = OrderedDict()
+    # 等待文件稳定的文件，文件路径：来源目录、目的目录、最后变化时间、大小及修改时间、失败次数
+    __pending_files = {}
+    # 已放入转移队列还未转移完成的文件，格式同__pending_files，成功后记为已转移，失败后放回等待列表
+    __transferring_files = {}
+    # 等待展开的新目录，目录路径：最后变化时间
+    __pending_dirs = {}
+    __dispatcher = None
+    __stop_event = None
+    # 转移队列，元素为 (入队时间, 转移路径, 目的目录, 文件列表)，由转移线程消费
+    __queue = None
+    __workers = []
+    # 转移线程的运行统计
+    __running_num = 0
+    __success_num = 0
+    __fail_num = 0
+    __queue_warn_time = 0
 
     def __init__(self):
         self.filetransfer = FileTransfer()
@@ -46,166 +66,260 @@ class Sync(object):
         if media:
             self.__unknown_path = media.get('unknown_path')
 
-    # 处理文件变化
-    def file_change_handler(self, event, text, event_path):
-        global SYNC_DIR_CONFIG
-        if not event.is_directory:
-            # 文件发生变化
-            try:
-                if not os.path.exists(event_path):
-                    return
-                # 判断是否处理过了
-                need_handler_flag = False
-                try:
-                    lock.acquire()
-                    if event_path not in self.__synced_files:
-                        self.__synced_files.append(event_path)
-                        need_handler_flag = True
-                finally:
-                    lock.release()
+    # 判断路径是否需要监控处理，返回所在的监控目录，不需要处理时返回None
+    def __get_monitor_dir(self, event_path):
+        monitor_dir = None
+        for m_path in SYNC_DIR_CONFIG.keys():
+            if m_path and is_path_in_path(m_path, event_path):
+                monitor_dir = m_path
+        if not monitor_dir:
+            return None
+        # 目的目录的子文件不处理
+        for tpath in SYNC_DIR_CONFIG.values():
+            if tpath and is_path_in_path(tpath, event_path):
+                return None
+        # 媒体库目录及子目录不处理
+        if self.filetransfer.is_target_dir_path(event_path):
+            return None
+        # 回收站及隐藏的文件不处理
+        if is_invalid_path(event_path):
+            return None
+        return monitor_dir
 
-                if not need_handler_flag:
-                    log.debug("【SYNC】文件已处理过：%s" % event_path)
-                    return
-                # 不是监控目录下的文件不处理
-                is_monitor_file = False
-                for tpath in SYNC_DIR_CONFIG.keys():
-                    if is_path_in_path(tpath, event_path):
-                        is_monitor_file = True
-                        break
-                if not is_monitor_file:
-                    return
-                # 目的目录的子文件不处理
-                for tpath in SYNC_DIR_CONFIG.values():
-                    if is_path_in_path(tpath, event_path):
-                        return
-                # 媒体库目录及子目录不处理
-                if self.filetransfer.is_target_dir_path(event_path):
-                    return
-                # 回收站及隐藏的文件不处理
-                if is_invalid_path(event_path):
-                    return
+    # 文件的大小及修改时间，文件不存在时返回None
+    @staticmethod
+    def __get_file_stat(file_path):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    # 记录一个待转移的文件，已在等待的重新开始计时
+    def __add_pending_file(self, file_path, monitor_dir, file_stat):
+        if self.__synced_files.get(file_path) == file_stat:
+            log.debug("【SYNC】文件已处理过：%s" % file_path)
+            return
+        transferring_file = self.__transferring_files.get(file_path)
+        if transferring_file and transferring_file.get('stat') == file_stat:
+            log.debug("【SYNC】文件正在转移：%s" % file_path)
+            return
+        pending_file = self.__pending_files.get(file_path)
+        if pending_file:
+            pending_file.update({'time': time.time(), 'stat': file_stat, 'stable': False})
+            return
+        from_dir = os.path.dirname(file_path)
+        self.__pending_files[file_path] = {
+            'from_dir': from_dir,
+            'target_dir': SYNC_DIR_CONFIG.get(os.path.normpath(monitor_dir)),
+            # 监控根目录下的文件单独转移，其它的按所在目录整批转移
+            'is_root': os.path.normpath(monitor_dir) == os.path.normpath(from_dir),
+            'time': time.time(),
+            'first_time': time.time(),
+            'stat': file_stat,
+            'retry': 0
+        }
+
+    # 处理文件变化，只做过滤和记录，不阻塞监控线程，由转移线程在文件稳定后统一转移
+    def file_change_handler(self, event, text, event_path):
+        try:
+            if not event.is_directory:
                 # 不是媒体文件不处理
                 name = os.path.basename(event_path)
-                if not name:
+                if not name or os.path.splitext(name)[-1].lower() not in RMT_MEDIAEXT:
                     return
-                ext = os.path.splitext(name)[-1]
-                if ext not in RMT_MEDIAEXT:
+                monitor_dir = self.__get_monitor_dir(event_path)
+                if not monitor_dir:
                     return
-                # 黑名单不处理
-                if is_transfer_in_blacklist(event_path):
+                file_stat = self.__get_file_stat(event_path)
+                if not file_stat:
                     return
-
                 log.debug("【SYNC】文件%s：%s" % (text, event_path))
-                # 找到是哪个监控目录下的
-                monitor_dir = event_path
-                from_dir = os.path.dirname(event_path)
-                is_root_path = False
-                for m_path in SYNC_DIR_CONFIG.keys():
-                    if m_path:
-                        if is_path_in_path(m_path, event_path):
-                            monitor_dir = m_path
-                        if os.path.normpath(m_path) == os.path.normpath(from_dir):
-                            is_root_path = True
-
-                # 查找目的目录
-                target_dir = SYNC_DIR_CONFIG.get(os.path.normpath(monitor_dir))
-                # 监控根目录下的文件发生变化时直接发走
-                if is_root_path:
-                    ret, ret_msg = self.filetransfer.transfer_media(in_from=SyncType.MON,
-                                                                    in_path=event_path,
-                                                                    target_dir=target_dir)
-                    if not ret:
-                        log.warn("【SYNC】%s转移失败：%s" % (event_path, ret_msg))
-                else:
-                    try:
-                        lock.acquire()
-                        if self.__need_sync_paths.get(from_dir):
-                            files = self.__need_sync_paths[from_dir].get('files')
-                            if not files:
-                                files = [event_path]
-                            else:
-                                if event_path not in files:
-                                    files.append(event_path)
-                                else:
-                                    return
-                            self.__need_sync_paths[from_dir].update({'files': files})
-                        else:
-                            self.__need_sync_paths[from_dir] = {'target_dir': target_dir, 'files': [event_path]}
-                    finally:
-                        lock.release()
-
-            except Exception as e:
-                log.error("【SYNC】发生错误：%s" % str(e))
-        else:
-            try:
-                # 文件变化时上级文件夹也会变化
-                if not os.path.exists(event_path):
+                with lock:
+                    self.__add_pending_file(event_path, monitor_dir, file_stat)
+            else:
+                # 文件变化时上级目录也会变化，只处理新建和移入的目录，展开其中已有的文件
+                if text == "修改" or not os.path.exists(event_path):
                     return
-                # 不是监控目录下的目录不处理
-                is_monitor_file = False
-                for tpath in SYNC_DIR_CONFIG.keys():
-                    if is_path_in_path(tpath, event_path):
-                        is_monitor_file = True
-                        break
-                if not is_monitor_file:
+                if not self.__get_monitor_dir(event_path):
                     return
                 # 源目录本身或上级目录不处理
                 for tpath in SYNC_DIR_CONFIG.keys():
                     if is_path_in_path(event_path, tpath):
                         return
-                # 目的目录的子文件不处理
-                for tpath in SYNC_DIR_CONFIG.values():
-                    if is_path_in_path(tpath, event_path):
-                        return
-                # 媒体库目录及子目录不处理
-                if self.filetransfer.is_target_dir_path(event_path):
-                    return
-                # 回收站及隐藏的文件不处理
-                if is_invalid_path(event_path):
-                    return False
-                # 开始处理变化，新目录等10秒钟，让文件充分变化
                 log.debug("【SYNC】文件夹%s：%s" % (text, event_path))
-                if text == "创建":
-                    sleep(10)
-                try:
-                    lock.acquire()
-                    sync_item = self.__need_sync_paths.get(event_path)
-                    if sync_item:
-                        sync_len = len(sync_item.get('files'))
-                        file_len = len(get_dir_files_by_ext(event_path, RMT_MEDIAEXT))
-                        if sync_len >= file_len:
-                            # 该目录下所有的文件都发生了改变，发走
-                            ret, ret_msg = self.filetransfer.transfer_media(in_from=SyncType.MON,
-                                                                            in_path=event_path,
-                                                                            target_dir=sync_item.get('target_dir'))
-                            if not ret:
-                                log.warn("【SYNC】%s转移失败：%s" % (event_path, ret_msg))
-                            self.__need_sync_paths.pop(event_path)
-                finally:
-                    lock.release()
-            except Exception as e:
-                log.error("【SYNC】发生错误：%s" % str(e))
+                with lock:
+                    self.__pending_dirs[event_path] = time.time()
+        except Exception as e:
+            log.error("【SYNC】发生错误：%s" % str(e))
 
-    # 批量转移文件
-    def transfer_mon_files(self, no_path=None):
-        try:
-            lock.acquire()
-            items = list(self.__need_sync_paths)
-            for path in items:
-                if path == no_path:
+    # 展开等待时间已到的新目录，将其中的媒体文件加入待转移
+    def __expand_pending_dirs(self):
+        now = time.time()
+        with lock:
+            dirs = [path for path, change_time in self.__pending_dirs.items()
+                    if now - change_time >= SYNC_EVENT_DEBOUNCE]
+            for path in dirs:
+                self.__pending_dirs.pop(path)
+        for path in dirs:
+            for file_path in get_dir_files_by_ext(path, RMT_MEDIAEXT):
+                monitor_dir = self.__get_monitor_dir(file_path)
+                file_stat = self.__get_file_stat(file_path)
+                if not monitor_dir or not file_stat:
+                    continue
+                with lock:
+                    self.__add_pending_file(file_path, monitor_dir, file_stat)
+
+    # 检查待转移文件是否稳定，返回最多limit个可以转移的批次，每批为 (转移路径, 目的目录, 文件列表)
+    def __get_ready_batches(self, limit):
+        now = time.time()
+        with lock:
+            pending_files = list(self.__pending_files.items())
+        # 距最后一次变化超过等待时间后，大小及修改时间都未再变化的视为稳定
+        for file_path, pending_file in pending_files:
+            if pending_file.get('stable') or now - pending_file.get('time') < SYNC_EVENT_DEBOUNCE:
+                continue
+            file_stat = self.__get_file_stat(file_path)
+            with lock:
+                if self.__pending_files.get(file_path) is not pending_file:
+                    continue
+                if not file_stat:
+                    self.__pending_files.pop(file_path)
+                elif file_stat != pending_file.get('stat'):
+                    pending_file.update({'time': now, 'stat': file_stat})
+                else:
+                    pending_file['stable'] = True
+        batches = []
+        with lock:
+            dir_files = {}
+            for file_path, pending_file in self.__pending_files.items():
+                if pending_file.get('is_root'):
+                    if pending_file.get('stable'):
+                        batches.append((file_path, pending_file.get('target_dir'), [file_path]))
+                else:
+                    dir_files.setdefault(pending_file.get('from_dir'), []).append((file_path, pending_file))
+            for from_dir, files in dir_files.items():
+                stable_files = [file_path for file_path, pending_file in files if pending_file.get('stable')]
+                if not stable_files:
+                    continue
+                target_dir = files[0][1].get('target_dir')
+                if len(stable_files) == len(files):
+                    # 目录下的文件都稳定了，整个目录一起转移
+                    batches.append((from_dir, target_dir, stable_files))
+                elif now - min(pending_file.get('first_time') for _, pending_file in files) >= SYNC_TRANSFER_INTERVAL:
+                    # 目录中有文件长时间未稳定，先把已稳定的逐个转移
+                    for file_path in stable_files:
+                        batches.append((file_path, target_dir, [file_path]))
+            batches = batches[:limit]
+            for _, _, files in batches:
+                for file_path in files:
+                    self.__transferring_files[file_path] = self.__pending_files.pop(file_path)
+        return batches
+
+    # 一批文件转移完成，成功的记为已转移，失败的放回等待列表稍后重新转移，多次失败后不再转移
+    def __finish_batch(self, files, success_flag):
+        now = time.time()
+        with lock:
+            for file_path in files:
+                pending_file = self.__transferring_files.pop(file_path, None)
+                if not pending_file:
+                    continue
+                if not success_flag and pending_file.get('retry') < SYNC_RETRY_TIMES:
+                    # 转移期间文件又有变化的，以新的为准
+                    if file_path not in self.__pending_files:
+                        pending_file.update({'time': now + SYNC_RETRY_INTERVAL,
+                                             'first_time': now + SYNC_RETRY_INTERVAL,
+                                             'stable': False,
+                                             'retry': pending_file.get('retry') + 1})
+                        self.__pending_files[file_path] = pending_file
                     continue
-                if os.path.exists(path):
-                    log.info("【SYNC】开始转移监控目录文件...")
-                    ret, ret_msg = self.filetransfer.transfer_media(in_from=SyncType.MON,
-                                                                    in_path=path,
-                                                                    target_dir=self.__need_sync_paths[path].get(
-                                                                        'target_dir'))
-                    if not ret:
-                        log.warn("【SYNC】%s转移失败：%s" % (path, ret_msg))
-                self.__need_sync_paths.pop(path)
-        finally:
-            lock.release()
+                if not success_flag:
+                    log.warn("【SYNC】%s 多次转移失败，文件再次变化前不再转移" % file_path)
+                self.__synced_files[file_path] = pending_file.get('stat')
+                self.__synced_files.move_to_end(file_path)
+            while len(self.__synced_files) > SYNC_SEEN_MAX_SIZE:
+                self.__synced_files.popitem(last=False)
+
+    # 转移一批文件，返回是否成功，整个目录一起转移时只转移批次中已稳定的文件，不处理目录下的其它文件
+    def __transfer_batch(self, in_path, target_dir, files):
+        # 黑名单不处理
+        transfer_files = [file_path for file_path in files if not is_transfer_in_blacklist(file_path)]
+        if not transfer_files:
+            return True
+        log.info("【SYNC】开始转移监控目录文件：%s" % in_path)
+        ret, ret_msg = self.filetransfer.transfer_media(in_from=SyncType.MON,
+                                                        in_path=in_path,
+                                                        target_dir=target_dir,
+                                                        files=transfer_files if os.path.isdir(in_path) else None)
+        if not ret:
+            log.warn("【SYNC】%s转移失败：%s" % (in_path, ret_msg))
+        return ret
+
+    # 将已稳定的监控文件放入转移队列，队列满时留在等待列表中，等转移线程消化后再放入
+    def __dispatch_mon_files(self):
+        self.__expand_pending_dirs()
+        free_num = SYNC_QUEUE_SIZE - self.__queue.qsize()
+        if free_num > 0:
+            for in_path, target_dir, files in self.__get_ready_batches(free_num):
+                self.__queue.put((time.time(), in_path, target_dir, files))
+        # 队列有积压时定时输出队列状态
+        queue_info = self.get_queue_info()
+        if queue_info.get('queue_size') >= SYNC_QUEUE_SIZE \
+                and time.time() - self.__queue_warn_time >= SYNC_QUEUE_WARN_INTERVAL:
+            self.__queue_warn_time = time.time()
+            log.warn("【SYNC】转移队列已满，队列中 %s 批，最早的已等待 %s 秒，另有 %s 个文件等待转移" % (
+                queue_info.get('queue_size'), queue_info.get('oldest_age'), queue_info.get('pending_num')))
+
+    # 分发线程，定时检查待转移的文件放入队列
+    def __dispatch(self, stop_event):
+        while not stop_event.wait(SYNC_EVENT_CHECK_INTERVAL):
+            try:
+                self.__dispatch_mon_files()
+            except Exception as e:
+                log.error("【SYNC】分发转移任务出错：%s" % str(e))
+
+    # 转移线程，从队列中取出批次转移，停止事件触发后退出，队列满时也能及时收到停止信号
+    def __transfer_worker(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                item = self.__queue.get(timeout=SYNC_EVENT_CHECK_INTERVAL)
+            except Empty:
+                continue
+            _, in_path, target_dir, files = item
+            with lock:
+                self.__running_num = self.__running_num + 1
+            success_flag = False
+            try:
+                success_flag = self.__transfer_batch(in_path, target_dir, files)
+            except Exception as e:
+                log.error("【SYNC】%s 转移出错：%s" % (in_path, str(e)))
+            finally:
+                self.__finish_batch(files, success_flag)
+                with lock:
+                    self.__running_num = self.__running_num - 1
+                    if success_flag:
+                        self.__success_num = self.__success_num + 1
+                    else:
+                        self.__fail_num = self.__fail_num + 1
+
+    # 转移队列的状态：等待稳定的文件数、队列中的批次数、最早入队批次的等待秒数、正在转移的批次数、成功及失败的批次数
+    def get_queue_info(self):
+        oldest_age = 0
+        queue_size = 0
+        if self.__queue:
+            with self.__queue.mutex:
+                queue_size = len(self.__queue.queue)
+                if self.__queue.queue and self.__queue.queue[0]:
+                    oldest_age = round(time.time() - self.__queue.queue[0][0])
+        with lock:
+            return {
+                'pending_num': len(self.__pending_files) + len(self.__pending_dirs),
+                'queue_size': queue_size,
+                'oldest_age': oldest_age,
+                'running_num': self.__running_num,
+                'success_num': self.__success_num,
+                'fail_num': self.__fail_num
+            }
 
     # 启动进程
     def run_service(self):
@@ -248,12 +362,28 @@ class Sync(object):
                     log.info("【RUN】%s 的monitor.media_sync启动..." % monpath)
                 else:
                     log.error("【SYNC】%s 目录不存在！" % sync_monpath)
+        if self.__observer and not self.__dispatcher:
+            self.__queue = Queue(maxsize=SYNC_QUEUE_SIZE)
+            self.__stop_event = threading.Event()
+            self.__workers = []
+            for i in range(SYNC_TRANSFER_WORKERS):
+                worker = threading.Thread(target=self.__transfer_worker, args=(self.__stop_event,),
+                                          name="SyncWorker-%s" % i, daemon=True)
+                self.__workers.append(worker)
+                worker.start()
+            self.__dispatcher = threading.Thread(target=self.__dispatch, args=(self.__stop_event,),
+                                                 name="SyncDispatcher", daemon=True)
+            self.__dispatcher.start()
 
     # 关闭服务
     def stop_service(self):
         if self.__observer:
             for observer in self.__observer:
                 observer.stop()
+        if self.__dispatcher:
+            self.__stop_event.set()
+            self.__dispatcher = None
+            self.__workers = []
 
 
 # 监听文件夹
@@ -1,4 +1,5 @@
 import log
+from monitor.library_index import LibraryIndex
 from monitor.media_sync import Sync
 
 
@@ -7,3 +8,7 @@ def run_monitor():
         Sync().run_service()
     except Exception as err:
         log.error("【RUN】启动monitor失败：%s" % str(err))
+    try:
+        LibraryIndex().run_service()
+    except Exception as err:
+        log.error("【RUN】启动媒体库索引失败：%s" % str(err))
@@ -68,9 +68,7 @@ class Downloader:
                 else:
                     self.client.set_torrents_status(task.get("id"))
             log.info("【PT】文件转移结束")
-            medias = []
-            for torrent in trans_torrents:
-                medias.append(self.media.get_media_info(torrent))
+            medias = self.media.get_media_infos(trans_torrents)
             self.emby.refresh_emby_library_by_medias(medias)
 
     # 做种清理
@@ -235,7 +233,7 @@ class Downloader:
                                   media_item.org_string))
         # 控重
         can_download_list_item = []
-        can_download_list = []
+        can_download_list = set()
         # 排序后重新加入数组，按真实名称控重，即只取每个名称的第一个
         for t_item in media_list:
             # 控重的主链是名称、年份、季、集
@@ -245,7 +243,7 @@ class Downloader:
             else:
                 media_name = t_item.get_title_string()
             if media_name not in can_download_list:
-                can_download_list.append(media_name)
+                can_download_list.add(media_name)
                 can_download_list_item.append(t_item)
 
         return can_download_list_item
@@ -1,17 +1,25 @@
+import asyncio
 import re
+import time
+from collections import OrderedDict
 from concurrent.futures.thread import ThreadPoolExecutor
 from concurrent.futures._base import as_completed
+from threading import Lock
+
 import log
-from config import Config
+from config import Config, RSS_IDENTIFY_BATCH_SIZE, JACKETT_CACHE_TTL, JACKETT_CACHE_MAX_SIZE
 from utils.functions import parse_jackettxml, get_keyword_from_string, get_tmdb_seasons_info, \
-    get_tmdb_season_episodes_num, get_torrents_group_item, singleton
+    get_tmdb_season_episodes_num, get_torrents_group_item, singleton, split_batches
 from message.send import Message
 from pt.downloader import Downloader
 from rmt.media import Media
-from utils.sqls import delete_all_jackett_torrents, insert_jackett_results
+from utils.async_utils import AsyncEngine
+from utils.search_helper import SearchHelper
 from utils.types import SearchType, MediaType
 from web.backend.emby import Emby
 
+lock = Lock()
+
 
 @singleton
 class Jackett:
@@ -22,8 +30,11 @@ class Jackett:
     message = None
     downloader = None
     emby = None
+    # (Indexer, 检索词)：(检索时间, 解析后的检索结果)
+    __indexer_cache = OrderedDict()
 
     def __init__(self):
+        self.__indexer_cache = OrderedDict()
         self.media = Media()
         self.downloader = Downloader()
         self.message = Message()
@@ -43,8 +54,9 @@ class Jackett:
             if not isinstance(self.__indexers, list):
                 self.__indexers = [self.__indexers]
 
-    # 检索一个Indexer
-    def seach_indexer(self, order_seq, index, search_word, key_word, s_num, e_num, year, whole_word=False):
+    # 检索一个Indexer，传入content时直接使用已下载的检索结果
+    def seach_indexer(self, order_seq, index, search_word, key_word, s_num, e_num, year, whole_word=False,
+                      content=None):
         if not index:
             return None
         ret_array = []
@@ -52,73 +64,143 @@ class Jackett:
         if indexer_name:
             indexer_name = indexer_name.group(1)
         log.info("【JACKETT】开始检索Indexer：%s ..." % indexer_name)
-        api_url = "%sapi?apikey=%s&t=search&q=%s" % (index, self.__api_key, search_word)
-        media_array = parse_jackettxml(api_url)
-        if len(media_array) == 0:
-            log.warn("【JACKETT】%s 未检索到资源" % indexer_name)
-            return None
-        # 从检索结果中匹配符合资源条件的记录
+        api_url = self.__get_api_url(index, search_word)
+        # 边下载边分批识别
+        media_num = 0
         index_sucess = 0
-        for media_item in media_array:
-            torrent_name = media_item.get('title')
-            enclosure = media_item.get('enclosure')
-            size = media_item.get('size')
-            description = media_item.get('description')
-            seeders = media_item.get('seeders')
-            peers = media_item.get('peers')
-
+        for media_array in split_batches(self.__get_indexer_items(index, api_url, search_word, content),
+                                         RSS_IDENTIFY_BATCH_SIZE):
+            media_num = media_num + len(media_array)
             # 检查资源类型
-            match_flag, res_order, res_typestr = self.media.check_resouce_types(torrent_name, self.__res_type)
-            if not match_flag:
-                log.debug("【JACKETT】%s 资源类型不匹配" % torrent_name)
-                continue
+            match_items = []
+            for media_item in media_array:
+                match_flag, res_order, res_typestr = self.media.check_resouce_types(media_item.get('title'),
+                                                                                    self.__res_type)
+                if not match_flag:
+                    log.debug("【JACKETT】%s 资源类型不匹配" % media_item.get('title'))
+                    continue
+                match_items.append((media_item, res_order, res_typestr))
+            # 批量识别种子名称
+            media_infos = self.media.get_media_infos([item[0].get('title') for item in match_items],
+                                                     [item[0].get('description') for item in match_items])
+            # 从检索结果中匹配符合资源条件的记录
+            for (media_item, res_order, res_typestr), media_info in zip(match_items, media_infos):
+                torrent_name = media_item.get('title')
+                enclosure = media_item.get('enclosure')
+                size = media_item.get('size')
+                description = media_item.get('description')
+                seeders = media_item.get('seeders')
+                peers = media_item.get('peers')
 
-            # 识别种子名称
-            media_info = self.media.get_media_info(torrent_name, description)
-            if not media_info or not media_info.tmdb_info:
-                log.debug("【JACKETT】%s 未检索媒体信息" % torrent_name)
-                continue
+                if not media_info or not media_info.tmdb_info:
+                    log.debug("【JACKETT】%s 未检索媒体信息" % torrent_name)
+                    continue
 
-            # 名称是否匹配
-            if whole_word:
-                # 全匹配模式，名字需要完全一样才下载
-                if key_word == media_info.title:
-                    match_flag = True
-                else:
-                    match_flag = False
-                    log.info("【JACKETT】%s：%s 不匹配名称：%s" % (media_info.type.value, media_info.title, key_word))
-            else:
-                # 非全匹配模式，种子中或者名字中有关键字就行
-                if key_word in media_info.title or key_word in "%s %s" % (media_info.en_name, media_info.cn_name):
-                    match_flag = True
+                # 名称是否匹配
+                if whole_word:
+                    # 全匹配模式，名字需要完全一样才下载
+                    if key_word == media_info.title:
+                        match_flag = True
+                    else:
+                        match_flag = False
+                        log.info("【JACKETT】%s：%s 不匹配名称：%s" % (media_info.type.value, media_info.title, key_word))
                 else:
-                    match_flag = False
-                    log.info("【JACKETT】%s：%s %s 不匹配名称：%s" % (
-                        media_info.type.value, media_info.get_name(), media_info.title, key_word))
+                    # 非全匹配模式，种子中或者名字中有关键字就行
+                    if key_word in media_info.title or key_word in "%s %s" % (media_info.en_name, media_info.cn_name):
+                        match_flag = True
+                    else:
+                        match_flag = False
+                        log.info("【JACKETT】%s：%s %s 不匹配名称：%s" % (
+                            media_info.type.value, media_info.get_name(), media_info.title, key_word))
 
-            # 检查标题是否匹配剧集
-            if match_flag:
-                match_flag = self.__is_jackett_match_sey(media_info, s_num, e_num, year)
+                # 检查标题是否匹配剧集
+                if match_flag:
+                    match_flag = self.__is_jackett_match_sey(media_info, s_num, e_num, year)
 
-            # 匹配到了
-            if match_flag:
-                media_info.set_torrent_info(site=indexer_name,
-                                            site_order=order_seq,
-                                            enclosure=enclosure,
-                                            res_type=res_typestr,
-                                            res_order=res_order,
-                                            size=size,
-                                            seeders=seeders,
-                                            peers=peers,
-                                            description=description)
-                if media_info not in ret_array:
-                    index_sucess = index_sucess + 1
-                    ret_array.append(media_info)
-            else:
-                continue
+                # 匹配到了
+                if match_flag:
+                    media_info.set_torrent_info(site=indexer_name,
+                                                site_order=order_seq,
+                                                enclosure=enclosure,
+                                                res_type=res_typestr,
+                                                res_order=res_order,
+                                                size=size,
+                                                seeders=seeders,
+                                                peers=peers,
+                                                description=description)
+                    if media_info not in ret_array:
+                        index_sucess = index_sucess + 1
+                        ret_array.append(media_info)
+                else:
+                    continue
+        if media_num == 0:
+            log.warn("【JACKETT】%s 未检索到资源" % indexer_name)
+            return None
         log.info("【JACKETT】%s 共检索到 %s 条有效资源" % (indexer_name, index_sucess))
         return ret_array
 
+    # 取Indexer的检索结果，有效期内相同的检索直接使用缓存，否则边下载边解析，完成后加入缓存
+    # 缓存的是解析后未识别的结果，识别仍按每次检索的条件进行
+    def __get_indexer_items(self, index, api_url, search_word, content=None):
+        items = self.__get_cache_items(index, search_word)
+        if items is not None:
+            log.info("【JACKETT】%s 使用缓存的检索结果，共 %s 条" % (search_word, len(items)))
+            yield from items
+            return
+        items = []
+        for item in parse_jackettxml(api_url, content):
+            items.append(item)
+            yield item
+        # 下载出错时同样没有结果，不缓存空结果以免错误被缓存
+        if items:
+            self.__set_cache_items(index, search_word, items)
+
+    # 查询缓存的检索结果，不存在或已过期时返回None
+    def __get_cache_items(self, index, search_word):
+        if not JACKETT_CACHE_TTL:
+            return None
+        with lock:
+            cache = self.__indexer_cache.get((index, search_word))
+            if not cache:
+                return None
+            if time.time() - cache[0] > JACKETT_CACHE_TTL:
+                self.__indexer_cache.pop((index, search_word), None)
+                return None
+            return cache[1]
+
+    # 缓存检索结果，超过最大数量时淘汰最早的
+    def __set_cache_items(self, index, search_word, items):
+        if not JACKETT_CACHE_TTL:
+            return
+        with lock:
+            self.__indexer_cache[(index, search_word)] = (time.time(), items)
+            self.__indexer_cache.move_to_end((index, search_word))
+            while len(self.__indexer_cache) > JACKETT_CACHE_MAX_SIZE:
+                self.__indexer_cache.popitem(last=False)
+
+    # 拼装Indexer的检索地址
+    def __get_api_url(self, index, search_word):
+        return "%sapi?apikey=%s&t=search&q=%s" % (index, self.__api_key, search_word)
+
+    # 异步并行下载所有Indexer的检索结果
+    async def __async_search_indexers(self, indexer_args):
+        return await asyncio.gather(*[self.__async_search_indexer(*args) for args in indexer_args])
+
+    # 异步下载一个Indexer的检索结果，下载完成后在线程池中识别
+    async def __async_search_indexer(self, order_seq, index, search_word, key_word, s_num, e_num, year, whole_word):
+        if not index:
+            return None
+        # 有缓存时不再下载
+        if self.__get_cache_items(index, search_word) is not None:
+            return await AsyncEngine().run_blocking(self.seach_indexer, order_seq, index, search_word, key_word,
+                                                    s_num, e_num, year, whole_word)
+        content = await AsyncEngine().fetch(self.__get_api_url(index, search_word), timeout=30)
+        if content is None:
+            log.warn("【JACKETT】%s 检索出错" % index)
+            return None
+        return await AsyncEngine().run_blocking(self.seach_indexer, order_seq, index, search_word, key_word,
+                                                s_num, e_num, year, whole_word, content)
+
     # 根据关键字调用 Jackett API 检索
     def search_medias_from_word(self, key_word, s_num, e_num, year, whole_word):
         if not key_word:
@@ -130,19 +212,26 @@ class Jackett:
             search_word = "%s %s" % (key_word, year)
         else:
             search_word = key_word
-        # 多线程检索
-        log.info("【JACKETT】开始并行检索 %s，线程数：%s" % (key_word, len(self.__indexers)))
-        executor = ThreadPoolExecutor(max_workers=len(self.__indexers))
-        all_task = []
         order_seq = 100
+        indexer_args = []
         for index in self.__indexers:
             order_seq = order_seq - 1
-            task = executor.submit(self.seach_indexer, order_seq, index, search_word, key_word, s_num, e_num, year,
-                                   whole_word)
-            all_task.append(task)
+            indexer_args.append((order_seq, index, search_word, key_word, s_num, e_num, year, whole_word))
+        if AsyncEngine().is_enabled():
+            # 异步检索
+            log.info("【JACKETT】开始异步检索 %s，Indexer数：%s" % (key_word, len(self.__indexers)))
+            results = AsyncEngine().run(self.__async_search_indexers(indexer_args))
+        else:
+            # 多线程检索
+            log.info("【JACKETT】开始并行检索 %s，线程数：%s" % (key_word, len(self.__indexers)))
+            executor = ThreadPoolExecutor(max_workers=len(self.__indexers))
+            all_task = []
+            for args in indexer_args:
+                task = executor.submit(self.seach_indexer, *args)
+                all_task.append(task)
+            results = [future.result() for future in as_completed(all_task)]
         ret_array = []
-        for future in as_completed(all_task):
-            result = future.result()
+        for result in results:
             if result:
                 ret_array = ret_array + result
         log.info("【JACKETT】所有API检索完成，有效资源数：%s" % len(ret_array))
@@ -262,11 +351,7 @@ class Jackett:
         else:
             if in_from == SearchType.WX:
                 # 保存微信搜索记录
-                delete_all_jackett_torrents()
-                # 插入数据库
-                save_media_list = get_torrents_group_item(media_list)
-                for save_media_item in save_media_list:
-                    insert_jackett_results(save_media_item)
+                SearchHelper().add_search(get_torrents_group_item(media_list), keyword=content)
                 self.message.sendmsg(title="%s 共检索到 %s 个有效资源，即将择优下载..." % (content, len(media_list)), text="")
             # 去重择优后开始添加下载
             download_medias = self.downloader.check_and_add_pt(in_from, media_list, total_tv_no_exists)
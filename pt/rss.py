@@ -1,20 +1,30 @@
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Semaphore
+from urllib.parse import urlparse
+
 import log
-from config import Config
-from utils.functions import parse_rssxml, is_chinese, singleton
+from config import Config, RSS_IDENTIFY_BATCH_SIZE, RSS_SEEN_EXPIRE_DAYS, RSS_FETCH_THREADS, RSS_DOMAIN_THREADS, \
+    RSS_DOMAIN_INTERVAL
+from utils.functions import parse_rssxml, get_xml_content, is_chinese, singleton, split_batches
 from message.send import Message
 from pt.downloader import Downloader
 from rmt.media import Media
-from utils.sqls import get_movie_keys, get_tv_keys, is_torrent_rssd_by_name, insert_rss_torrents
+from utils.sqls import get_movie_keys, get_tv_keys, is_torrent_rssd_by_name, insert_rss_torrents, \
+    get_rss_feed_state, update_rss_feed_state, get_rss_seen_enclosures, insert_rss_seen_enclosures, \
+    delete_expired_rss_seen
 from utils.types import MediaType, SearchType
 
-RSS_CACHED_TORRENTS = []
+lock = Lock()
 
 
 @singleton
 class Rss:
     __rss_chinese = None
     __sites = None
+    __domain_slots = {}
     message = None
     media = None
     downloader = None
@@ -33,7 +43,6 @@ class Rss:
             self.__sites = pt.get('sites')
 
     def rssdownload(self):
-        global RSS_CACHED_TORRENTS
         if not self.__sites:
             return
         log.info("【RSS】开始RSS订阅...")
@@ -54,9 +63,12 @@ class Rss:
         if not movie_keys and not tv_keys:
             return
 
+        # 清理过期的已处理种子链接
+        delete_expired_rss_seen(RSS_SEEN_EXPIRE_DAYS)
+
         # 代码站点配置优先级的序号
         order_seq = 0
-        rss_download_torrents = []
+        rss_jobs = []
         for rss_job, job_info in self.__sites.items():
             order_seq = order_seq + 1
             # 读取子配置
@@ -67,87 +79,193 @@ class Rss:
             res_type = job_info.get('res_type')
             if res_type and not isinstance(res_type, list):
                 res_type = [res_type]
+            rss_jobs.append((rss_job, order_seq, rssurl, res_type))
 
-            # 开始下载RSS
+        # 多个站点并行处理，结果按站点优先级顺序合并
+        # 本次各站点已匹配的名称及站点序号，同一名称只保留优先级最高的站点，各站点共用，需在锁内读写
+        claimed_names = {}
+        rss_download_torrents = []
+        if rss_jobs:
+            with ThreadPoolExecutor(max_workers=min(RSS_FETCH_THREADS, len(rss_jobs))) as executor:
+                results = executor.map(lambda job: self.__rss_site(*job, movie_keys, tv_keys, claimed_names),
+                                       rss_jobs)
+                for media_infos in results:
+                    for media_info in media_infos:
+                        # 先处理完的低优先级站点匹配到的名称，被高优先级的站点占用后不再下载
+                        if claimed_names.get(self.__get_match_name(media_info)) != media_info.site_order:
+                            continue
+                        if media_info not in rss_download_torrents:
+                            rss_download_torrents.append(media_info)
+        log.info("【RSS】所有RSS处理结束，共 %s 个有效资源" % len(rss_download_torrents))
+        # 去重择优后开始添加下载
+        download_medias = self.downloader.check_and_add_pt(SearchType.RSS, rss_download_torrents)
+        log.info("【RSS】实际下载了 %s 个资源" % len(download_medias))
+
+    # 按域名控制并发数及请求间隔
+    @contextmanager
+    def __domain_slot(self, url):
+        domain = urlparse(url).netloc
+        with lock:
+            slot = self.__domain_slots.get(domain)
+            if not slot:
+                slot = [Semaphore(RSS_DOMAIN_THREADS), 0]
+                self.__domain_slots[domain] = slot
+        with slot[0]:
+            with lock:
+                now = time.time()
+                start_time = max(now, slot[1] + RSS_DOMAIN_INTERVAL)
+                slot[1] = start_time
+            if start_time > now:
+                time.sleep(start_time - now)
+            yield
+
+    # 处理一个站点的RSS，返回匹配订阅规则的媒体信息
+    def __rss_site(self, rss_job, order_seq, rssurl, res_type, movie_keys, tv_keys, claimed_names):
+        match_medias = []
+        try:
+            # 开始下载RSS，带上次的更新状态做条件请求，只在下载时占用域名的并发数
             log.info("【RSS】正在处理：%s" % rss_job)
-            rss_result = parse_rssxml(rssurl)
-            if len(rss_result) == 0:
+            feed_state = get_rss_feed_state(rssurl)
+            with self.__domain_slot(rssurl):
+                content = get_xml_content(rssurl, feed_state)
+            # 分批识别
+            rss_num = 0
+            fail_num = 0
+            if content is not None:
+                try:
+                    for rss_items in split_batches(parse_rssxml(rssurl, feed_state, content),
+                                                   RSS_IDENTIFY_BATCH_SIZE):
+                        rss_num = rss_num + len(rss_items)
+                        batch_medias, batch_fail_num = self.__get_match_medias(rss_job, order_seq, res_type,
+                                                                               rss_items, movie_keys, tv_keys,
+                                                                               claimed_names)
+                        fail_num = fail_num + batch_fail_num
+                        for media_info in batch_medias:
+                            if media_info not in match_medias:
+                                match_medias.append(media_info)
+                finally:
+                    content.close()
+            if not feed_state.get('changed'):
+                log.info("【RSS】%s 没有更新" % rss_job)
+                update_rss_feed_state(rssurl, rss_job, feed_state)
+                return match_medias
+            if rss_num == 0:
                 log.warn("【RSS】%s 未下载到数据" % rss_job)
-                continue
+                return match_medias
+            # 有识别出错的不保存更新状态，下次重新下载并处理，已处理过的按种子链接跳过
+            if fail_num:
+                log.warn("【RSS】%s 有 %s 条识别出错，下次重新处理" % (rss_job, fail_num))
             else:
-                log.info("【RSS】%s 发现更新：%s" % (rss_job, len(rss_result)))
+                update_rss_feed_state(rssurl, rss_job, feed_state)
+            log.info("【RSS】%s 发现更新：%s" % (rss_job, rss_num))
+            log.info("【RSS】%s 处理结束，匹配到 %s 个有效资源" % (rss_job, len(match_medias)))
+        except Exception as e:
+            log.error("【RSS】%s 处理出错：%s" % (rss_job, str(e)))
+        return match_medias
 
-            res_num = 0
-            for res in rss_result:
-                try:
-                    torrent_name = res['title']
-                    enclosure = res['enclosure']
-                    description = res['description']
-                    # 判断是否处理过
-                    if enclosure in RSS_CACHED_TORRENTS:
-                        log.info("【RSS】%s 已处理过，跳过..." % torrent_name)
-                        continue
-                    else:
-                        RSS_CACHED_TORRENTS.append(enclosure)
+    # 识别一批RSS数据，返回匹配订阅规则的媒体信息及识别出错的条数
+    # claimed_names为本次各站点共用的已匹配名称，与数据库中的记录一起用于去重
+    def __get_match_medias(self, rss_job, order_seq, res_type, rss_items, movie_keys, tv_keys, claimed_names):
+        match_medias = []
+        # 已有确定结果的种子链接，处理完成后记为已处理，识别出错的不记录，下次重新识别
+        done_enclosures = []
+        fail_num = 0
+        # 过滤掉处理过的
+        seen_enclosures = get_rss_seen_enclosures([res['enclosure'] for res in rss_items])
+        new_result = []
+        for res in rss_items:
+            enclosure = res['enclosure']
+            if enclosure in seen_enclosures:
+                log.info("【RSS】%s 已处理过，跳过..." % res['title'])
+                continue
+            else:
+                seen_enclosures.add(enclosure)
+                new_result.append(res)
+        # 批量识别种子名称，开始检索TMDB
+        media_infos = self.media.get_media_infos([res['title'] for res in new_result],
+                                                 [res['description'] for res in new_result])
+        for res, media_info in zip(new_result, media_infos):
+            try:
+                torrent_name = res['title']
+                enclosure = res['enclosure']
 
-                    log.info("【RSS】开始处理：%s" % torrent_name)
+                log.info("【RSS】开始处理：%s" % torrent_name)
 
-                    # 识别种子名称，开始检索TMDB
-                    media_info = self.media.get_media_info(torrent_name, description)
-                    if not media_info or not media_info.tmdb_info:
-                        continue
-                    if self.__rss_chinese and not is_chinese(media_info.title):
-                        log.info("【RSS】%s 没有中文信息，跳过..." % media_info.title)
-                        continue
-                    # 检查这个名字是不是下过了
-                    if is_torrent_rssd_by_name(media_info.title,
-                                               media_info.year,
-                                               media_info.get_season_string(),
-                                               media_info.get_episode_string()):
-                        log.info("【RSS】%s 已处理过，跳过..." % (media_info.get_title_string()))
-                        continue
-                    # 检查种子名称或者标题是否匹配
-                    match_flag = self.__is_torrent_match(media_info, movie_keys, tv_keys)
-                    if match_flag:
-                        log.info("【RSS】%s: %s %s %s 匹配成功" % (media_info.type.value,
-                                                             media_info.get_title_string(),
-                                                             media_info.get_season_episode_string(),
-                                                             media_info.get_resource_type_string()))
-                    else:
-                        log.info("【RSS】%s: %s %s %s 不匹配订阅规则" % (media_info.type.value,
-                                                                media_info.get_title_string(),
-                                                                media_info.get_season_episode_string(),
-                                                                media_info.get_resource_type_string()))
+                if not media_info:
+                    log.warn("【RSS】%s 识别出错，下次重新处理" % torrent_name)
+                    fail_num = fail_num + 1
+                    continue
+                if not media_info.tmdb_info:
+                    done_enclosures.append(enclosure)
+                    continue
+                if self.__rss_chinese and not is_chinese(media_info.title):
+                    log.info("【RSS】%s 没有中文信息，跳过..." % media_info.title)
+                    done_enclosures.append(enclosure)
+                    continue
+                # 检查这个名字是不是下过了
+                match_name = self.__get_match_name(media_info)
+                if is_torrent_rssd_by_name(*match_name):
+                    log.info("【RSS】%s 已处理过，跳过..." % (media_info.get_title_string()))
+                    done_enclosures.append(enclosure)
+                    continue
+                # 检查种子名称或者标题是否匹配
+                match_flag = self.__is_torrent_match(media_info, movie_keys, tv_keys)
+                if match_flag:
+                    log.info("【RSS】%s: %s %s %s 匹配成功" % (media_info.type.value,
+                                                         media_info.get_title_string(),
+                                                         media_info.get_season_episode_string(),
+                                                         media_info.get_resource_type_string()))
+                else:
+                    log.info("【RSS】%s: %s %s %s 不匹配订阅规则" % (media_info.type.value,
+                                                            media_info.get_title_string(),
+                                                            media_info.get_season_episode_string(),
+                                                            media_info.get_resource_type_string()))
+                    done_enclosures.append(enclosure)
+                    continue
+                # 匹配后，看资源类型是否满足
+                # 代表资源类型在配置中的优先级顺序
+                res_order = 99
+                res_typestr = ""
+                if match_flag:
+                    # 确定标题中是否有资源类型关键字，并返回关键字的顺序号
+                    match_flag, res_order, res_typestr = self.media.check_resouce_types(torrent_name, res_type)
+                    if not match_flag:
+                        log.info("【RSS】%s 资源类型不匹配" % torrent_name)
+                        done_enclosures.append(enclosure)
                         continue
-                    # 匹配后，看资源类型是否满足
-                    # 代表资源类型在配置中的优先级顺序
-                    res_order = 99
-                    res_typestr = ""
-                    if match_flag:
-                        # 确定标题中是否有资源类型关键字，并返回关键字的顺序号
-                        match_flag, res_order, res_typestr = self.media.check_resouce_types(torrent_name, res_type)
-                        if not match_flag:
-                            log.info("【RSS】%s 资源类型不匹配" % torrent_name)
-                            continue
-                    # 插入数据库
-                    insert_rss_torrents(media_info)
-                    # 返回对象
-                    media_info.set_torrent_info(site_order=order_seq,
-                                                site=rss_job,
-                                                enclosure=enclosure,
-                                                res_type=res_typestr,
-                                                res_order=res_order)
-                    if media_info not in rss_download_torrents:
-                        rss_download_torrents.append(media_info)
-                        res_num = res_num + 1
-                except Exception as e:
-                    log.error("【RSS】错误：%s" % str(e))
+                # 占用名称，已被本站点或优先级更高的站点占用时跳过，其它站点并行处理时也能看到
+                with lock:
+                    claimed_seq = claimed_names.get(match_name)
+                    if claimed_seq is None or claimed_seq > order_seq:
+                        claimed_names[match_name] = order_seq
+                if claimed_seq is not None and claimed_seq <= order_seq:
+                    log.info("【RSS】%s 已处理过，跳过..." % (media_info.get_title_string()))
+                    done_enclosures.append(enclosure)
                     continue
-            log.info("【RSS】%s 处理结束，匹配到 %s 个有效资源" % (rss_job, res_num))
-        log.info("【RSS】所有RSS处理结束，共 %s 个有效资源" % len(rss_download_torrents))
-        # 去重择优后开始添加下载
-        download_medias = self.downloader.check_and_add_pt(SearchType.RSS, rss_download_torrents)
-        log.info("【RSS】实际下载了 %s 个资源" % len(download_medias))
+                # 返回对象
+                media_info.set_torrent_info(site_order=order_seq,
+                                            site=rss_job,
+                                            enclosure=enclosure,
+                                            res_type=res_typestr,
+                                            res_order=res_order)
+                match_medias.append(media_info)
+                done_enclosures.append(enclosure)
+            except Exception as e:
+                log.error("【RSS】错误：%s" % str(e))
+                fail_num = fail_num + 1
+                continue
+        # 插入数据库
+        insert_rss_torrents(match_medias)
+        insert_rss_seen_enclosures(done_enclosures)
+        return match_medias, fail_num
+
+    # 用于判断是否下载过的名称：标题、年份、季、集
+    @staticmethod
+    def __get_match_name(media_info):
+        return (media_info.title,
+                media_info.year,
+                media_info.get_season_string(),
+                media_info.get_episode_string())
 
     @staticmethod
     def __is_torrent_match(media_info, movie_keys, tv_keys):
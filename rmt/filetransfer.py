@@ -2,16 +2,21 @@ import argparse
 import os
 import re
 import shutil
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Semaphore
 from subprocess import call
 
 import log
-from config import RMT_SUBEXT, RMT_MEDIAEXT, RMT_DISKFREESIZE, RMT_FAVTYPE, Config
+from config import RMT_SUBEXT, RMT_MEDIAEXT, RMT_DISKFREESIZE, RMT_FAVTYPE, Config, TRANSFER_THREADS, \
+    TRANSFER_DEVICE_THREADS
 from rmt.category import Category
 from utils.functions import get_dir_files_by_ext, get_free_space_gb, get_dir_level1_medias, is_invalid_path, \
     is_path_in_path, singleton
 from message.send import Message
+from monitor.library_index import LibraryIndex
 from rmt.media import Media
+from utils.copy_utils import transfer_file_by_mode, transfer_dir_by_copy, clean_expired_copy_files
 from utils.sqls import insert_transfer_history, insert_transfer_unknown
 from utils.types import MediaType, DownloaderType, SyncType, RmtMode
 
@@ -30,14 +35,21 @@ class FileTransfer:
     __anime_category_flag = None
     __sync_path = None
     __unknown_path = None
+    __device_slots = {}
+    # 正在转移中的目的路径，不同任务转移到同一位置时只有一个能执行
+    __claimed_paths = set()
     media = None
     message = None
+    library_index = None
 
     def __init__(self):
         self.media = Media()
         self.message = Message()
         self.category = Category()
+        self.library_index = LibraryIndex()
+        self.__claimed_paths = set()
         self.init_config()
+        clean_expired_copy_files()
 
     def init_config(self):
         config = Config()
@@ -78,6 +90,40 @@ class FileTransfer:
             else:
                 self.__pt_rmt_mode = RmtMode.COPY
 
+    # 复制时按目的磁盘控制同时转移的文件数，不同磁盘之间互不影响，硬链接和软链接不限制
+    @contextmanager
+    def __copy_slot(self, path, rmt_mode):
+        if rmt_mode != RmtMode.COPY:
+            yield
+            return
+        # 目的路径可能还未创建，取已存在的上级目录所在设备
+        while path and not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        device = os.stat(path).st_dev
+        with lock:
+            device_slot = self.__device_slots.get(device)
+            if not device_slot:
+                device_slot = Semaphore(TRANSFER_DEVICE_THREADS)
+                self.__device_slots[device] = device_slot
+        with device_slot:
+            yield
+
+    # 占用目的路径直到转移结束，已被其它任务占用时返回False
+    @contextmanager
+    def __claim_path(self, path):
+        with lock:
+            if path in self.__claimed_paths:
+                claimed = False
+            else:
+                self.__claimed_paths.add(path)
+                claimed = True
+        try:
+            yield claimed
+        finally:
+            if claimed:
+                with lock:
+                    self.__claimed_paths.discard(path)
+
     # 根据文件名转移对应字幕文件
     @staticmethod
     def transfer_subtitles(org_name, new_name, rmt_mode=RmtMode.COPY):
@@ -101,12 +147,7 @@ class FileTransfer:
                         new_file = os.path.splitext(new_name)[0] + file_ext
                     if not os.path.exists(new_file):
                         log.debug("【RMT】正在处理字幕：%s" % file_name)
-                        if rmt_mode == RmtMode.LINK:
-                            retcode = call(["ln", file_item, new_file])
-                        elif rmt_mode == RmtMode.SOFTLINK:
-                            retcode = call(["ln", "-s", file_item, new_file])
-                        else:
-                            retcode = call(["cp", file_item, new_file])
+                        retcode = transfer_file_by_mode(file_item, new_file, rmt_mode)
                         if retcode == 0:
                             log.info("【RMT】字幕 %s %s完成" % (file_name, rmt_mode.value))
                         else:
@@ -124,19 +165,20 @@ class FileTransfer:
     '''
 
     def transfer_bluray_dir(self, file_path, new_path, mv_flag=False, over_flag=False):
-        if not over_flag and os.path.exists(new_path):
-            log.warn("【RMT】目录已存在：%s" % new_path)
-            return False
-
-        try:
-            lock.acquire()
-            if over_flag and os.path.exists(new_path):
-                log.warn("【RMT】正在删除已存在的目录：%s" % new_path)
-                shutil.rmtree(new_path)
-            log.info("【RMT】正在复制目录：%s 到 %s" % (file_path, new_path))
-            retcode = call(['cp', '-r', file_path, new_path])
-        finally:
-            lock.release()
+        with self.__claim_path(new_path) as claimed:
+            if not claimed:
+                log.warn("【RMT】目录正在被其它任务转移：%s" % new_path)
+                return False
+            if not over_flag and os.path.exists(new_path):
+                log.warn("【RMT】目录已存在：%s" % new_path)
+                return False
+
+            with self.__copy_slot(new_path, RmtMode.COPY):
+                if over_flag and os.path.exists(new_path):
+                    log.warn("【RMT】正在删除已存在的目录：%s" % new_path)
+                    shutil.rmtree(new_path)
+                log.info("【RMT】正在复制目录：%s 到 %s" % (file_path, new_path))
+                retcode = transfer_dir_by_copy(file_path, new_path)
 
         if retcode == 0:
             log.info("【RMT】文件 %s 复制完成" % new_path)
@@ -176,14 +218,9 @@ class FileTransfer:
         target_dir = os.path.join(target_dir, parent_name)
         if not os.path.exists(target_dir):
             log.debug("【RMT】正在创建目录：%s" % target_dir)
-            os.makedirs(target_dir)
+            os.makedirs(target_dir, exist_ok=True)
         target_file = os.path.join(target_dir, file_name)
-        if rmt_mode == RmtMode.LINK:
-            retcode = call(['ln', file_item, target_file])
-        elif rmt_mode == RmtMode.SOFTLINK:
-            retcode = call(['ln', '-s', file_item, target_file])
-        else:
-            retcode = call(['cp', file_item, target_file])
+        retcode = transfer_file_by_mode(file_item, target_file, rmt_mode)
 
         if retcode == 0:
             log.info("【RMT】文件 %s %s到unknown完成" % (file_name, rmt_mode.value))
@@ -196,42 +233,40 @@ class FileTransfer:
     def transfer_file(self, file_item, new_file, over_flag=False, rmt_mode=RmtMode.COPY):
         file_name = os.path.basename(file_item)
         new_file_name = os.path.basename(new_file)
-        if not over_flag and os.path.exists(new_file):
-            log.warn("【RMT】文件已存在：%s" % new_file_name)
-            return False
-
-        try:
-            if rmt_mode == RmtMode.COPY:
-                lock.acquire()
-            if over_flag and os.path.isfile(new_file):
-                log.info("【RMT】正在删除已存在的文件：%s" % new_file_name)
-                os.remove(new_file)
-            log.info("【RMT】正在转移文件：%s 到 %s" % (file_name, new_file_name))
-            if rmt_mode == RmtMode.LINK:
-                retcode = call(['ln', file_item, new_file])
-            elif rmt_mode == RmtMode.SOFTLINK:
-                retcode = call(['ln', '-s', file_item, new_file])
-            else:
-                retcode = call(['cp', file_item, new_file])
-        finally:
-            if rmt_mode == RmtMode.COPY:
-                lock.release()
+        # 检查是否已存在及转移都在占用目的路径期间进行，避免并行的任务同时转移到同一位置
+        with self.__claim_path(new_file) as claimed:
+            if not claimed:
+                log.warn("【RMT】文件正在被其它任务转移：%s" % new_file_name)
+                return False
+            if not over_flag and os.path.exists(new_file):
+                log.warn("【RMT】文件已存在：%s" % new_file_name)
+                return False
+
+            with self.__copy_slot(new_file, rmt_mode):
+                # 复制时完成后直接替换已存在的文件，链接时需先删除
+                if over_flag and rmt_mode != RmtMode.COPY and os.path.isfile(new_file):
+                    log.info("【RMT】正在删除已存在的文件：%s" % new_file_name)
+                    os.remove(new_file)
+                log.info("【RMT】正在转移文件：%s 到 %s" % (file_name, new_file_name))
+                retcode = transfer_file_by_mode(file_item, new_file, rmt_mode)
 
         if retcode == 0:
             log.info("【RMT】文件 %s %s完成" % (file_name, rmt_mode.value))
+            self.library_index.add(new_file)
         else:
             log.error("【RMT】文件 %s %s失败，错误码：%s" % (file_name, rmt_mode.value, str(retcode)))
             return False
         # 处理字幕
         return self.transfer_subtitles(file_item, new_file, rmt_mode)
 
-    # 转移识别媒体文件 in_from：来源  in_path：路径，可有是个目录也可能是一个文件  target_dir：指定目的目录，否则按电影、电视剧目录
+    # 转移识别媒体文件 in_from：来源  in_path：路径，可有是个目录也可能是一个文件  target_dir：指定目的目录，否则按电影、电视剧目录  files：in_path为目录时只处理其中的这些文件
     def transfer_media(self,
                        in_from,
                        in_path,
                        target_dir=None,
                        tmdb_info=None,
-                       media_type=None):
+                       media_type=None,
+                       files=None):
         if not in_path:
             log.error("【RMT】输入路径错误!")
             return False, "输入路径错误"
@@ -269,6 +304,9 @@ class FileTransfer:
             if bluray_disk_flag:
                 file_list = [in_path]
                 log.info("【RMT】当前为蓝光原盘文件夹：%s" % str(in_path))
+            elif files:
+                # 传入了文件清单时只处理这些文件，不再遍历目录
+                file_list = files
             else:
                 file_list = get_dir_files_by_ext(in_path, RMT_MEDIAEXT)
                 Media_FileNum = len(file_list)
@@ -293,15 +331,20 @@ class FileTransfer:
             log.error("【RMT】检索媒体信息出错！")
             return False, "检索媒体信息出错"
 
-        # 统计总的文件数、失败文件数
+        # 统计总的文件数、失败文件数，以及连接TMDB出错的文件数
         failed_count = 0
         total_count = 0
+        error_count = 0
         # 如果是电影，因为只会有一个文件，直接在循环里就发了消息
         # 但是电视剧可能有多集，如果在循环里发消息就太多了，要在外面发消息
         # 如果这个目录很复杂，有多集或者多部电影电视剧，则电视剧也要在外面统一发消息
         # title: {year, media_filesize, season_ary[], episode_ary}
         message_medias = {}
 
+        # 先逐个识别并确定目的路径，再并行转移文件，最后统一记录历史及发送消息
+        transfer_jobs = []
+        # 本次已安排转移的目的文件，避免多个文件转移到同一位置
+        planned_files = set()
         for file_item, media in Medias.items():
             if re.search(r'[./\s\[]+Sample[/.\s\]]+', file_item, re.IGNORECASE):
                 log.warn("【RMT】%s 可能是预告片，跳过..." % file_item)
@@ -309,6 +352,12 @@ class FileTransfer:
             total_count = total_count + 1
             # 文件名
             file_name = os.path.basename(file_item)
+            if media is None:
+                # 识别出错的不当作未识别，保留在原处等下次重新识别
+                log.error("【RMT】%s 识别媒体信息出错！" % file_name)
+                failed_count = failed_count + 1
+                error_count = error_count + 1
+                continue
             if not media or not media.tmdb_info:
                 log.warn("【RMT】%s 无法识别媒体信息！" % file_name)
                 # 记录未识别
@@ -359,6 +408,12 @@ class FileTransfer:
             dir_exist_flag, ret_dir_path, file_exist_flag, ret_file_path = self.is_media_exists(dist_path, media)
             # 已存在的文件数量
             exist_filenum = 0
+            transfer_job = {"file_item": file_item,
+                            "media": media,
+                            "dist_path": dist_path,
+                            "media_filesize": media_filesize,
+                            "bluray_disk_flag": bluray_disk_flag,
+                            "over_flag": False}
             # 路径存在
             if dir_exist_flag:
                 # 蓝光原盘
@@ -367,20 +422,20 @@ class FileTransfer:
                     continue
                 # 文年存在
                 if file_exist_flag:
-                    exist_filenum = exist_filenum + 1
-                    if rmt_mode == RmtMode.COPY:
+                    try:
                         existfile_size = os.path.getsize(ret_file_path)
-                        if media_filesize > existfile_size:
+                    except OSError:
+                        # 检查之后文件已被删除，按不存在处理
+                        existfile_size = None
+                        ret_file_path = os.path.splitext(ret_file_path)[0]
+                    if existfile_size is not None:
+                        exist_filenum = exist_filenum + 1
+                        if rmt_mode == RmtMode.COPY and media_filesize > existfile_size:
                             log.info("【RMT】文件 %s 已存在，但新文件质量更好，覆盖..." % ret_file_path)
-                            ret = self.transfer_file(file_item, ret_file_path, True, rmt_mode)
-                            if not ret:
-                                continue
+                            transfer_job.update({"new_file": ret_file_path, "over_flag": True})
                         else:
                             log.warn("【RMT】文件 %s 已存在" % ret_file_path)
                             continue
-                    else:
-                        log.warn("【RMT】文件 %s 已存在" % ret_file_path)
-                        continue
             # 路径不存在
             else:
                 if not ret_dir_path:
@@ -388,34 +443,47 @@ class FileTransfer:
                     continue
                 # 转移蓝光原盘
                 if bluray_disk_flag:
-                    ret = self.transfer_bluray_dir(file_item, ret_dir_path)
-                    if ret:
-                        insert_transfer_history(in_from, rmt_mode, in_path, dist_path, media)
-                        log.info("【RMT】蓝光原盘 %s 转移成功" % file_name)
-                    else:
-                        log.error("【RMT】蓝光原盘 %s 转移失败！" % file_name)
-                        continue
+                    transfer_job.update({"new_file": ret_dir_path})
                 else:
                     # 创建电录
                     log.debug("【RMT】正在创建目录：%s" % ret_dir_path)
-                    os.makedirs(ret_dir_path)
-            # 开始转移文件
-            file_ext = os.path.splitext(file_item)[-1]
-            if not ret_file_path:
-                log.error("【RMT】拼装文件路径错误，请确认媒体类型是否匹配！")
+                    os.makedirs(ret_dir_path, exist_ok=True)
+                    self.library_index.add(ret_dir_path)
+            if not transfer_job.get("new_file"):
+                # 开始转移文件
+                file_ext = os.path.splitext(file_item)[-1]
+                if not ret_file_path:
+                    log.error("【RMT】拼装文件路径错误，请确认媒体类型是否匹配！")
+                    continue
+                transfer_job.update({"new_file": "%s%s" % (ret_file_path, file_ext)})
+            if transfer_job.get("new_file") in planned_files:
+                log.warn("【RMT】文件 %s 已存在" % transfer_job.get("new_file"))
                 continue
-            new_file = "%s%s" % (ret_file_path, file_ext)
-            ret = self.transfer_file(file_item, new_file, False, rmt_mode)
+            planned_files.add(transfer_job.get("new_file"))
+            transfer_job.update({"exist_filenum": exist_filenum})
+            transfer_jobs.append(transfer_job)
+
+        # 并行转移文件，复制时每个目的磁盘同时只转移有限个文件
+        if transfer_jobs:
+            with ThreadPoolExecutor(max_workers=min(TRANSFER_THREADS, len(transfer_jobs))) as executor:
+                results = list(executor.map(lambda job: self.__transfer_job(job, rmt_mode), transfer_jobs))
+        else:
+            results = []
+
+        # 转移历史记录
+        insert_transfer_history(in_from, rmt_mode, in_path,
+                                [(transfer_job.get("dist_path"), transfer_job.get("media"))
+                                 for transfer_job, ret in zip(transfer_jobs, results) if ret])
+        for transfer_job, ret in zip(transfer_jobs, results):
             if not ret:
                 continue
-            # 转移历史记录
-            insert_transfer_history(in_from, rmt_mode, in_path, dist_path, media)
-            # 电影立即发送消息
+            media = transfer_job.get("media")
+            # 电影逐个发送消息
             if media.type == MediaType.MOVIE:
                 self.message.send_transfer_movie_message(in_from,
                                                          media,
-                                                         media_filesize,
-                                                         exist_filenum,
+                                                         transfer_job.get("media_filesize"),
+                                                         transfer_job.get("exist_filenum"),
                                                          self.__movie_category_flag)
             # 否则汇总发消息
             else:
@@ -432,7 +500,8 @@ class FileTransfer:
                                                                 "type": media.type.value}
                 # 总文件大小
                 message_medias[media.get_title_string()]['totalsize'] = message_medias[media.get_title_string()][
-                                                                            'totalsize'] + media_filesize
+                                                                            'totalsize'] + transfer_job.get(
+                    "media_filesize")
                 # 季集合
                 message_medias[media.get_title_string()]['seasons'] = list(
                     set(message_medias[media.get_title_string()].get('seasons')).union(set(media.get_season_list())))
@@ -440,15 +509,35 @@ class FileTransfer:
                 message_medias[media.get_title_string()]['episodes'] = list(
                     set(message_medias[media.get_title_string()].get('episodes')).union(set(media.get_episode_list())))
             # 文件转移完成
-            log.info("【RMT】%s 转移完成" % file_name)
+            log.info("【RMT】%s 转移完成" % os.path.basename(transfer_job.get("file_item")))
         # 循环结束
         # 统计完成情况，发送通知
         if message_medias:
             self.message.send_transfer_tv_message(message_medias, in_from)
         # 总结
         log.info("【RMT】%s 处理完成，总数：%s，失败：%s" % (in_path, total_count, failed_count))
+        if error_count:
+            return False, "%s 个文件识别媒体信息出错" % error_count
         return True, ""
 
+    # 执行一个转移任务，蓝光原盘转移目录，其它转移文件
+    def __transfer_job(self, transfer_job, rmt_mode):
+        try:
+            if transfer_job.get("bluray_disk_flag"):
+                ret = self.transfer_bluray_dir(transfer_job.get("file_item"), transfer_job.get("new_file"))
+                if ret:
+                    log.info("【RMT】蓝光原盘 %s 转移成功" % os.path.basename(transfer_job.get("file_item")))
+                else:
+                    log.error("【RMT】蓝光原盘 %s 转移失败！" % os.path.basename(transfer_job.get("file_item")))
+                return ret
+            return self.transfer_file(transfer_job.get("file_item"),
+                                      transfer_job.get("new_file"),
+                                      transfer_job.get("over_flag"),
+                                      rmt_mode)
+        except Exception as e:
+            log.error("【RMT】%s 转移出错：%s" % (transfer_job.get("file_item"), str(e)))
+            return False
+
     # 全量转移，用于使用命令调用
     def transfer_manually(self, s_path, t_path):
         if not s_path:
@@ -493,6 +582,7 @@ class FileTransfer:
                         log.info("【SYNC】%s 处理成功" % path)
 
     # 判断媒体文件是否忆存在，返回：目录存在标志、目录名、文件存在标志、文件名
+    # 结果用于决定创建目录、覆盖文件，直接检查文件系统，不使用媒体库索引
     def is_media_exists(self,
                         media_dest,
                         media):
@@ -567,7 +657,7 @@ class FileTransfer:
                             break
         return dir_exist_flag, ret_dir_path, file_exist_flag, ret_file_path
 
-    # 检查媒体库是否存在，返回TRUE或FLASE
+    # 检查媒体库是否存在，返回TRUE或FLASE，只用于判断是否需要下载，使用媒体库索引
     def is_media_file_exists(self, item):
         mtype = item.type
         title = item.title
@@ -583,12 +673,12 @@ class FileTransfer:
         if mtype == MediaType.MOVIE:
             if self.__movie_category_flag:
                 dest_path = os.path.join(self.__movie_path, RMT_FAVTYPE, title_str)
-                if os.path.exists(dest_path):
+                if self.library_index.exists(dest_path):
                     return True
                 dest_path = os.path.join(self.__movie_path, category, title_str)
             else:
                 dest_path = os.path.join(self.__movie_path, title_str)
-            return os.path.exists(dest_path)
+            return self.library_index.exists(dest_path)
         else:
             if mtype == MediaType.TV:
                 dest_dir = self.__tv_path
@@ -601,7 +691,7 @@ class FileTransfer:
             if not season:
                 # 没有季信息的情况下，只判断目录
                 dest_path = os.path.join(dest_dir, title_str)
-                return os.path.exists(dest_path)
+                return self.library_index.exists(dest_path)
             else:
                 if not episode:
                     # 有季没有集的情况下，只要有一季缺失就下
@@ -609,7 +699,7 @@ class FileTransfer:
                         if not sea:
                             continue
                         dest_path = os.path.join(dest_dir, title_str, "Season %s" % sea)
-                        if not os.path.exists(dest_path):
+                        if not self.library_index.exists(dest_path):
                             return False
                     return True
                 else:
@@ -627,7 +717,7 @@ class FileTransfer:
                                 dest_path = os.path.join(dest_dir, title_str,
                                                          "Season %s" % sea, "%s%s - %s%s - 第 %s 集%s" % (
                                                              title, part, sea_str, epi_str, epi, ext))
-                                if os.path.exists(dest_path):
+                                if self.library_index.exists(dest_path):
                                     ext_exist = True
                             if not ext_exist:
                                 return False
@@ -654,6 +744,8 @@ class FileTransfer:
             return False, None
         ret = call(['mv', movie_dir, new_path])
         if ret == 0:
+            self.library_index.remove(movie_dir)
+            self.library_index.add(new_path)
             return True, org_type
         else:
             return False, None
@@ -1,15 +1,18 @@
 import os
 import re
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from threading import Lock, Condition
 import log
 from tmdbv3api import TMDb, Search, Movie, TV
-from config import Config
+from config import Config, TMDB_QUERY_THREADS
 from rmt.metainfo import MetaInfo
 from utils.functions import xstr, singleton, is_anime
 from utils.meta_helper import MetaHelper
 from utils.types import MediaType, MatchMode
 
 lock = Lock()
+language_cond = Condition()
 
 
 @singleton
@@ -21,8 +24,12 @@ class Media:
     tv = None
     meta = None
     __rmt_match_mode = None
+    __key_locks = {}
+    # 正在检索TMDB的线程数，TMDB的语言是全局设置，有线程在检索时不能切换
+    __language_users = 0
 
     def __init__(self):
+        self.__key_locks = {}
         self.init_config()
 
     def init_config(self):
@@ -48,18 +55,54 @@ class Media:
             else:
                 self.__rmt_match_mode = MatchMode.NORMAL
 
+    # 按媒体KEY加锁，相同KEY的并发查询等待同一次TMDB检索，不同KEY之间并行
+    @contextmanager
+    def __media_key_lock(self, media_key):
+        with lock:
+            key_lock = self.__key_locks.get(media_key)
+            if not key_lock:
+                key_lock = [Lock(), 0]
+                self.__key_locks[media_key] = key_lock
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield
+        finally:
+            with lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    self.__key_locks.pop(media_key, None)
+
+    # 按指定的语言检索TMDB，相同语言的检索可以并行，切换语言时等待其它语言的检索都结束
+    @contextmanager
+    def __tmdb_language(self, language):
+        with language_cond:
+            while self.__language_users and self.tmdb.language != language:
+                language_cond.wait()
+            if self.tmdb.language != language:
+                self.tmdb.language = language
+            self.__language_users += 1
+        try:
+            yield
+        finally:
+            with language_cond:
+                self.__language_users -= 1
+                if not self.__language_users:
+                    language_cond.notify_all()
+
     # 检索tmdb中的媒体信息，传入名字、年份、类型
-    # 返回媒体信息对象
+    # 返回媒体信息对象，未找到返回None，连接TMDB出错返回False
     def __search_tmdb(self, file_media_name, media_year, search_type, language=None):
         if not self.search:
             return None
         if not file_media_name:
             log.error("【META】检索关键字有误！")
             return None
-        if language:
-            self.tmdb.language = language
-        else:
-            self.tmdb.language = 'zh'
+        with self.__tmdb_language(language or 'zh'):
+            return self.__search_tmdb_info(file_media_name, media_year, search_type)
+
+    # 检索TMDB，需在__tmdb_language内调用，返回值同__search_tmdb
+    def __search_tmdb_info(self, file_media_name, media_year, search_type):
         # TMDB检索
         if search_type == MediaType.MOVIE:
             # 先按年份查，不行再不用年份查
@@ -71,7 +114,7 @@ class Media:
                     movies = self.search.movies({"query": file_media_name})
             except Exception as e:
                 log.error("【META】连接TMDB出错：%s" % str(e))
-                return None
+                return False
             log.debug("【META】API返回：%s" % str(self.search.total_results))
             if len(movies) == 0:
                 log.warn("【META】%s 未找到媒体信息!" % file_media_name)
@@ -95,7 +138,7 @@ class Media:
                     tvs = self.search.tv_shows({"query": file_media_name})
             except Exception as e:
                 log.error("【META】连接TMDB出错：%s" % str(e))
-                return None
+                return False
             log.debug("【META】API返回：%s" % str(self.search.total_results))
             if len(tvs) == 0:
                 log.warn("【META】%s 未找到媒体信息!" % file_media_name)
@@ -122,7 +165,7 @@ class Media:
         if not tmdbid:
             if not mtype or not title or not year:
                 return None
-            tmdb_info = self.__search_tmdb(title, year, mtype)
+            tmdb_info = self.__search_tmdb(title, year, mtype) or None
         else:
             if mtype == MediaType.MOVIE:
                 tmdb_info = self.get_tmdb_movie_info(tmdbid)
@@ -130,73 +173,136 @@ class Media:
                 tmdb_info = self.get_tmdb_tv_info(tmdbid)
         return tmdb_info
 
-    # 只有名称信息，判别是电影还是电视剧并TMDB信息
-    def get_media_info(self, title, subtitle=None):
-        if not title:
-            return None
-        if not self.meta:
-            return None
-        if not is_anime(title):
-            # 常规识别
+    # 解析名称，返回识别信息及缓存的KEY
+    @staticmethod
+    def __get_meta_info(title, subtitle=None, anime=False):
+        if not anime:
             meta_info = MetaInfo(title, subtitle=subtitle)
             media_key = "%s%s" % (meta_info.get_name(), meta_info.year)
-            try:
-                lock.acquire()
+        else:
+            meta_info = MetaInfo(title, anime=True)
+            media_key = "[ANIME]%s%s" % (meta_info.get_name(), meta_info.year)
+        return meta_info, media_key
+
+    # 缓存中没有时检索TMDB，结果加入缓存，连接TMDB出错时返回False
+    def __search_media_key(self, meta_info, media_key, anime=False):
+        # 检索过程中是否连接TMDB出错，出错时不标记为未找到，下次重新检索
+        search_error = [False]
+
+        def search_tmdb(name, year, mtype):
+            info = self.__search_tmdb(name, year, mtype)
+            if info is False:
+                search_error[0] = True
+            return info
+
+        if not anime:
+            # 常规识别
+            with self.__media_key_lock(media_key):
                 if not self.meta.get_meta_data().get(media_key):
                     # 缓存中没有开始查询
                     if meta_info.type == MediaType.TV:
                         # 确定是电视剧，直接按电视剧查
-                        file_media_info = self.__search_tmdb(meta_info.get_name(), meta_info.year, MediaType.TV)
+                        file_media_info = search_tmdb(meta_info.get_name(), meta_info.year, MediaType.TV)
                         if meta_info.year and not file_media_info and self.__rmt_match_mode == MatchMode.NORMAL:
                             # 非严格模式去掉年份再查一遍
-                            file_media_info = self.__search_tmdb(meta_info.get_name(), None, MediaType.TV)
+                            file_media_info = search_tmdb(meta_info.get_name(), None, MediaType.TV)
                     else:
                         # 不能确定是电视剧，先按电影查
-                        file_media_info = self.__search_tmdb(meta_info.get_name(), meta_info.year, MediaType.MOVIE)
+                        file_media_info = search_tmdb(meta_info.get_name(), meta_info.year, MediaType.MOVIE)
                         if not file_media_info:
                             # 电影查不到再按电视剧查
-                            file_media_info = self.__search_tmdb(meta_info.get_name(), meta_info.year, MediaType.TV)
+                            file_media_info = search_tmdb(meta_info.get_name(), meta_info.year, MediaType.TV)
                         if meta_info.year and not file_media_info and self.__rmt_match_mode == MatchMode.NORMAL:
                             # 非严格模式去掉年份再查一遍， 先查电视剧（一般电视剧年份出错的概率高）
-                            file_media_info = self.__search_tmdb(meta_info.get_name(), None, MediaType.TV)
+                            file_media_info = search_tmdb(meta_info.get_name(), None, MediaType.TV)
                             if not file_media_info:
                                 # 不带年份查电影
-                                file_media_info = self.__search_tmdb(meta_info.get_name(), None, MediaType.MOVIE)
+                                file_media_info = search_tmdb(meta_info.get_name(), None, MediaType.MOVIE)
                     # 加入缓存
                     if file_media_info:
                         self.meta.update_meta_data({media_key: file_media_info})
-                    else:
+                    elif not search_error[0]:
                         # 标记为未找到，避免再次查询
                         self.meta.update_meta_data({media_key: {'id': 0}})
-            finally:
-                lock.release()
         else:
             # 动漫识别
-            meta_info = MetaInfo(title, anime=True)
-            media_key = "[ANIME]%s%s" % (meta_info.get_name(), meta_info.year)
             if meta_info.type != MediaType.UNKNOWN:
-                try:
-                    lock.acquire()
+                with self.__media_key_lock(media_key):
                     if not self.meta.get_meta_data().get(media_key):
-                        file_media_info = self.__search_tmdb(meta_info.get_name(), meta_info.year, meta_info.type)
+                        file_media_info = search_tmdb(meta_info.get_name(), meta_info.year, meta_info.type)
                         # 加入缓存
                         if file_media_info:
                             self.meta.update_meta_data({media_key: file_media_info})
-                        else:
+                        elif not search_error[0]:
                             # 标记为未找到，避免再次查询
                             self.meta.update_meta_data({media_key: {'id': 0}})
-                finally:
-                    lock.release()
             else:
                 self.meta.update_meta_data({media_key: {'id': 0}})
+        return not search_error[0]
+
+    # 只有名称信息，判别是电影还是电视剧并TMDB信息
+    def get_media_info(self, title, subtitle=None):
+        if not title:
+            return None
+        if not self.meta:
+            return None
+        anime = is_anime(title)
+        meta_info, media_key = self.__get_meta_info(title, subtitle, anime)
+        self.__search_media_key(meta_info, media_key, anime)
         # 赋值返回
         meta_info.set_tmdb_info(self.meta.get_meta_data().get(media_key))
         return meta_info
 
+    # 批量识别名称，先全部解析并按缓存KEY去重，不同KEY并行检索TMDB，再把结果分发回每个名称
+    # 返回与titles一一对应的媒体信息列表，subtitles为对应的副标题列表，识别出错的名称对应None，未识别到的没有tmdb_info
+    def get_media_infos(self, titles, subtitles=None):
+        if not titles:
+            return []
+        if not self.meta:
+            return [None] * len(titles)
+        if not subtitles:
+            subtitles = [None] * len(titles)
+        meta_infos = [None] * len(titles)
+        # KEY对应的解析信息及在titles中的位置
+        media_keys = {}
+        for i, title in enumerate(titles):
+            if not title:
+                continue
+            anime = is_anime(title)
+            meta_info, media_key = self.__get_meta_info(title, subtitles[i], anime)
+            meta_infos[i] = meta_info
+            if media_key not in media_keys:
+                media_keys[media_key] = (meta_info, anime, [])
+            media_keys[media_key][2].append(i)
+
+        def search_and_set(key, key_meta_info, key_anime, indexes):
+            try:
+                if not self.__search_media_key(key_meta_info, key, key_anime):
+                    raise Exception("%s 连接TMDB出错" % key_meta_info.get_name())
+                tmdb_info = self.meta.get_meta_data().get(key)
+                for index in indexes:
+                    meta_infos[index].set_tmdb_info(tmdb_info)
+            except Exception:
+                for index in indexes:
+                    meta_infos[index] = None
+                raise
+
+        if media_keys:
+            log.debug("【META】批量识别：%s 个名称，%s 个媒体" % (len(titles), len(media_keys)))
+            with ThreadPoolExecutor(max_workers=min(TMDB_QUERY_THREADS, len(media_keys))) as executor:
+                all_task = [executor.submit(search_and_set, media_key, info[0], info[1], info[2])
+                            for media_key, info in media_keys.items()]
+                for future in as_completed(all_task):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        log.error("【META】批量识别出错：%s" % str(e))
+        return meta_infos
+
     # 搜刮媒体信息和类型，返回每个文件对应的媒体信息
     '''
     输入：file_list：文件路径清单, 可能是一个目录，也可能是一个文件清单
-    输出：类型，文件路径：媒体信息的List
+    输出：类型，文件路径：媒体信息的List，连接TMDB出错的文件对应None
     '''
 
     def get_media_info_on_files(self, file_list, tmdb_info=None, media_type=None):
@@ -233,22 +339,23 @@ class Media:
                         if parent_info.type != MediaType.MOVIE:
                             meta_info.type = parent_info.type
                     media_key = "%s%s" % (meta_info.get_name(), meta_info.year)
-                    try:
-                        lock.acquire()
+                    with self.__media_key_lock(media_key):
                         if not self.meta.get_meta_data().get(media_key):
                             # 调用TMDB API
                             file_media_info = self.__search_tmdb(meta_info.get_name(), meta_info.year, meta_info.type)
-                            if not file_media_info:
+                            if file_media_info is None:
                                 if self.__rmt_match_mode == MatchMode.NORMAL:
                                     # 去掉年份再查一次，有可能是年份错误
                                     file_media_info = self.__search_tmdb(meta_info.get_name(), None, meta_info.type)
                             if file_media_info:
                                 self.meta.update_meta_data({media_key: file_media_info})
+                            elif file_media_info is False:
+                                # 连接TMDB出错，不标记为未找到，下次重新检索
+                                return_media_infos[file_path] = None
+                                continue
                             else:
                                 # 标记为未找到避免再次查询
                                 self.meta.update_meta_data({media_key: {'id': 0}})
-                    finally:
-                        lock.release()
                 else:
                     # 动漫识别
                     meta_info = MetaInfo(file_name, anime=True)
@@ -267,16 +374,17 @@ class Media:
                     media_key = "[ANIME]%s%s" % (meta_info.get_name(), meta_info.year)
                     # 动漫识别到了
                     if meta_info.type != MediaType.UNKNOWN:
-                        try:
-                            lock.acquire()
+                        with self.__media_key_lock(media_key):
                             if not self.meta.get_meta_data().get(media_key):
                                 file_media_info = self.__search_tmdb(meta_info.get_name(), meta_info.year, meta_info.type)
                                 if file_media_info:
                                     self.meta.update_meta_data({media_key: file_media_info})
+                                elif file_media_info is False:
+                                    # 连接TMDB出错，不标记为未找到，下次重新检索
+                                    return_media_infos[file_path] = None
+                                    continue
                                 else:
                                     self.meta.update_meta_data({media_key: {'id': 0}})
-                        finally:
-                            lock.release()
                     else:
                         self.meta.update_meta_data({media_key: {'id': 0}})
                 # 存入结果清单返回
@@ -1,108 +1,153 @@
 import os.path
 import re
+from functools import lru_cache
 import anitopy
 import cn2an
-import requests
 from requests import RequestException
-from config import FANART_TV_API_URL, FANART_MOVIE_API_URL, RMT_MEDIAEXT
+from config import FANART_TV_API_URL, FANART_MOVIE_API_URL, RMT_MEDIAEXT, METAINFO_PARSE_CACHE_SIZE
 from rmt.category import Category
 from utils.functions import is_chinese
+from utils.http_utils import RequestUtils
 from utils.tokens import Tokens
 from utils.types import MediaType
 
 
 class MetaInfo(object):
-    category_handler = None
-    # 原字符串
-    org_string = None
-    # 类型 电影、电视剧
-    type = None
-    # 识别的中文名
-    cn_name = None
-    # 识别的英文名
-    en_name = None
-    # 总季数
-    total_seasons = 0
-    # 识别的开始季 数字
-    begin_season = 0
-    # 识别的结束季 数字
-    end_season = 0
-    # 总集数
-    total_episodes = 0
-    # 识别的开始集
-    begin_episode = None
-    # 识别的结束集
-    end_episode = None
-    # Partx Cd Dvd Disk Disc
-    part = None
-    # 识别的资源类型
-    resource_type = None
-    # 识别的分辨率
-    resource_pix = None
-    # 二级分类
-    category = None
-    # TMDB ID
-    tmdb_id = 0
-    # 媒体标题
-    title = None
-    # 媒体年份
-    year = None
-    # 封面图片
-    backdrop_path = None
-    poster_path = None
-    # 评分
-    vote_average = 0
-    # TMDB 的其它信息
-    tmdb_info = {}
-    # 种子附加信息
-    site = None
-    site_order = 0
-    enclosure = None
-    res_order = 0
-    size = 0
-    seeders = 0
-    peers = 0
-    description = None
-    res_type = None
-    # 控制标位区
-    _stop_name_flag = False
-    _last_token = ""
-    _last_token_type = ""
-    _continue_flag = True
-    _unknown_name_str = ""
-    # 正则式区
-    _season_re = r"S(\d{2})"
-    _episode_re = r"EP?(\d{2})"
-    _part_re = r"(^PART[\s.]*[1-9]?|^CD[\s.]*[1-9]?|^DVD[\s.]*[1-9]?|^DISK[\s.]*[1-9]?|^DISC[\s.]*[1-9]?)"
-    _resources_type_re = r"^BLURAY|^REMUX|^HDTV|^HDDVD|^WEBRIP|^DVDRIP|^BDRIP|^UHD|^SDR|^HDR|^DOLBY|^BLU|^WEB|^BD"
-    _name_no_begin_re = r"^\[.+?]"
+    # 字段及默认值，实例使用__slots__存储，不再有__dict__
+    _fields = {
+        'category_handler': None,
+        # 原字符串
+        'org_string': None,
+        # 类型 电影、电视剧
+        'type': None,
+        # 识别的中文名
+        'cn_name': None,
+        # 识别的英文名
+        'en_name': None,
+        # 总季数
+        'total_seasons': 0,
+        # 识别的开始季 数字
+        'begin_season': 0,
+        # 识别的结束季 数字
+        'end_season': 0,
+        # 总集数
+        'total_episodes': 0,
+        # 识别的开始集
+        'begin_episode': None,
+        # 识别的结束集
+        'end_episode': None,
+        # Partx Cd Dvd Disk Disc
+        'part': None,
+        # 识别的资源类型
+        'resource_type': None,
+        # 识别的分辨率
+        'resource_pix': None,
+        # 二级分类
+        'category': None,
+        # TMDB ID
+        'tmdb_id': 0,
+        # 媒体标题
+        'title': None,
+        # 媒体年份
+        'year': None,
+        # 封面图片
+        'backdrop_path': None,
+        'poster_path': None,
+        # 评分
+        'vote_average': 0,
+        # TMDB 的其它信息，引用元数据缓存中的同一个对象
+        'tmdb_info': {},
+        # 种子附加信息
+        'site': None,
+        'site_order': 0,
+        'enclosure': None,
+        'res_order': 0,
+        'size': 0,
+        'seeders': 0,
+        'peers': 0,
+        'description': None,
+        'res_type': None,
+        # 控制标位区
+        '_stop_name_flag': False,
+        '_last_token': "",
+        '_last_token_type': "",
+        '_continue_flag': True,
+        '_unknown_name_str': "",
+    }
+    __slots__ = tuple(_fields)
+    # 正则式区，类加载时编译
+    _season_re = re.compile(r"S(\d{2})", re.IGNORECASE)
+    _episode_re = re.compile(r"EP?(\d{2})", re.IGNORECASE)
+    _part_re = re.compile(r"(^PART[\s.]*[1-9]?|^CD[\s.]*[1-9]?|^DVD[\s.]*[1-9]?|^DISK[\s.]*[1-9]?|^DISC[\s.]*[1-9]?)",
+                          re.IGNORECASE)
+    _resources_type_re = re.compile(r"(^BLURAY|^REMUX|^HDTV|^HDDVD|^WEBRIP|^DVDRIP|^BDRIP|^UHD|^SDR|^HDR|^DOLBY|^BLU"
+                                    r"|^WEB|^BD)", re.IGNORECASE)
+    _name_no_begin_re = re.compile(r"^\[.+?]")
     _name_se_words = ['共', '第', '季', '集', '话', '話']
-    _name_nostring_re = r"^JADE|^AOD|^[A-Z]{2,4}TV[\-0-9UVHDK]*|HBO|\d{1,2}th|NETFLIX|IMAX|^CHC" \
-                        r"|[第\s共]+[0-9一二三四五六七八九十\-\s]+季" \
-                        r"|[第\s共]+[0-9一二三四五六七八九十\-\s]+[集话話]" \
-                        r"|S\d{2}\s*-\s*S\d{2}|S\d{2}|EP?\d{2}\s*-\s*EP?\d{2}|EP?\d{2}" \
-                        r"|BLU-?RAY|REMUX|HDTV|HDDVD|WEBRIP|DVDRIP|UHD|WEB|SDR|HDR|DOLBY|TRUEHD|BDRIP|BD" \
-                        r"|[HX]264|[HX]265|AVC|AAC|DTS\d.\d|HEVC|\d{3,4}[PI]" \
-                        r"|TV|Series|Movie|Animations|XXX" \
-                        r"|大陆|连载|西德|日剧|美剧|电视剧|电影|动画片|动漫|法国|英国|美国|德国|印度|泰国|台湾|香港|中国|韩国|日本|欧美|日韩|超高清|高清|蓝光|翡翠台" \
-                        r"|最终季|合集|[中国英葡法俄日韩德意西印泰台港粤双文语简繁体特效内封官译外挂]+字幕" \
-                        r"|未删减版|UNCUT|UNRATE|WITH EXTRAS|RERIP|SUBBED|PROPER|REPACK" \
-                        r"|PART[\s.]*[1-9]|CD[\s.]*[1-9]|DVD[\s.]*[1-9]|DISK[\s.]*[1-9]|DISC[\s.]*[1-9]" \
-                        r"|[248]K|\d{3,4}[PIX]+"
-    _resources_pix_re = r"^[SBUHD]*(\d{3,4}[PIX]+)"
-    _resources_pix_re2 = r"(^[248]+K)"
-    _subtitle_season_re = r"[第\s]+([0-9一二三四五六七八九十\-]+)\s*季"
-    _subtitle_episode_re = r"[第\s]+([0-9一二三四五六七八九十\-]+)\s*集"
+    _name_nostring_re = re.compile(r"^JADE|^AOD|^[A-Z]{2,4}TV[\-0-9UVHDK]*|HBO|\d{1,2}th|NETFLIX|IMAX|^CHC"
+                                   r"|[第\s共]+[0-9一二三四五六七八九十\-\s]+季"
+                                   r"|[第\s共]+[0-9一二三四五六七八九十\-\s]+[集话話]"
+                                   r"|S\d{2}\s*-\s*S\d{2}|S\d{2}|EP?\d{2}\s*-\s*EP?\d{2}|EP?\d{2}"
+                                   r"|BLU-?RAY|REMUX|HDTV|HDDVD|WEBRIP|DVDRIP|UHD|WEB|SDR|HDR|DOLBY|TRUEHD|BDRIP|BD"
+                                   r"|[HX]264|[HX]265|AVC|AAC|DTS\d.\d|HEVC|\d{3,4}[PI]"
+                                   r"|TV|Series|Movie|Animations|XXX"
+                                   r"|大陆|连载|西德|日剧|美剧|电视剧|电影|动画片|动漫|法国|英国|美国|德国|印度|泰国|台湾|香港|中国|韩国|日本|欧美|日韩|超高清|高清|蓝光|翡翠台"
+                                   r"|最终季|合集|[中国英葡法俄日韩德意西印泰台港粤双文语简繁体特效内封官译外挂]+字幕"
+                                   r"|未删减版|UNCUT|UNRATE|WITH EXTRAS|RERIP|SUBBED|PROPER|REPACK"
+                                   r"|PART[\s.]*[1-9]|CD[\s.]*[1-9]|DVD[\s.]*[1-9]|DISK[\s.]*[1-9]|DISC[\s.]*[1-9]"
+                                   r"|[248]K|\d{3,4}[PIX]+", re.IGNORECASE)
+    _resources_pix_re = re.compile(r"^[SBUHD]*(\d{3,4}[PIX]+)", re.IGNORECASE)
+    _resources_pix_re2 = re.compile(r"(^[248]+K)", re.IGNORECASE)
+    _subtitle_season_re = re.compile(r"[第\s]+([0-9一二三四五六七八九十\-]+)\s*季", re.IGNORECASE)
+    _subtitle_episode_re = re.compile(r"[第\s]+([0-9一二三四五六七八九十\-]+)\s*集", re.IGNORECASE)
+    _subtitle_se_re = re.compile(r"[第季集]")
+    _blank_re = re.compile(r"\s+")
+    # Part、分辨率、季、集、资源类型的合并正则，只用于预先过滤：不匹配且不是数字的token不用再逐项识别
+    # 匹配上的token仍按原顺序逐项识别，一个token可能同时属于多类（如S01E02），不能按匹配到的分组直接确定类型
+    _meta_token_re = re.compile(r"|".join([_part_re.pattern,
+                                           _resources_pix_re.pattern,
+                                           _resources_pix_re2.pattern,
+                                           _season_re.pattern,
+                                           _episode_re.pattern,
+                                           _resources_type_re.pattern]), re.IGNORECASE)
+    _meta_token_words = ['DL', 'RAY']
     _anime_no_words = ['CHS&CHT']
 
     def __init__(self, title, subtitle=None, anime=False):
         if not title:
+            for name, value in self._fields.items():
+                setattr(self, name, value)
             return
+        # 相同名称的解析结果直接复制
+        for name, value in zip(self._fields, self.__get_parse_result(title, subtitle, anime)):
+            setattr(self, name, value)
         self.category_handler = Category()
+
+    # 解析名称，按(名称, 副标题, 是否动漫)缓存解析出的字段值
+    @staticmethod
+    @lru_cache(maxsize=METAINFO_PARSE_CACHE_SIZE)
+    def __get_parse_result(title, subtitle, anime):
+        meta_info = MetaInfo(None)
+        meta_info.__init_meta_info(title, subtitle, anime)
+        return tuple(getattr(meta_info, name) for name in MetaInfo._fields)
+
+    # 名称解析缓存的命中、未命中次数及当前条数
+    @staticmethod
+    def get_parse_cache_info():
+        cache_info = MetaInfo.__get_parse_result.cache_info()
+        return {"hits": cache_info.hits, "misses": cache_info.misses, "size": cache_info.currsize,
+                "max_size": cache_info.maxsize}
+
+    # 清空名称解析缓存
+    @staticmethod
+    def clear_parse_cache():
+        MetaInfo.__get_parse_result.cache_clear()
+
+    def __init_meta_info(self, title, subtitle=None, anime=False):
         self.org_string = title
         if not anime:
             # 去掉名称中第1个[]的内容
-            title = re.sub(r'%s' % self._name_no_begin_re, "", title, count=1)
+            title = self._name_no_begin_re.sub("", title, count=1)
             # 拆分tokens
             tokens = Tokens(title)
             # 解析名称、年份、季、集、资源类型、分辨率等
@@ -110,6 +155,9 @@ class MetaInfo(object):
             while token:
                 # 标题
                 self.__init_name(token)
+                # 不可能是Part、年份、分辨率、季、集、资源类型的跳过
+                if self._continue_flag and not self.__is_meta_token(token):
+                    self._continue_flag = False
                 # Part
                 if self._continue_flag:
                     self.__init_part(token)
@@ -141,13 +189,11 @@ class MetaInfo(object):
                 self.type = MediaType.MOVIE
             # 去掉名字中不需要的干扰字符
             if self.cn_name:
-                self.cn_name = re.sub(r'%s' % self._name_nostring_re, '', self.cn_name,
-                                      flags=re.IGNORECASE).strip()
-                self.cn_name = re.sub(r'\s+', ' ', self.cn_name)
+                self.cn_name = self._name_nostring_re.sub('', self.cn_name).strip()
+                self.cn_name = self._blank_re.sub(' ', self.cn_name)
             if self.en_name:
-                self.en_name = re.sub(r'%s' % self._name_nostring_re, '', self.en_name,
-                                      flags=re.IGNORECASE).strip()
-                self.en_name = re.sub(r'\s+', ' ', self.en_name)
+                self.en_name = self._name_nostring_re.sub('', self.en_name).strip()
+                self.en_name = self._blank_re.sub(' ', self.en_name)
         else:
             # 调用第三方模块识别动漫
             try:
@@ -281,10 +327,18 @@ class MetaInfo(object):
                     self.en_name = token
                 self._last_token_type = "enname"
 
+    # 是否可能是Part、年份、分辨率、季、集、资源类型，返回False的一定不是，返回True的还需逐项识别
+    def __is_meta_token(self, token):
+        if token.isdigit():
+            return True
+        if token.upper() in self._meta_token_words:
+            return True
+        return self._meta_token_re.search(token) is not None
+
     def __init_part(self, token):
         if not self.get_name():
             return
-        re_res = re.search(r"%s" % self._part_re, token, re.IGNORECASE)
+        re_res = self._part_re.search(token)
         if re_res:
             # part或者part加数字
             if not self.part:
@@ -315,7 +369,7 @@ class MetaInfo(object):
     def __init_resource_pix(self, token):
         if not self.get_name():
             return
-        re_res = re.search(r"%s" % self._resources_pix_re, token, re.IGNORECASE)
+        re_res = self._resources_pix_re.search(token)
         if re_res:
             if not self.resource_pix:
                 self.resource_pix = re_res.group(1).lower()
@@ -323,7 +377,7 @@ class MetaInfo(object):
                 self._continue_flag = False
                 self._stop_name_flag = True
         else:
-            re_res = re.search(r"%s" % self._resources_pix_re2, token, re.IGNORECASE)
+            re_res = self._resources_pix_re2.search(token)
             if re_res:
                 if not self.resource_pix:
                     self.resource_pix = re_res.group(1).lower()
@@ -334,7 +388,7 @@ class MetaInfo(object):
     def __init_seasion(self, token):
         if not self.get_name():
             return
-        re_res = re.findall(r"%s" % self._season_re, token, re.IGNORECASE)
+        re_res = self._season_re.findall(token)
         if re_res:
             for se in re_res:
                 if not se:
@@ -365,7 +419,7 @@ class MetaInfo(object):
     def __init_episode(self, token):
         if not self.get_name():
             return
-        re_res = re.findall(r"%s" % self._episode_re, token, re.IGNORECASE)
+        re_res = self._episode_re.findall(token)
         if re_res:
             for se in re_res:
                 if not se:
@@ -398,7 +452,7 @@ class MetaInfo(object):
     def __init_resource_type(self, token):
         if not self.get_name():
             return
-        re_res = re.search(r"(%s)" % self._resources_type_re, token, re.IGNORECASE)
+        re_res = self._resources_type_re.search(token)
         if re_res:
             if not self.resource_type:
                 self.resource_type = re_res.group(1).upper()
@@ -417,9 +471,9 @@ class MetaInfo(object):
                 self._continue_flag = False
 
     def __init_subtitle(self, title_text):
-        if re.search(r'[第季集]', title_text, re.IGNORECASE):
+        if self._subtitle_se_re.search(title_text):
             # 季
-            season_str = re.search(r'%s' % self._subtitle_season_re, title_text, re.IGNORECASE)
+            season_str = self._subtitle_season_re.search(title_text)
             if season_str:
                 seasons = season_str.group(1)
                 if seasons:
@@ -440,7 +494,7 @@ class MetaInfo(object):
                     self.end_season = end_season
                 self.type = MediaType.TV
             # 集
-            episode_str = re.search(r'%s' % self._subtitle_episode_re, title_text, re.IGNORECASE)
+            episode_str = self._subtitle_episode_re.search(title_text)
             if episode_str:
                 episodes = episode_str.group(1)
                 if episodes:
@@ -638,7 +692,7 @@ class MetaInfo(object):
             else:
                 image_url = FANART_TV_API_URL % tmdbid
             try:
-                ret = requests.get(image_url, timeout=10)
+                ret = RequestUtils().request("get", image_url)
                 if ret:
                     moviethumbs = ret.json().get('moviethumb')
                     if moviethumbs:
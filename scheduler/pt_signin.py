@@ -1,9 +1,9 @@
 from threading import Lock
 
-import requests
 import log
 from config import Config
 from utils.functions import cookieParse, generateHeader, singleton
+from utils.http_utils import RequestUtils
 from message.send import Message
 
 lock = Lock()
@@ -39,10 +39,7 @@ class PTSignin:
             cookie_obj = cookieParse(cookie)
             header = generateHeader(url)
             # 设置请求头 、 cookie
-            session = requests.session()
-            session.headers.update(header)
-            session.cookies.update(cookie_obj)
-            res = session.get(url)
+            res = RequestUtils().request("get", url, headers=header, cookies=cookie_obj)
             if res:
                 return "%s 签到成功" % name
         except Exception as err:
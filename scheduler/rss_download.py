@@ -3,7 +3,6 @@ import log
 from pt.rss import Rss
 from utils.functions import singleton
 
-RSS_CACHED_TORRENTS = []
 lock = Lock()
 
 
@@ -1,8 +1,7 @@
 from apscheduler.schedulers.blocking import BlockingScheduler
 import log
 from config import AUTO_REMOVE_TORRENTS_INTERVAL, PT_TRANSFER_INTERVAL, Config, METAINFO_SAVE_INTERVAL, \
-    RELOAD_CONFIG_INTERVAL, SYNC_TRANSFER_INTERVAL
-from monitor.media_sync import Sync
+    RELOAD_CONFIG_INTERVAL
 from scheduler.autoremove_torrents import AutoRemoveTorrents
 from scheduler.douban_sync import DoubanSync
 from scheduler.pt_signin import PTSignin
@@ -62,9 +61,6 @@ def run_scheduler():
         # 元数据定时保存
         SCHEDULER.add_job(MetaHelper().save_meta_data, 'interval', seconds=METAINFO_SAVE_INTERVAL)
 
-        # 定时把队列中的监控文件转移走
-        SCHEDULER.add_job(Sync().transfer_mon_files, 'interval', seconds=SYNC_TRANSFER_INTERVAL)
-
         SCHEDULER.start()
 
     except Exception as err:
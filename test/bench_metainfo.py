@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rmt.metainfo import MetaInfo
+from utils.functions import is_anime
+
+# 解析名称的总数，不够时循环使用测试文件中的名称
+BENCH_TITLE_NUM = 100000
+
+
+# 读取测试用的种子名称和文件名称
+def load_titles():
+    titles = []
+    test_path = os.path.dirname(os.path.abspath(__file__))
+    for file_name in ['torrentnames.txt', 'filenames.txt']:
+        with open(os.path.join(test_path, file_name), 'r', encoding='utf-8') as f:
+            for line in f.readlines():
+                line = line.strip()
+                if line:
+                    titles.append(line)
+    return titles
+
+
+# 逐个解析名称，返回耗时秒数，cold为True时每次解析前清空缓存，测的是实际解析的速度
+def run_bench(bench_titles, cold):
+    MetaInfo.clear_parse_cache()
+    if not cold:
+        # 先解析一遍，之后都命中缓存
+        for title, anime in bench_titles:
+            MetaInfo(title, anime=anime)
+    begin_time = time.perf_counter()
+    for title, anime in bench_titles:
+        if cold:
+            MetaInfo.clear_parse_cache()
+        MetaInfo(title, anime=anime)
+    return time.perf_counter() - begin_time
+
+
+if __name__ == "__main__":
+    names = load_titles()
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else BENCH_TITLE_NUM
+    bench_titles = [(name, is_anime(name)) for name in (names * (num // len(names) + 1))[:num]]
+    for cold_flag, bench_name in [(True, "无缓存"), (False, "命中缓存")]:
+        used_time = run_bench(bench_titles, cold_flag)
+        print("%s：解析 %s 个名称，耗时 %.2f 秒，%.0f 个/秒" % (bench_name, num, used_time, num / used_time))
@@ -0,0 +1,84 @@
+import asyncio
+import atexit
+from threading import Lock, Thread
+
+import log
+from config import ASYNC_ENGINE_ENABLE, ASYNC_HTTP_LIMIT, ASYNC_HTTP_LIMIT_PER_HOST, HTTP_TIMEOUT, HTTP_RETRY_TIMES, \
+    HTTP_RETRY_BACKOFF
+from utils.functions import singleton
+
+# aiohttp为可选依赖，未安装时不启用异步引擎，调用方使用原有的多线程方式
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+lock = Lock()
+
+
+@singleton
+class AsyncEngine:
+    __loop = None
+    __thread = None
+    __session = None
+
+    # 是否启用异步引擎
+    @staticmethod
+    def is_enabled():
+        return ASYNC_ENGINE_ENABLE and aiohttp is not None
+
+    # 在独立线程中运行事件循环，首次使用时启动
+    def __get_loop(self):
+        with lock:
+            if not self.__loop:
+                self.__loop = asyncio.new_event_loop()
+                self.__thread = Thread(target=self.__loop.run_forever, name="AsyncEngine", daemon=True)
+                self.__thread.start()
+                atexit.register(self.__close)
+        return self.__loop
+
+    # 退出时关闭HTTP会话
+    def __close(self):
+        if self.__session and not self.__session.closed:
+            self.run(self.__session.close(), timeout=5)
+
+    # 同步调用入口，供Flask路由及定时任务使用，在事件循环线程中执行协程并等待结果
+    def run(self, coro, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self.__get_loop())
+        return future.result(timeout)
+
+    # 事件循环中共享的HTTP会话，只在事件循环线程中访问
+    def __get_session(self):
+        if not self.__session or self.__session.closed:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_LIMIT, limit_per_host=ASYNC_HTTP_LIMIT_PER_HOST),
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+        return self.__session
+
+    # 异步下载，失败时按指数退避重试，返回内容，出错返回None
+    async def fetch(self, url, headers=None, timeout=None):
+        kwargs = {'headers': headers}
+        if timeout:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        for i in range(HTTP_RETRY_TIMES + 1):
+            try:
+                async with self.__get_session().get(url, **kwargs) as res:
+                    if res.status not in (429, 500, 502, 503, 504):
+                        if res.status >= 400:
+                            log.error("【ASYNC】%s 返回错误码：%s" % (url, res.status))
+                            return None
+                        return await res.read()
+                    if i >= HTTP_RETRY_TIMES:
+                        log.error("【ASYNC】%s 返回错误码：%s" % (url, res.status))
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if i >= HTTP_RETRY_TIMES:
+                    log.error("【ASYNC】%s 请求出错：%s" % (url, str(e) or type(e).__name__))
+                    return None
+            await asyncio.sleep(HTTP_RETRY_BACKOFF * (2 ** i))
+        return None
+
+    # 在事件循环的线程池中执行同步函数，用于识别等阻塞处理
+    @staticmethod
+    async def run_blocking(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
@@ -0,0 +1,256 @@
+import errno
+import hashlib
+import os
+import shutil
+import time
+
+import log
+from config import COPY_CHUNK_SIZE, COPY_PROGRESS_INTERVAL, COPY_TEMP_SUFFIX, COPY_JOURNAL_INTERVAL, \
+    COPY_JOURNAL_EXPIRE_DAYS, COPY_VERIFY, COPY_VERIFY_SAMPLES, COPY_VERIFY_SAMPLE_SIZE
+from utils.functions import str_filesize
+from utils.sqls import get_transfer_journal, update_transfer_journal, delete_transfer_journal, \
+    get_expired_transfer_journals
+from utils.types import RmtMode
+
+# FICLONE只在Linux下可用，其它系统直接使用普通复制
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl FICLONE，btrfs、XFS等文件系统上共享数据块，瞬间完成复制
+FICLONE = 0x40049409
+# 不支持当前复制方式时返回的错误码，遇到后换下一种方式
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY)
+
+
+# 尝试reflink复制，成功返回True
+def reflink_file(fsrc, fdst):
+    if not fcntl:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise
+
+
+# 在内核中复制数据，依次尝试copy_file_range、sendfile，都不支持时用普通读写，从offset处开始复制，返回复制到的位置
+def copy_file_data(fsrc, fdst, size, progress_callback=None, offset=0):
+    copied = offset
+    for copy_func in [_copy_file_range, _sendfile, _read_write]:
+        try:
+            while copied < size:
+                length = copy_func(fsrc, fdst, copied, min(COPY_CHUNK_SIZE, size - copied))
+                if not length:
+                    break
+                copied = copied + length
+                if progress_callback:
+                    progress_callback(copied, size)
+        except OSError as e:
+            if copied > offset or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            continue
+        # 部分FUSE、overlay及网络文件系统一开始就返回0，换下一种方式，已复制过数据后返回0才视为文件结束
+        if copied < size and copied == offset:
+            continue
+        return copied
+    return copied
+
+
+def _copy_file_range(fsrc, fdst, offset, count):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not supported")
+    return os.copy_file_range(fsrc.fileno(), fdst.fileno(), count, offset, offset)
+
+
+def _sendfile(fsrc, fdst, offset, count):
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile not supported")
+    os.lseek(fdst.fileno(), offset, os.SEEK_SET)
+    return os.sendfile(fdst.fileno(), fsrc.fileno(), offset, count)
+
+
+def _read_write(fsrc, fdst, offset, count):
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    data = fsrc.read(count)
+    fdst.write(data)
+    return len(data)
+
+
+# 计算文件前end字节内均匀抽样的若干数据块的摘要，用于快速比较大文件内容是否一致
+def get_sample_hash(file_path, end):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        if end <= COPY_VERIFY_SAMPLES * COPY_VERIFY_SAMPLE_SIZE:
+            offsets = range(0, end, COPY_VERIFY_SAMPLE_SIZE)
+        else:
+            step = (end - COPY_VERIFY_SAMPLE_SIZE) // (COPY_VERIFY_SAMPLES - 1)
+            offsets = [i * step for i in range(COPY_VERIFY_SAMPLES)]
+        for offset in offsets:
+            f.seek(offset)
+            md5.update(f.read(min(COPY_VERIFY_SAMPLE_SIZE, end - offset)))
+    return md5.hexdigest()
+
+
+# 抽样校验两个文件前end字节的内容是否一致
+def verify_file_samples(src, dst, end):
+    return get_sample_hash(src, end) == get_sample_hash(dst, end)
+
+
+# 根据复制进度查询可续传的位置，源文件有变化或临时文件不完整时从头复制
+def get_resume_offset(src, dst, tmp_file, src_stat):
+    journal = get_transfer_journal(dst)
+    if not journal or not os.path.isfile(tmp_file):
+        return 0
+    if journal.get('src') != src \
+            or journal.get('src_size') != src_stat.st_size \
+            or journal.get('src_mtime') != str(src_stat.st_mtime):
+        return 0
+    offset = min(journal.get('copied') or 0, os.path.getsize(tmp_file), src_stat.st_size)
+    if offset and COPY_VERIFY and not verify_file_samples(src, tmp_file, offset):
+        log.warn("【RMT】%s 已复制的部分校验不一致，重新复制" % os.path.basename(dst))
+        return 0
+    return offset
+
+
+# 复制一个文件并保留权限及时间，progress_callback(已复制字节数, 总字节数)，返回本次复制的字节数
+# 先写入临时文件，完成后再改名，中断时保留临时文件及进度，下次从中断处继续复制
+def copy_file(src, dst, progress_callback=None):
+    tmp_file = dst + COPY_TEMP_SUFFIX
+    src_stat = os.stat(src)
+    size = src_stat.st_size
+    src_mtime = str(src_stat.st_mtime)
+    offset = get_resume_offset(src, dst, tmp_file, src_stat)
+    if offset:
+        log.info("【RMT】%s 从 %s 处继续复制" % (os.path.basename(src), str_filesize(offset)))
+    else:
+        delete_transfer_journal(dst)
+    try:
+        with open(src, 'rb') as fsrc, open(tmp_file, 'r+b' if offset else 'wb') as fdst:
+            if offset:
+                fdst.truncate(offset)
+            if not offset and size and reflink_file(fsrc, fdst):
+                copied = size
+                if progress_callback:
+                    progress_callback(copied, size)
+            else:
+                last_time = [time.time()]
+
+                # 定时落盘并保存进度，保证记录的进度之前的数据都已写入磁盘
+                def _journal_callback(_copied, _size):
+                    if progress_callback:
+                        progress_callback(_copied, _size)
+                    now = time.time()
+                    if now - last_time[0] < COPY_JOURNAL_INTERVAL or _copied >= _size:
+                        return
+                    last_time[0] = now
+                    getattr(os, "fdatasync", os.fsync)(fdst.fileno())
+                    update_transfer_journal(dst, src, size, src_mtime, _copied)
+
+                copied = copy_file_data(fsrc, fdst, size, _journal_callback, offset)
+        if copied != size or os.path.getsize(tmp_file) != size:
+            raise OSError(errno.EIO, "复制的文件大小不一致：%s" % tmp_file)
+        if COPY_VERIFY and size and not verify_file_samples(src, tmp_file, size):
+            os.remove(tmp_file)
+            delete_transfer_journal(dst)
+            raise OSError(errno.EIO, "复制的文件校验不一致：%s" % tmp_file)
+        shutil.copystat(src, tmp_file)
+        os.replace(tmp_file, dst)
+        delete_transfer_journal(dst)
+    except Exception:
+        # 已有进度的保留临时文件用于续传，否则直接删除
+        if not get_transfer_journal(dst) and os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return copied - offset
+
+
+# 复制整个目录，返回复制的字节数
+# 先复制到临时目录，完成后再改名，中断后再次复制时跳过临时目录中已完成的文件
+def copy_dir(src, dst, progress_callback=None):
+    tmp_dir = dst + COPY_TEMP_SUFFIX
+    copied = [0]
+
+    def _copy_function(src_file, dst_file):
+        if os.path.isfile(dst_file):
+            src_stat = os.stat(src_file)
+            dst_stat = os.stat(dst_file)
+            if src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+                return dst_file
+        copied[0] = copied[0] + copy_file(src_file, dst_file, progress_callback)
+        return dst_file
+
+    shutil.copytree(src, tmp_dir, copy_function=_copy_function, dirs_exist_ok=True)
+    os.rename(tmp_dir, dst)
+    return copied[0]
+
+
+# 清理超过保留天数未继续的复制临时文件
+def clean_expired_copy_files():
+    for dest in get_expired_transfer_journals(COPY_JOURNAL_EXPIRE_DAYS):
+        tmp_file = dest + COPY_TEMP_SUFFIX
+        try:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+                log.info("【RMT】已清理未完成的复制临时文件：%s" % tmp_file)
+        except OSError as e:
+            log.warn("【RMT】清理复制临时文件出错：%s" % str(e))
+        delete_transfer_journal(dest)
+
+
+# 生成复制进度回调，每隔一段时间输出一次进度及速度
+def get_progress_callback(file_name):
+    start_time = time.time()
+    last_time = [start_time]
+
+    def _progress_callback(copied, size):
+        now = time.time()
+        if now - last_time[0] < COPY_PROGRESS_INTERVAL or copied >= size:
+            return
+        last_time[0] = now
+        log.info("【RMT】正在复制 %s：%.1f%%，速度：%s/s" % (
+            file_name, copied * 100 / size, str_filesize(copied / (now - start_time))))
+
+    return _progress_callback
+
+
+# 按转移方式转移一个文件，返回0表示成功，否则为错误码
+def transfer_file_by_mode(src, dst, rmt_mode):
+    file_name = os.path.basename(src)
+    start_time = time.time()
+    try:
+        if rmt_mode == RmtMode.LINK:
+            os.link(src, dst)
+        elif rmt_mode == RmtMode.SOFTLINK:
+            os.symlink(src, dst)
+        else:
+            copied = copy_file(src, dst, get_progress_callback(file_name))
+            used_time = max(time.time() - start_time, 0.001)
+            msg = "【RMT】%s 复制了 %s，耗时 %.1f 秒，速度：%s/s" % (
+                file_name, str_filesize(copied), used_time, str_filesize(copied / used_time))
+            if copied >= COPY_CHUNK_SIZE:
+                log.info(msg)
+            else:
+                log.debug(msg)
+    except OSError as e:
+        log.error("【RMT】%s %s出错：%s" % (file_name, rmt_mode.value, str(e)))
+        return e.errno or -1
+    return 0
+
+
+# 复制目录，返回0表示成功，否则为错误码
+def transfer_dir_by_copy(src, dst):
+    start_time = time.time()
+    try:
+        copied = copy_dir(src, dst, get_progress_callback(os.path.basename(src)))
+    except (OSError, shutil.Error) as e:
+        log.error("【RMT】%s 复制出错：%s" % (src, str(e)))
+        return getattr(e, "errno", None) or -1
+    used_time = max(time.time() - start_time, 0.001)
+    log.info("【RMT】%s 复制了 %s，耗时 %.1f 秒，速度：%s/s" % (
+        os.path.basename(src), str_filesize(copied), used_time, str_filesize(copied / used_time)))
+    return 0
@@ -1,9 +1,11 @@
 import os
+import queue
 import sqlite3
 import threading
+from contextlib import contextmanager
 
 import log
-from config import Config
+from config import Config, DB_BUSY_TIMEOUT, DB_CACHE_SIZE, DB_MMAP_SIZE, DB_CACHED_STATEMENTS, DB_POOL_SIZE
 from utils.functions import singleton
 
 lock = threading.Lock()
@@ -11,10 +13,17 @@ lock = threading.Lock()
 
 @singleton
 class DBHelper:
-    __connection = None
     __db_path = None
+    # 空闲的连接，连接用完后放回，各线程共用，总数不超过DB_POOL_SIZE
+    __pool = None
+    __pool_slots = None
+    # 当前线程正在使用的连接及嵌套层数，同一线程嵌套调用时使用同一个连接
+    __local = None
 
     def __init__(self):
+        self.__pool = queue.LifoQueue()
+        self.__pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+        self.__local = threading.local()
         self.init_config()
 
     def init_config(self):
@@ -24,33 +33,60 @@ class DBHelper:
             print("【ERROR】NASTOOL_CONFIG 环境变量未设置，程序无法工作，正在退出...")
             quit()
         self.__db_path = os.path.join(os.path.dirname(config_path), 'user.db')
-        self.__connection = sqlite3.connect(self.__db_path, check_same_thread=False)
         self.__init_tables()
 
+    # 新建连接
+    # WAL模式下读写互不阻塞，synchronous=NORMAL时提交不再每次落盘，只在检查点时落盘
+    # 自动提交模式，单条语句即一个事务，多条语句需要一起提交时使用transaction
+    def __new_connection(self):
+        connection = sqlite3.connect(self.__db_path,
+                                     timeout=DB_BUSY_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=DB_CACHED_STATEMENTS)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-%s" % int(DB_CACHE_SIZE / 1024))
+        connection.execute("PRAGMA mmap_size=%s" % DB_MMAP_SIZE)
+        return connection
+
+    # 从连接池中借用一个连接，用完后放回，连接都在使用中时等待
+    @contextmanager
+    def __get_connection(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is not None:
+            self.__local.depth += 1
+            try:
+                yield connection
+            finally:
+                self.__local.depth -= 1
+            return
+        if not self.__pool_slots.acquire(timeout=DB_BUSY_TIMEOUT):
+            raise sqlite3.OperationalError("数据库连接池已满")
+        try:
+            try:
+                connection = self.__pool.get_nowait()
+            except queue.Empty:
+                connection = self.__new_connection()
+            self.__local.connection = connection
+            self.__local.depth = 1
+            try:
+                yield connection
+            finally:
+                self.__local.connection = None
+                # 未结束的事务回滚后再放回
+                if connection.in_transaction:
+                    connection.rollback()
+                self.__pool.put(connection)
+        finally:
+            self.__pool_slots.release()
+
+    # 启动时建表，使用的连接完成后放入连接池
     def __init_tables(self):
-        cursor = self.__connection.cursor()
+        connection = self.__new_connection()
+        cursor = connection.cursor()
         try:
-            # Jackett搜索结果表
-            cursor.execute('''CREATE TABLE IF NOT EXISTS JACKETT_TORRENTS
-                   (ID INTEGER PRIMARY KEY AUTOINCREMENT     NOT NULL,
-                   TORRENT_NAME    TEXT,
-                   ENCLOSURE    TEXT,
-                   DESCRIPTION    TEXT,
-                   TYPE TEXT,
-                   TITLE    TEXT,
-                   YEAR    TEXT,
-                   SEASON    TEXT,
-                   EPISODE    TEXT,
-                   ES_STRING    TEXT,
-                   VOTE    TEXT,
-                   IMAGE    TEXT,
-                   RES_TYPE    TEXT,
-                   RES_ORDER    TEXT,
-                   SIZE    INTEGER,
-                   SEEDERS    INTEGER,
-                   PEERS    INTEGER,                   
-                   SITE    TEXT,
-                   SITE_ORDER    TEXT);''')
             # RSS下载记录表
             cursor.execute('''CREATE TABLE IF NOT EXISTS RSS_TORRENTS
                                    (ID INTEGER PRIMARY KEY AUTOINCREMENT     NOT NULL,
@@ -63,6 +99,20 @@ class DBHelper:
                                    EPISODE    TEXT);''')
             cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_RSS_TORRENTS_NAME ON RSS_TORRENTS (TITLE, YEAR, SEASON, EPISODE);''')
             cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_RSS_TORRENTS_URL ON RSS_TORRENTS (ENCLOSURE);''')
+            # RSS已处理过的种子链接表，按链接的摘要去重，定期清理
+            cursor.execute('''CREATE TABLE IF NOT EXISTS RSS_SEEN_TORRENTS
+                                   (URL_HASH    TEXT PRIMARY KEY     NOT NULL,
+                                   DATE    TEXT);''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_RSS_SEEN_TORRENTS_DATE ON RSS_SEEN_TORRENTS (DATE);''')
+            # RSS订阅地址的更新状态表
+            cursor.execute('''CREATE TABLE IF NOT EXISTS RSS_FEEDS
+                                   (URL    TEXT PRIMARY KEY     NOT NULL,
+                                   SITE    TEXT,
+                                   ETAG    TEXT,
+                                   LAST_MODIFIED    TEXT,
+                                   CONTENT_HASH    TEXT,
+                                   LAST_GUID    TEXT,
+                                   UPDATE_TIME    TEXT);''')
             # 电影关键字表
             cursor.execute('''CREATE TABLE IF NOT EXISTS RSS_MOVIEKEYS
                                    (ID INTEGER PRIMARY KEY AUTOINCREMENT     NOT NULL,
@@ -98,6 +148,7 @@ class DBHelper:
             cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_TRANSFER_HISTORY_PATH ON TRANSFER_HISTORY (FILE_PATH);''')
             cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_TRANSFER_HISTORY_NAME ON TRANSFER_HISTORY (FILE_NAME);''')
             cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_TRANSFER_HISTORY_TITLE ON TRANSFER_HISTORY (TITLE);''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_TRANSFER_HISTORY_DATE ON TRANSFER_HISTORY (DATE, ID);''')
             # 无法识别的文件列表
             cursor.execute('''CREATE TABLE IF NOT EXISTS TRANSFER_UNKNOWN
                                                (ID INTEGER PRIMARY KEY AUTOINCREMENT     NOT NULL,
@@ -111,45 +162,130 @@ class DBHelper:
                                                            (ID INTEGER PRIMARY KEY AUTOINCREMENT     NOT NULL,
                                                            PATH    TEXT);''')
             cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_TRANSFER_BLACKLIST ON TRANSFER_BLACKLIST (PATH);''')
-            self.__connection.commit()
+            # 复制中的文件进度，用于中断后断点续传
+            cursor.execute('''CREATE TABLE IF NOT EXISTS TRANSFER_JOURNAL
+                                                           (DEST    TEXT PRIMARY KEY     NOT NULL,
+                                                           SRC    TEXT,
+                                                           SRC_SIZE    INTEGER,
+                                                           SRC_MTIME    TEXT,
+                                                           COPIED    INTEGER,
+                                                           UPDATE_TIME    TEXT);''')
+            # 检索结果会话，内存中放不下或程序重启后从这里读取
+            cursor.execute('''CREATE TABLE IF NOT EXISTS SEARCH_SESSIONS
+                                                           (SEARCH_ID    TEXT PRIMARY KEY     NOT NULL,
+                                                           OWNER    TEXT,
+                                                           KEYWORD    TEXT,
+                                                           RESULTS    TEXT,
+                                                           UPDATE_TIME    REAL);''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS INDX_SEARCH_SESSIONS_TIME ON SEARCH_SESSIONS (UPDATE_TIME);''')
 
         except Exception as e:
             log.error("【DB】创建数据库错误：%s" % str(e))
         finally:
             cursor.close()
+        self.__init_history_fts(connection)
+        self.__pool.put(connection)
 
-    def excute(self, sql):
+    # 识别转移历史的全文索引，按文件名及标题三字切分，支持任意位置的模糊查询，通过触发器与历史记录表保持同步
+    # SQLite未编译FTS5或版本过低不支持trigram时不建立，查询时使用LIKE
+    def __init_history_fts(self, connection):
+        cursor = connection.cursor()
+        try:
+            exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'TRANSFER_HISTORY_FTS'").fetchall()
+            cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS TRANSFER_HISTORY_FTS USING fts5
+                                   (FILE_NAME, TITLE, content='TRANSFER_HISTORY', content_rowid='ID', tokenize='trigram');''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS TRANSFER_HISTORY_AI AFTER INSERT ON TRANSFER_HISTORY BEGIN
+                                   INSERT INTO TRANSFER_HISTORY_FTS(rowid, FILE_NAME, TITLE) VALUES (new.ID, new.FILE_NAME, new.TITLE);
+                                   END;''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS TRANSFER_HISTORY_AD AFTER DELETE ON TRANSFER_HISTORY BEGIN
+                                   INSERT INTO TRANSFER_HISTORY_FTS(TRANSFER_HISTORY_FTS, rowid, FILE_NAME, TITLE) VALUES ('delete', old.ID, old.FILE_NAME, old.TITLE);
+                                   END;''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS TRANSFER_HISTORY_AU AFTER UPDATE ON TRANSFER_HISTORY BEGIN
+                                   INSERT INTO TRANSFER_HISTORY_FTS(TRANSFER_HISTORY_FTS, rowid, FILE_NAME, TITLE) VALUES ('delete', old.ID, old.FILE_NAME, old.TITLE);
+                                   INSERT INTO TRANSFER_HISTORY_FTS(rowid, FILE_NAME, TITLE) VALUES (new.ID, new.FILE_NAME, new.TITLE);
+                                   END;''')
+            # 新建索引时导入已有的历史记录
+            if not exists:
+                cursor.execute("INSERT INTO TRANSFER_HISTORY_FTS(TRANSFER_HISTORY_FTS) VALUES ('rebuild')")
+        except Exception as e:
+            log.warn("【DB】不支持全文索引，历史记录查询将使用模糊匹配：%s" % str(e))
+        finally:
+            cursor.close()
+
+    # 判断表是否存在
+    def is_table_exists(self, table_name):
+        return len(self.select("SELECT 1 FROM sqlite_master WHERE name = ?", (table_name,))) > 0
+
+    def excute(self, sql, params=()):
         if not sql:
             return False
-        cursor = self.__connection.cursor()
         try:
-            cursor.execute(sql)
-            self.__connection.commit()
+            with self.__get_connection() as connection:
+                connection.execute(sql, params).close()
+        except Exception as e:
+            log.error("【DB】执行SQL出错：%s，%s" % (sql, str(e)))
+            return False
+        return True
+
+    def excute_many(self, sql, params_list):
+        """
+        同一条语句批量执行多组参数，在一个事务中提交
+        """
+        if not sql or not params_list:
+            return False
+        try:
+            with self.transaction() as cursor:
+                cursor.executemany(sql, params_list)
         except Exception as e:
             log.error("【DB】执行SQL出错：%s，%s" % (sql, str(e)))
             return False
-        finally:
-            cursor.close()
         return True
 
-    def select(self, sql):
+    def select(self, sql, params=()):
         if not sql:
             return False
-        cursor = self.__connection.cursor()
         try:
-            res = cursor.execute(sql)
-            ret = res.fetchall()
+            with self.__get_connection() as connection:
+                cursor = connection.execute(sql, params)
+                try:
+                    return cursor.fetchall()
+                finally:
+                    cursor.close()
         except Exception as e:
             log.error("【DB】执行SQL出错：%s，%s" % (sql, str(e)))
             return []
-        finally:
-            cursor.close()
-        return ret
+
+    @contextmanager
+    def transaction(self):
+        """
+        显式事务，with块中通过cursor执行的语句一起提交，出错时回滚并抛出异常
+        事务期间占用一个连接，同一线程中嵌套的查询使用同一个连接
+        """
+        with self.__get_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                yield cursor
+                cursor.execute("COMMIT")
+            except Exception:
+                if connection.in_transaction:
+                    connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+
+def select_by_sql(sql, params=()):
+    return DBHelper().select(sql, params)
+
+
+def update_by_sql(sql, params=()):
+    return DBHelper().excute(sql, params)
 
 
-def select_by_sql(sql):
-    return DBHelper().select(sql)
+def update_by_sql_many(sql, params_list):
+    return DBHelper().excute_many(sql, params_list)
 
 
-def update_by_sql(sql):
-    return DBHelper().excute(sql)
+def db_transaction():
+    return DBHelper().transaction()
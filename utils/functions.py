@@ -1,22 +1,28 @@
 import ctypes
+import hashlib
 import os
 import re
 import socket
 import subprocess
+import tempfile
 import time
 import platform
 
 import cn2an
-import requests
 import bisect
 import datetime
-from xml.dom.minidom import parse
-import xml.dom.minidom
+import xml.etree.ElementTree as ETree
 
 from utils.types import MediaType
 
 # 全局对象
 INSTANCES = {}
+# 流式解析XML时每次读取的字节数
+XML_CHUNK_SIZE = 64 * 1024
+# 条件请求下载的XML超过该字节数时暂存到临时文件，避免大的RSS占用内存
+XML_SPOOL_SIZE = 1024 * 1024
+# Torznab扩展属性的命名空间
+TORZNAB_NAMESPACE = "http://torznab.com/schemas/2015/feed"
 
 
 # 单例模式注解
@@ -39,14 +45,17 @@ def get_location(ip):
     url = 'https://sp0.baidu.com/8aQDcjqpAAV3otqbppnN2DJv/api.php?co=&resource_id=6006&t=1529895387942&ie=utf8' \
           '&oe=gbk&cb=op_aladdin_callback&format=json&tn=baidu&' \
           'cb=jQuery110203920624944751099_1529894588086&_=1529894588088&query=%s' % ip
+    # 延迟导入，避免与config循环引用
+    from utils.http_utils import RequestUtils
     try:
-        r = requests.get(url, timeout=10)
+        r = RequestUtils().request("get", url)
         r.encoding = 'gbk'
         html = r.text
         c1 = html.split('location":"')[1]
         c2 = c1.split('","')[0]
         return c2
-    except requests.exceptions:
+    except Exception as e:
+        print(str(e))
         return ''
 
 
@@ -202,135 +211,228 @@ def get_host_ip():
         return ''
 
 
-# 解析RSS的XML，返回标题及URL
-def parse_rssxml(url):
-    ret_array = []
+# 去掉XML标签的命名空间
+def get_xml_local_name(tag):
+    return tag.rsplit('}', 1)[-1] if tag.startswith('{') else tag
+
+
+# 增量解析XML数据块，每解析完一个item就返回，已返回的item从树中移除
+def iter_xml_elements(chunks):
+    parser = ETree.XMLPullParser(events=('start', 'end'))
+    parents = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if get_xml_local_name(elem.tag) != "item":
+                continue
+            yield elem
+            if parents:
+                parents[-1].remove(elem)
+
+
+# 流式下载并解析XML，传入feed_state时使用条件请求，内容未变化时不解析
+def iter_xml_items(url, feed_state=None):
     if not url:
-        return []
-    try:
-        ret = requests.get(url, timeout=30)
-    except Exception as e2:
-        print(str(e2))
-        return []
-    if ret:
-        ret_xml = ret.text
+        return
+    if feed_state is not None:
+        content = get_xml_content(url, feed_state)
         try:
-            # 解析XML
-            dom_tree = xml.dom.minidom.parseString(ret_xml)
-            rootNode = dom_tree.documentElement
-            items = rootNode.getElementsByTagName("item")
-            for item in items:
-                try:
-                    # 标题
-                    title = ""
-                    tagNames = item.getElementsByTagName("title")
-                    if tagNames:
-                        firstChild = tagNames[0].firstChild
-                        if firstChild:
-                            title = firstChild.data
-                    if not title:
-                        continue
-                    # 种子链接
-                    enclosure = ""
-                    tagNames = item.getElementsByTagName("enclosure")
-                    if tagNames:
-                        enclosure = tagNames[0].getAttribute("url")
-                    if not enclosure:
-                        continue
-                    # 描述
-                    description = ""
-                    tagNames = item.getElementsByTagName("description")
-                    if tagNames:
-                        firstChild = tagNames[0].firstChild
-                        if firstChild:
-                            description = firstChild.data
-                    tmp_dict = {'title': title, 'enclosure': enclosure, 'description': description}
-                    ret_array.append(tmp_dict)
-                except Exception as e1:
-                    print(str(e1))
-                    continue
-        except Exception as e2:
-            print(str(e2))
-            return ret_array
-    return ret_array
+            for elem in iter_xml_content_items(content):
+                yield elem
+        finally:
+            if content is not None:
+                content.close()
+        return
+    # 延迟导入，避免与config循环引用
+    from utils.http_utils import RequestUtils
+    try:
+        ret = RequestUtils(timeout=30).request("get", url, stream=True)
+    except Exception as e:
+        print(str(e))
+        return
+    try:
+        if not ret:
+            return
+        for elem in iter_xml_elements(ret.iter_content(chunk_size=XML_CHUNK_SIZE)):
+            yield elem
+    except Exception as e:
+        print(str(e))
+    finally:
+        ret.close()
 
 
-# 解析Jackett的XML，返回标题及URL等
-def parse_jackettxml(url):
-    ret_array = []
+# 使用条件请求下载完整的XML内容，边下载边计算摘要并暂存，不整体读入内存
+# 返回定位到开头的临时文件，由调用方关闭，内容未变化或下载失败时返回None
+def get_xml_content(url, feed_state):
     if not url:
-        return ret_array
+        return None
+    # 延迟导入，避免与config循环引用
+    from utils.http_utils import RequestUtils
+    headers = {}
+    feed_state['changed'] = True
+    if feed_state.get('etag'):
+        headers['If-None-Match'] = feed_state.get('etag')
+    if feed_state.get('last_modified'):
+        headers['If-Modified-Since'] = feed_state.get('last_modified')
     try:
-        ret = requests.get(url, timeout=30)
-    except Exception as e2:
-        print(str(e2))
-        return []
-    if ret:
-        ret_xml = ret.text
+        ret = RequestUtils(timeout=30).request("get", url, headers=headers, stream=True)
+    except Exception as e:
+        print(str(e))
+        return None
+    content = None
+    try:
+        if ret.status_code == 304:
+            feed_state['changed'] = False
+            return None
+        if not ret:
+            return None
+        content = tempfile.SpooledTemporaryFile(max_size=XML_SPOOL_SIZE)
+        content_hash = hashlib.md5()
+        for chunk in ret.iter_content(chunk_size=XML_CHUNK_SIZE):
+            content_hash.update(chunk)
+            content.write(chunk)
+        content_hash = content_hash.hexdigest()
+        feed_state['etag'] = ret.headers.get('ETag')
+        feed_state['last_modified'] = ret.headers.get('Last-Modified')
+        if content_hash == feed_state.get('content_hash'):
+            feed_state['changed'] = False
+            content.close()
+            return None
+        feed_state['content_hash'] = content_hash
+        content.seek(0)
+        return content
+    except Exception as e:
+        print(str(e))
+        if content is not None:
+            content.close()
+        return None
+    finally:
+        ret.close()
+
+
+# 解析已下载完成的XML内容，逐个返回item，content为字节串或已打开的文件，文件按块读取
+def iter_xml_content_items(content):
+    if not content:
+        return
+    if isinstance(content, bytes):
+        chunks = [content]
+    else:
+        chunks = iter(lambda: content.read(XML_CHUNK_SIZE), b"")
+    try:
+        for elem in iter_xml_elements(chunks):
+            yield elem
+    except Exception as e:
+        print(str(e))
+
+
+# 取item下第一个子节点，按不带命名空间的标签名匹配
+def get_xml_child(item, name):
+    for child in item:
+        if get_xml_local_name(child.tag) == name:
+            return child
+    return None
+
+
+# 取item下子节点的文本
+def get_xml_child_text(item, name):
+    child = get_xml_child(item, name)
+    if child is not None and child.text:
+        return child.text
+    return ""
+
+
+# 解析RSS的XML，逐条返回标题及URL，传入feed_state时解析到上次最新的一条即停止，传入content时解析已下载的内容
+def parse_rssxml(url, feed_state=None, content=None):
+    items = iter_xml_content_items(content) if content is not None else iter_xml_items(url, feed_state)
+    for item in items:
         try:
-            # 解析XML
-            dom_tree = xml.dom.minidom.parseString(ret_xml)
-            rootNode = dom_tree.documentElement
-            items = rootNode.getElementsByTagName("item")
-            for item in items:
-                try:
-                    # 标题
-                    title = ""
-                    tagNames = item.getElementsByTagName("title")
-                    if tagNames:
-                        firstChild = tagNames[0].firstChild
-                        if firstChild:
-                            title = firstChild.data
-                    if not title:
-                        continue
-                    # 种子链接
-                    enclosure = ""
-                    tagNames = item.getElementsByTagName("enclosure")
-                    if tagNames:
-                        enclosure = tagNames[0].getAttribute("url")
-                    if not enclosure:
-                        continue
-                    # 描述
-                    description = ""
-                    tagNames = item.getElementsByTagName("description")
-                    if tagNames:
-                        firstChild = tagNames[0].firstChild
-                        if firstChild:
-                            description = firstChild.data
-                    # 种子大小
-                    size = 0
-                    tagNames = item.getElementsByTagName("size")
-                    if tagNames:
-                        firstChild = tagNames[0].firstChild
-                        if firstChild:
-                            size = firstChild.data
-                    # 做种数
-                    seeders = 0
-                    # 下载数
-                    peers = 0
-                    torznab_attrs = item.getElementsByTagName("torznab:attr")
-                    for torznab_attr in torznab_attrs:
-                        name = torznab_attr.getAttribute('name')
-                        value = torznab_attr.getAttribute('value')
-                        if name == "seeders":
-                            seeders = value
-                        if name == "peers":
-                            peers = value
-
-                    # 做种为0的跳过
-                    if seeders == 0:
-                        continue
-
-                    tmp_dict = {'title': title, 'enclosure': enclosure, 'description': description, 'size': size,
-                                'seeders': seeders, 'peers': peers}
-                    ret_array.append(tmp_dict)
-                except Exception as e:
-                    print(str(e))
+            # 标题
+            title = get_xml_child_text(item, "title")
+            if not title:
+                continue
+            # 种子链接
+            enclosure = ""
+            tag = get_xml_child(item, "enclosure")
+            if tag is not None:
+                enclosure = tag.get("url")
+            if not enclosure:
+                continue
+            # 唯一标识，没有guid的使用种子链接
+            guid = get_xml_child_text(item, "guid") or enclosure
+            if feed_state is not None:
+                if guid == feed_state.get('last_guid'):
+                    if not feed_state.get('new_guid'):
+                        feed_state['changed'] = False
+                    break
+                if not feed_state.get('new_guid'):
+                    feed_state['new_guid'] = guid
+            # 描述
+            description = get_xml_child_text(item, "description")
+            yield {'title': title, 'enclosure': enclosure, 'description': description, 'guid': guid}
+        except Exception as e:
+            print(str(e))
+            continue
+
+
+# 解析Jackett的XML，逐条返回标题及URL等，传入content时解析已下载的内容
+def parse_jackettxml(url, content=None):
+    items = iter_xml_content_items(content) if content is not None else iter_xml_items(url)
+    for item in items:
+        try:
+            # 标题
+            title = get_xml_child_text(item, "title")
+            if not title:
+                continue
+            # 种子链接
+            enclosure = ""
+            tag = get_xml_child(item, "enclosure")
+            if tag is not None:
+                enclosure = tag.get("url")
+            if not enclosure:
+                continue
+            # 描述
+            description = get_xml_child_text(item, "description")
+            # 种子大小
+            size = get_xml_child_text(item, "size") or 0
+            # 做种数
+            seeders = 0
+            # 下载数
+            peers = 0
+            for torznab_attr in item:
+                if torznab_attr.tag != "{%s}attr" % TORZNAB_NAMESPACE:
                     continue
-        except Exception as e2:
-            print(str(e2))
-            return ret_array
-    return ret_array
+                name = torznab_attr.get('name')
+                value = torznab_attr.get('value')
+                if name == "seeders":
+                    seeders = value
+                if name == "peers":
+                    peers = value
+
+            # 做种为0的跳过
+            if seeders == 0:
+                continue
+
+            yield {'title': title, 'enclosure': enclosure, 'description': description, 'size': size,
+                   'seeders': seeders, 'peers': peers}
+        except Exception as e:
+            print(str(e))
+            continue
+
+
+# 将迭代器按数量分批返回
+def split_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def is_media_files_tv(file_list):
@@ -438,7 +540,7 @@ def get_torrents_group_item(media_list):
     media_list = sorted(media_list, key=lambda x: get_sort_str(x), reverse=True)
     # 控重
     can_download_list_item = []
-    can_download_list = []
+    can_download_list = set()
     # 排序后重新加入数组，按真实名称控重，即只取每个名称的第一个
     for t_item in media_list:
         # 控重的主链是名称、节份、季、集
@@ -450,7 +552,7 @@ def get_torrents_group_item(media_list):
         else:
             media_name = "%s%s%s" % (t_item.get_title_string(), t_item.site, t_item.get_resource_type_string())
         if media_name not in can_download_list:
-            can_download_list.append(media_name)
+            can_download_list.add(media_name)
             can_download_list_item.append(t_item)
     return can_download_list_item
 
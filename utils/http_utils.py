@@ -3,45 +3,104 @@
 # @Time    : 2022/3/1 21:05
 # @Function: http请求工具
 
-import datetime
 import random
 import time
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+from urllib.parse import urlparse
 
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import HTTP_TIMEOUT, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_RETRY_TIMES, HTTP_RETRY_BACKOFF
+
+lock = Lock()
 
 
 class RequestUtils:
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    __pre_request_time = None
+    # 按站点共享的会话，复用长连接
+    __sessions = {}
+    # 按站点记录的上次请求时间
+    __pre_request_times = {}
 
-    def __init__(self, request_interval_mode=False):
+    def __init__(self, request_interval_mode=False, timeout=HTTP_TIMEOUT):
         self.request_interval_mode = request_interval_mode
+        self.timeout = timeout
 
-    def check_request(self):
-        if not self.request_interval_mode:
-            return
+    @staticmethod
+    def get_host(url):
+        url_obj = urlparse(url)
+        return "%s://%s" % (url_obj.scheme, url_obj.netloc)
+
+    @classmethod
+    def get_session(cls, url):
+        """
+        取站点共享的会话，不存在则新建
+        会话只用于复用连接，不保存Cookie，避免不同调用方之间串Cookie
+        :return:
+        """
+        host = cls.get_host(url)
+        with lock:
+            session = cls.__sessions.get(host)
+            if not session:
+                session = requests.Session()
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                retry = Retry(total=HTTP_RETRY_TIMES,
+                              backoff_factor=HTTP_RETRY_BACKOFF,
+                              status_forcelist=(429, 500, 502, 503, 504),
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                      pool_maxsize=HTTP_POOL_MAXSIZE,
+                                      max_retries=retry)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls.__sessions[host] = session
+        return session
+
+    def check_request(self, url):
         """
-        todo 对不同domain做不同配置
-        检测每次请求的间隔，如果频率太快则休息，休息时间尽量无规律
+        检测每个站点每次请求的间隔，如果频率太快则休息，休息时间尽量无规律
+        在锁内预约本次请求的时间再休眠，同一站点的并发请求依次排开，不会同时醒来
         :return:
         """
-        if self.__pre_request_time is None:
-            self.__pre_request_time = datetime.datetime.now()
+        if not self.request_interval_mode:
             return
-        during_time = datetime.datetime.now() - self.__pre_request_time
-        ms = during_time.microseconds / 1000
-        # 至少间隔1秒，随机是为了无规律
-        if ms < random.randint(1000, 5000):
-            min_sleep_secs = 1
-            # 随机休眠0.5-5秒，扣除间隔影响，避免休眠太久
-            max_sleep_secs = 10.0 - (ms / 1000)
-            # 避免间隔太久随机出错
-            if max_sleep_secs <= min_sleep_secs:
-                max_sleep_secs = min_sleep_secs * 2
-            sleep_secs = random.uniform(min_sleep_secs, max_sleep_secs)
-            time.sleep(sleep_secs)
-        self.__pre_request_time = datetime.datetime.now()
+        host = self.get_host(url)
+        with lock:
+            now = time.time()
+            start_time = now
+            pre_request_time = self.__pre_request_times.get(host)
+            if pre_request_time is not None:
+                ms = (now - pre_request_time) * 1000
+                # 至少间隔1秒，随机是为了无规律
+                if ms < random.randint(1000, 5000):
+                    min_sleep_secs = 1
+                    # 随机休眠0.5-5秒，扣除间隔影响，避免休眠太久
+                    max_sleep_secs = 10.0 - (max(ms, 0) / 1000)
+                    # 避免间隔太久随机出错
+                    if max_sleep_secs <= min_sleep_secs:
+                        max_sleep_secs = min_sleep_secs * 2
+                    # 上一次请求还在等待时，在其预约的时间之后再间隔
+                    start_time = max(now, pre_request_time) + random.uniform(min_sleep_secs, max_sleep_secs)
+            self.__pre_request_times[host] = start_time
+        if start_time > now:
+            time.sleep(start_time - now)
+
+    def request(self, method, url, **kwargs):
+        """
+        通过站点共享的会话发起请求，出错时抛出异常
+
+        :param method: get、post等
+        :param url:
+        :param kwargs: 同requests.request
+        :return: Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        self.check_request(url)
+        return self.get_session(url).request(method, url, **kwargs)
 
     def post(self, url, params, headers={}, json={}):
         """
@@ -53,44 +112,32 @@ class RequestUtils:
         :param json:
         :return:
         """
-        i = 0
-        while i < 3:
-            try:
-                self.check_request()
-                r = requests.post(url, data=params,
-                                  verify=False, headers=headers, json=json)
-                # return str(r.content, 'UTF-8')
-                return r
-            except requests.exceptions.RequestException:
-                i += 1
+        try:
+            return self.request("post", url, data=params, verify=False, headers=headers, json=json)
+        except requests.exceptions.RequestException as e:
+            print(e)
+            return None
 
     def get(self, url, params=None, headers=None):
-        i = 0
-        while i < 3:
-            try:
-                self.check_request()
-                r = requests.get(url, verify=False, headers=headers, params=params, timeout=10)
-                return str(r.content, 'UTF-8')
-            except requests.exceptions.RequestException:
-                i += 1
-
-    def get_res(self, url, params=None, headers={}, cookies=None):
-        i = 0
-        while i < 3:
-            try:
-                self.check_request()
-                return requests.get(url, params=params, verify=False, headers=headers, cookies=cookies, timeout=10)
-            except requests.exceptions.RequestException as e:
-                print(e)
-                i += 1
+        try:
+            r = self.request("get", url, verify=False, headers=headers, params=params)
+            return str(r.content, 'UTF-8')
+        except requests.exceptions.RequestException as e:
+            print(e)
+            return None
+
+    def get_res(self, url, params=None, headers={}, cookies=None, stream=False):
+        try:
+            return self.request("get", url, params=params, verify=False, headers=headers, cookies=cookies,
+                                stream=stream)
+        except requests.exceptions.RequestException as e:
+            print(e)
+            return None
 
     def post_res(self, url, params=None, headers={}, cookies=None, allow_redirects=True):
-        i = 0
-        while i < 3:
-            try:
-                self.check_request()
-                return requests.post(url, params=params, verify=False, headers=headers, cookies=cookies,
-                                     allow_redirects=allow_redirects)
-            except requests.exceptions.RequestException as e:
-                print(e)
-                i += 1
+        try:
+            return self.request("post", url, params=params, verify=False, headers=headers, cookies=cookies,
+                                allow_redirects=allow_redirects)
+        except requests.exceptions.RequestException as e:
+            print(e)
+            return None
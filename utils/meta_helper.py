@@ -1,55 +1,258 @@
 import os
 import pickle
+import sqlite3
+import time
+from collections import OrderedDict
 from threading import Lock
 
-from config import Config
+import log
+from config import Config, METAINFO_CACHE_MAX_SIZE, METAINFO_CACHE_TTL, METAINFO_CACHE_NEGATIVE_TTL
 from utils.functions import singleton
 
 lock = Lock()
 
 
+# 使用SQLite表存储元数据，KEY为主键，值为序列化后的TMDB信息
+class SqliteMetaStore(object):
+    __connection = None
+    __lock = None
+
+    def __init__(self, path):
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute('''CREATE TABLE IF NOT EXISTS META_DATA
+                                   (KEY TEXT PRIMARY KEY NOT NULL,
+                                   VALUE BLOB,
+                                   UPDATE_TIME REAL);''')
+        self.__connection.execute('''CREATE INDEX IF NOT EXISTS INDX_META_DATA_TIME ON META_DATA (UPDATE_TIME);''')
+        self.__connection.commit()
+
+    # 返回 (数据, 更新时间)，不存在时返回None
+    def get(self, key):
+        with self.__lock:
+            row = self.__connection.execute("SELECT VALUE, UPDATE_TIME FROM META_DATA WHERE KEY = ?",
+                                            (key,)).fetchone()
+        if not row:
+            return None
+        try:
+            return pickle.loads(row[0]), row[1] or 0
+        except Exception as e:
+            log.error("【META】读取缓存数据出错：%s，%s" % (key, str(e)))
+            return None
+
+    def put_many(self, items):
+        if not items:
+            return 0
+        now = time.time()
+        rows = [(key, pickle.dumps(item, pickle.HIGHEST_PROTOCOL), now) for key, item in items.items()]
+        with self.__lock:
+            with self.__connection:
+                self.__connection.executemany(
+                    "INSERT OR REPLACE INTO META_DATA(KEY, VALUE, UPDATE_TIME) VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    # 删除指定时间之前更新的记录
+    def delete_expired(self, before_time):
+        with self.__lock:
+            with self.__connection:
+                return self.__connection.execute("DELETE FROM META_DATA WHERE UPDATE_TIME < ?",
+                                                 (before_time,)).rowcount
+
+    def count(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(1) FROM META_DATA").fetchone()[0]
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+# 元数据的内存缓存，按最久未使用淘汰，识别到与未识别到的记录分别设置有效期
+# 未命中时按KEY从存储中加载，新增的记录标记为待保存，未识别到的记录只保存在内存中
+class MetaCache(object):
+    __store = None
+    __items = None
+    __dirty = None
+    __lock = None
+    __max_size = 0
+    __ttl = 0
+    __negative_ttl = 0
+    __stats = None
+
+    def __init__(self, store, max_size, ttl, negative_ttl):
+        self.__store = store
+        self.__items = OrderedDict()
+        self.__dirty = {}
+        self.__lock = Lock()
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def __is_negative(item):
+        return item.get("id") == 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.__lock:
+            cached = self.__items.get(key)
+            if cached:
+                item, expire_time = cached
+                if expire_time > now:
+                    self.__items.move_to_end(key)
+                    self.__stats["hits"] += 1
+                    return item
+                # 过期删除，重新查询
+                self.__items.pop(key)
+                self.__dirty.pop(key, None)
+                self.__stats["expirations"] += 1
+                self.__stats["misses"] += 1
+                return default
+            if key in self.__dirty:
+                # 已被淘汰但还未保存的记录
+                self.__stats["hits"] += 1
+                self.__put(key, self.__dirty[key], now + self.__ttl)
+                return self.__dirty[key]
+        stored = self.__store.get(key)
+        with self.__lock:
+            if not stored:
+                self.__stats["misses"] += 1
+                return default
+            item, update_time = stored
+            if update_time + self.__ttl <= now:
+                self.__stats["expirations"] += 1
+                self.__stats["misses"] += 1
+                return default
+            self.__stats["hits"] += 1
+            self.__put(key, item, update_time + self.__ttl)
+        return item
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        item = self.get(key)
+        if item is None:
+            raise KeyError(key)
+        return item
+
+    def __setitem__(self, key, item):
+        now = time.time()
+        with self.__lock:
+            if self.__is_negative(item):
+                self.__put(key, item, now + self.__negative_ttl)
+            else:
+                self.__put(key, item, now + self.__ttl)
+                self.__dirty[key] = item
+
+    def __put(self, key, item, expire_time):
+        self.__items[key] = (item, expire_time)
+        self.__items.move_to_end(key)
+        while len(self.__items) > self.__max_size:
+            # 待保存的记录在__dirty中保留至下次保存
+            self.__items.popitem(last=False)
+            self.__stats["evictions"] += 1
+
+    def __len__(self):
+        return len(self.__items)
+
+    # 取出待保存的记录并清空标记
+    def pop_dirty(self):
+        with self.__lock:
+            dirty_items = self.__dirty
+            self.__dirty = {}
+        return dirty_items
+
+    # 保存失败时放回待保存的记录，期间又有更新的以新记录为准
+    def restore_dirty(self, dirty_items):
+        with self.__lock:
+            for key, item in dirty_items.items():
+                if key not in self.__dirty:
+                    self.__dirty[key] = item
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["size"] = len(self.__items)
+            stats["max_size"] = self.__max_size
+        return stats
+
+
 @singleton
 class MetaHelper(object):
-    __meta_data = {}
+    __meta_data = None
     __meta_path = None
+    __meta_store = None
 
     def __init__(self):
         self.init_config()
 
     def init_config(self):
         config = Config()
-        self.__meta_path = os.path.join(os.path.dirname(config.get_config_path()), 'meta.dat')
-        self.__meta_data = self.__load_meta_data(self.__meta_path)
+        config_dir = os.path.dirname(config.get_config_path())
+        self.__meta_path = os.path.join(config_dir, 'meta.db')
+        self.__meta_data = None
+        if self.__meta_store:
+            self.__meta_store.close()
+            self.__meta_store = None
 
+    # 首次查询时才打开存储，旧版本的meta.dat导入后改名备份
     def get_meta_data(self):
+        if self.__meta_data is None:
+            with lock:
+                if self.__meta_data is None:
+                    self.__meta_store = SqliteMetaStore(self.__meta_path)
+                    self.__import_legacy_data(os.path.join(os.path.dirname(self.__meta_path), 'meta.dat'))
+                    self.__meta_data = MetaCache(self.__meta_store,
+                                                  METAINFO_CACHE_MAX_SIZE,
+                                                  METAINFO_CACHE_TTL,
+                                                  METAINFO_CACHE_NEGATIVE_TTL)
         return self.__meta_data
 
-    @staticmethod
-    def __load_meta_data(path):
+    def __import_legacy_data(self, path):
+        if not os.path.exists(path):
+            return
         try:
             with open(path, 'rb') as f:
                 data = pickle.load(f)
-            return data
+            if data:
+                num = self.__meta_store.put_many({key: item for key, item in data.items()
+                                                  if item and item.get("id") != 0})
+                log.info("【META】已导入旧版本缓存数据：%s 条" % num)
+            os.rename(path, "%s.bak" % path)
         except Exception as e:
-            return {}
+            log.error("【META】导入旧版本缓存数据出错：%s" % str(e))
 
     def update_meta_data(self, meta_data):
-        for key, item in meta_data.items():
-            if not self.__meta_data.get(key):
-                self.__meta_data[key] = item
+        cache = self.get_meta_data()
+        with lock:
+            for key, item in meta_data.items():
+                if not cache.get(key):
+                    cache[key] = item
 
+    # 只保存新增的记录，同时清理存储中已过期的记录
     def save_meta_data(self):
+        if self.__meta_data is None:
+            return
+        with lock:
+            dirty_items = self.__meta_data.pop_dirty()
         try:
-            lock.acquire()
-            meta_data = self.__load_meta_data(self.__meta_path)
-            save_flag = False
-            for key, item in self.__meta_data.items():
-                if not meta_data.get(key) and item.get("id") != 0:
-                    save_flag = True
-                    meta_data[key] = item
-            if not save_flag:
-                return
-            with open(self.__meta_path, 'wb') as f:
-                pickle.dump(meta_data, f, pickle.HIGHEST_PROTOCOL)
-        finally:
-            lock.release()
+            if dirty_items:
+                self.__meta_store.put_many(dirty_items)
+        except Exception as e:
+            # 放回待保存的记录，下次保存时重试
+            self.__meta_data.restore_dirty(dirty_items)
+            log.error("【META】保存缓存数据出错：%s" % str(e))
+            return
+        try:
+            self.__meta_store.delete_expired(time.time() - METAINFO_CACHE_TTL)
+        except Exception as e:
+            log.error("【META】清理过期缓存数据出错：%s" % str(e))
+
+    # 缓存统计信息：命中、未命中、淘汰、过期次数及当前条数
+    def get_meta_stats(self):
+        if self.__meta_data is None:
+            return {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "size": 0,
+                    "max_size": METAINFO_CACHE_MAX_SIZE}
+        return self.__meta_data.get_stats()
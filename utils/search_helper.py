@@ -0,0 +1,169 @@
+import json
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+import log
+from config import SEARCH_SESSION_TTL, SEARCH_SESSION_MAX_SIZE, SEARCH_SESSION_SPILL
+from utils.functions import singleton, str_filesize, xstr
+from utils.sqls import insert_search_session, get_search_session, get_last_search_session, \
+    delete_expired_search_sessions
+from utils.types import MediaType
+
+lock = Lock()
+
+
+# 检索结果会话，每次检索生成一个检索ID，结果保存在内存中，不同用户、不同检索之间互不覆盖
+# 结果行格式与原JACKETT_TORRENTS查询结果一致：
+# ID,标题,资源类型,大小,做种数,链接,站点,年份,季集,图片,类型,评分,种子名称,描述,原标题,季,集
+@singleton
+class SearchHelper(object):
+    # 检索ID：{'owner': 用户, 'keyword': 关键字, 'items': 结果行, 'search_time': 检索时间, 'time': 最近使用时间}
+    # 按最近使用的顺序排列，超过数量或有效期时从最久未使用的开始淘汰
+    __sessions = OrderedDict()
+
+    def __init__(self):
+        self.__sessions = OrderedDict()
+
+    # 保存一次检索的结果，返回检索ID
+    def add_search(self, media_items, keyword=None, owner=None):
+        search_id = uuid.uuid4().hex[:16]
+        items = self.__get_items(search_id, media_items)
+        now = time.time()
+        with lock:
+            self.__sessions[search_id] = {'search_id': search_id, 'owner': owner, 'keyword': keyword, 'items': items,
+                                          'search_time': now, 'time': now}
+            self.__clear_expired_sessions(now)
+        if SEARCH_SESSION_SPILL:
+            try:
+                delete_expired_search_sessions(now - SEARCH_SESSION_TTL)
+                insert_search_session(search_id, owner, keyword, json.dumps(items, ensure_ascii=False), now)
+            except Exception as e:
+                log.error("【SEARCH】保存检索结果出错：%s" % str(e))
+        return search_id
+
+    # 查询检索结果，未指定检索ID时取该用户最近一次的检索，用户没有检索过时取最近一次的检索（如微信检索）
+    # 返回 (检索ID, 结果行列表)
+    def get_jackett_results(self, search_id=None, owner=None):
+        if search_id:
+            session = self.__get_session(search_id)
+            return search_id, session.get('items') if session else []
+        for last_owner in ([owner, None] if owner else [None]):
+            search_id, session = self.__get_last_session(last_owner)
+            if session:
+                return search_id, session.get('items')
+        return None, []
+
+    # 根据结果ID查询一条检索结果，返回格式与原数据库查询一致：[(链接,标题,年份,季,集,评分,图片,类型)]
+    def get_jackett_result_by_id(self, dl_id):
+        if not dl_id or "_" not in str(dl_id):
+            return []
+        search_id = str(dl_id).rsplit("_", 1)[0]
+        session = self.__get_session(search_id)
+        if not session:
+            return []
+        for item in session.get('items'):
+            if item[0] == dl_id:
+                return [(item[5], item[14], item[7], item[15], item[16], item[11], item[9], item[10])]
+        return []
+
+    # 从内存中查询检索会话，没有时从数据库中加载
+    def __get_session(self, search_id):
+        now = time.time()
+        with lock:
+            session = self.__sessions.get(search_id)
+            if session and now - session.get('time') <= SEARCH_SESSION_TTL:
+                session['time'] = now
+                self.__sessions.move_to_end(search_id)
+                return session
+        if not SEARCH_SESSION_SPILL:
+            return None
+        return self.__load_session(get_search_session(search_id), now)
+
+    # 查询最近一次的检索会话，owner为None时不区分用户，内存中的可能已被淘汰，同时与数据库中最近的比较
+    def __get_last_session(self, owner=None):
+        now = time.time()
+        last_session = None
+        with lock:
+            for session in self.__sessions.values():
+                if now - session.get('time') > SEARCH_SESSION_TTL:
+                    continue
+                if owner is not None and session.get('owner') != owner:
+                    continue
+                if not last_session or session.get('search_time') > last_session.get('search_time'):
+                    last_session = session
+        if SEARCH_SESSION_SPILL:
+            row = get_last_search_session(owner)
+            if row and (not last_session or (row[4] or 0) > last_session.get('search_time')):
+                last_session = self.__load_session(row, now) or last_session
+        if not last_session:
+            return None, None
+        return last_session.get('search_id'), last_session
+
+    # 将数据库中的检索记录加载到内存中，作为最近使用的放在最后，过期的不加载
+    def __load_session(self, row, now):
+        if not row or now - (row[4] or 0) > SEARCH_SESSION_TTL:
+            return None
+        try:
+            items = json.loads(row[3])
+        except Exception as e:
+            log.error("【SEARCH】读取检索结果出错：%s" % str(e))
+            return None
+        session = {'search_id': row[0], 'owner': row[1], 'keyword': row[2], 'items': items,
+                   'search_time': row[4], 'time': now}
+        with lock:
+            session = self.__sessions.get(row[0]) or session
+            session['time'] = now
+            self.__sessions[row[0]] = session
+            self.__sessions.move_to_end(row[0])
+            self.__clear_expired_sessions(now)
+        return session
+
+    # 清理过期的检索会话，超过最大数量时淘汰最久未使用的，需在锁内调用
+    def __clear_expired_sessions(self, now):
+        while self.__sessions:
+            search_id, session = next(iter(self.__sessions.items()))
+            if len(self.__sessions) <= SEARCH_SESSION_MAX_SIZE and now - session.get('time') <= SEARCH_SESSION_TTL:
+                break
+            self.__sessions.popitem(last=False)
+
+    # 生成检索结果行，按标题、做种数倒序排列
+    def __get_items(self, search_id, media_items):
+        items = []
+        for media_item in media_items or []:
+            title = str(media_item.title)
+            year = xstr(media_item.year)
+            se_string = media_item.get_season_episode_string()
+            items.append([
+                None,
+                "%s (%s) %s" % (title, year, se_string),
+                media_item.get_resource_type_string(),
+                str_filesize(int(media_item.size)),
+                self.__get_number(media_item.seeders),
+                str(media_item.enclosure),
+                str(media_item.site),
+                year,
+                se_string,
+                str(media_item.backdrop_path),
+                "TV" if media_item.type == MediaType.TV else "MOV",
+                self.__get_number(media_item.vote_average),
+                str(media_item.org_string),
+                str(media_item.description),
+                title,
+                media_item.get_season_string(),
+                media_item.get_episode_string()
+            ])
+        items.sort(key=lambda x: (x[14], -x[4]))
+        for index, item in enumerate(items):
+            item[0] = "%s_%s" % (search_id, index)
+        return items
+
+    # 转换为数字，整数值返回int，无法转换时返回0
+    @staticmethod
+    def __get_number(value):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return 0
+        return int(number) if number.is_integer() else number
@@ -1,67 +1,19 @@
+import hashlib
 import os.path
 import time
+from threading import Lock
 
-from utils.db_helper import update_by_sql, select_by_sql
-from utils.functions import str_filesize, xstr
-from utils.types import MediaType
-
-
-# 将Jackett返回信息插入数据库
-def insert_jackett_results(media_item):
-    org_string = media_item.org_string.replace("'", "''")
-    description = media_item.description.replace("'", "''")
-    sql = "INSERT INTO JACKETT_TORRENTS(" \
-          "TORRENT_NAME," \
-          "ENCLOSURE," \
-          "DESCRIPTION," \
-          "TYPE," \
-          "TITLE," \
-          "YEAR," \
-          "SEASON," \
-          "EPISODE," \
-          "ES_STRING," \
-          "VOTE," \
-          "IMAGE," \
-          "RES_TYPE," \
-          "RES_ORDER," \
-          "SIZE," \
-          "SEEDERS," \
-          "PEERS," \
-          "SITE," \
-          "SITE_ORDER) VALUES (" \
-          "'%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s')" % (
-              org_string,
-              media_item.enclosure,
-              description,
-              "TV" if media_item.type == MediaType.TV else "MOV",
-              media_item.title,
-              xstr(media_item.year),
-              media_item.get_season_string(),
-              media_item.get_episode_string(),
-              media_item.get_season_episode_string(),
-              media_item.vote_average,
-              media_item.backdrop_path,
-              media_item.get_resource_type_string(),
-              media_item.res_order,
-              str_filesize(int(media_item.size)),
-              media_item.seeders,
-              media_item.peers,
-              media_item.site,
-              media_item.site_order
-          )
-    return update_by_sql(sql)
-
+import log
+from config import HISTORY_COUNT_CACHE_TTL, HISTORY_COUNT_CACHE_SIZE, HISTORY_COUNT_LIMIT
+from utils.db_helper import update_by_sql, select_by_sql, update_by_sql_many, db_transaction, DBHelper
 
-# 根据ID从数据库中查询Jackett检索结果的一条记录
-def get_jackett_result_by_id(dl_id):
-    sql = "SELECT ENCLOSURE,TITLE,YEAR,SEASON,EPISODE,VOTE,IMAGE,TYPE FROM JACKETT_TORRENTS WHERE ID=%s" % dl_id
-    return select_by_sql(sql)
+# SQL中IN列表单次最多带的参数个数，超出时分批查询
+SQL_IN_BATCH_SIZE = 500
 
-
-# 查询Jackett检索结果的所有记录
-def get_jackett_results():
-    sql = "SELECT ID,TITLE||' ('||YEAR||') '||ES_STRING,RES_TYPE,SIZE,SEEDERS,ENCLOSURE,SITE,YEAR,ES_STRING,IMAGE,TYPE,VOTE*1,TORRENT_NAME,DESCRIPTION FROM JACKETT_TORRENTS ORDER BY TITLE, SEEDERS DESC"
-    return select_by_sql(sql)
+lock = Lock()
+# 识别转移历史的总数缓存，(条件, 参数)：(查询时间, 总数)
+_history_count_cache = {}
+_history_fts_enabled = None
 
 
 # 查询电影关键字
@@ -90,30 +42,30 @@ def delete_all_tv_keys():
 
 # 插入电影关键字
 def insert_movie_key(key):
-    sql = "SELECT 1 FROM RSS_MOVIEKEYS WHERE NAME = '%s'" % key
-    ret = select_by_sql(sql)
+    sql = "SELECT 1 FROM RSS_MOVIEKEYS WHERE NAME = ?"
+    ret = select_by_sql(sql, (key,))
     if not ret or len(ret) == 0:
-        sql = "INSERT INTO RSS_MOVIEKEYS(NAME) VALUES ('%s')" % key
-        return update_by_sql(sql)
+        sql = "INSERT INTO RSS_MOVIEKEYS(NAME) VALUES (?)"
+        return update_by_sql(sql, (key,))
     else:
         return False
 
 
 # 插入电视剧关键字
 def insert_tv_key(key):
-    sql = "SELECT 1 FROM RSS_TVKEYS WHERE NAME = '%s'" % key
-    ret = select_by_sql(sql)
+    sql = "SELECT 1 FROM RSS_TVKEYS WHERE NAME = ?"
+    ret = select_by_sql(sql, (key,))
     if not ret or len(ret) == 0:
-        sql = "INSERT INTO RSS_TVKEYS(NAME) VALUES ('%s')" % key
-        return update_by_sql(sql)
+        sql = "INSERT INTO RSS_TVKEYS(NAME) VALUES (?)"
+        return update_by_sql(sql, (key,))
     else:
         return False
 
 
 # 查询RSS是否处理过，根据链接
 def is_torrent_rssd_by_url(url):
-    sql = "SELECT 1 FROM RSS_TORRENTS WHERE ENCLOSURE = '%s'" % url
-    ret = select_by_sql(sql)
+    sql = "SELECT 1 FROM RSS_TORRENTS WHERE ENCLOSURE = ?"
+    ret = select_by_sql(sql, (url,))
     if not ret:
         return False
     if len(ret) > 0:
@@ -125,14 +77,18 @@ def is_torrent_rssd_by_url(url):
 def is_torrent_rssd_by_name(media_title, media_year, media_seaion, media_episode):
     if not media_title:
         return True
-    sql = "SELECT 1 FROM RSS_TORRENTS WHERE TITLE = '%s'" % media_title
+    sql = "SELECT 1 FROM RSS_TORRENTS WHERE TITLE = ?"
+    params = [media_title]
     if media_year:
-        sql = "%s AND YEAR='%s'" % (sql, media_year)
+        sql = "%s AND YEAR = ?" % sql
+        params.append(str(media_year))
     if media_seaion:
-        sql = "%s AND SEASON='%s'" % (sql, media_seaion)
+        sql = "%s AND SEASON = ?" % sql
+        params.append(media_seaion)
     if media_episode:
-        sql = "%s AND EPISODE='%s'" % (sql, media_episode)
-    ret = select_by_sql(sql)
+        sql = "%s AND EPISODE = ?" % sql
+        params.append(media_episode)
+    ret = select_by_sql(sql, params)
     if not ret:
         return False
     if len(ret) > 0:
@@ -140,43 +96,99 @@ def is_torrent_rssd_by_name(media_title, media_year, media_seaion, media_episode
     return False
 
 
-# 删除所有JACKETT的记录
-def delete_all_jackett_torrents():
-    return update_by_sql("DELETE FROM JACKETT_TORRENTS")
+# 将RSS的记录批量插入数据库，在一个事务中提交
+def insert_rss_torrents(media_infos):
+    if not media_infos:
+        return False
+    sql = "INSERT INTO RSS_TORRENTS(TORRENT_NAME, ENCLOSURE, TYPE, TITLE, YEAR, SEASON, EPISODE) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    return update_by_sql_many(sql, [(
+        str(media_info.title), str(media_info.enclosure), str(media_info.type), str(media_info.title),
+        str(media_info.year), media_info.get_season_string(), media_info.get_episode_string()
+    ) for media_info in media_infos])
+
+
+# 计算种子链接的摘要
+def get_url_hash(url):
+    return hashlib.md5(str(url).encode('utf-8')).hexdigest()
+
+
+# 查询一批种子链接中RSS已处理过的
+def get_rss_seen_enclosures(enclosures):
+    if not enclosures:
+        return set()
+    url_hashes = {get_url_hash(enclosure): enclosure for enclosure in enclosures}
+    hash_list = list(url_hashes)
+    seen_enclosures = set()
+    for i in range(0, len(hash_list), SQL_IN_BATCH_SIZE):
+        batch = hash_list[i:i + SQL_IN_BATCH_SIZE]
+        sql = "SELECT URL_HASH FROM RSS_SEEN_TORRENTS WHERE URL_HASH IN (%s)" % ",".join("?" * len(batch))
+        ret = select_by_sql(sql, batch)
+        if ret:
+            seen_enclosures.update(url_hashes.get(item[0]) for item in ret)
+    return seen_enclosures
+
+
+# 记录一批RSS已处理过的种子链接
+def insert_rss_seen_enclosures(enclosures):
+    if not enclosures:
+        return False
+    timestr = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
+    sql = "INSERT OR REPLACE INTO RSS_SEEN_TORRENTS(URL_HASH, DATE) VALUES (?, ?)"
+    return update_by_sql_many(sql, [(get_url_hash(enclosure), timestr) for enclosure in set(enclosures)])
+
+
+# 清理超过保留天数的RSS已处理种子链接
+def delete_expired_rss_seen(days):
+    timestr = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - days * 86400))
+    return update_by_sql("DELETE FROM RSS_SEEN_TORRENTS WHERE DATE < ?", (timestr,))
 
 
-# 将RSS的记录插入数据库
-def insert_rss_torrents(media_info):
-    sql = "INSERT INTO RSS_TORRENTS(TORRENT_NAME, ENCLOSURE, TYPE, TITLE, YEAR, SEASON, EPISODE) VALUES ('%s', '%s', '%s', '%s', '%s', '%s', '%s')" % (
-        media_info.title, media_info.enclosure, media_info.type, media_info.title, media_info.year,
-        media_info.get_season_string(), media_info.get_episode_string())
-    return update_by_sql(sql)
+# 查询RSS订阅地址上次的更新状态
+def get_rss_feed_state(url):
+    sql = "SELECT ETAG, LAST_MODIFIED, CONTENT_HASH, LAST_GUID FROM RSS_FEEDS WHERE URL = ?"
+    ret = select_by_sql(sql, (url,))
+    if not ret:
+        return {}
+    return {'etag': ret[0][0], 'last_modified': ret[0][1], 'content_hash': ret[0][2], 'last_guid': ret[0][3]}
+
+
+# 保存RSS订阅地址的更新状态
+def update_rss_feed_state(url, site, feed_state):
+    sql = "INSERT OR REPLACE INTO RSS_FEEDS(URL, SITE, ETAG, LAST_MODIFIED, CONTENT_HASH, LAST_GUID, UPDATE_TIME) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    return update_by_sql(sql, (
+        url, site, feed_state.get('etag'), feed_state.get('last_modified'), feed_state.get('content_hash'),
+        feed_state.get('new_guid') or feed_state.get('last_guid'),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))))
 
 
-# 将豆瓣的数据插入数据库
+# 将豆瓣的数据插入数据库，先删除再插入，在一个事务中完成
 def insert_douban_media_state(media, state):
-    if not media.year:
-        sql = "DELETE FROM DOUBAN_MEDIAS WHERE NAME = '%s'" % media.get_name()
-    else:
-        sql = "DELETE FROM DOUBAN_MEDIAS WHERE NAME = '%s' AND YEAR = '%s'" % (media.get_name(), media.year)
-    # 先删除
-    update_by_sql(sql)
-    sql = "INSERT INTO DOUBAN_MEDIAS(NAME, YEAR, TYPE, RATING, IMAGE, STATE) VALUES ('%s', '%s', '%s', '%s', '%s', '%s')" % (
-        media.get_name(), media.year, media.type.value, media.vote_average, media.poster_path, state)
-    # 再插入
-    return update_by_sql(sql)
+    try:
+        with db_transaction() as cursor:
+            if not media.year:
+                cursor.execute("DELETE FROM DOUBAN_MEDIAS WHERE NAME = ?", (media.get_name(),))
+            else:
+                cursor.execute("DELETE FROM DOUBAN_MEDIAS WHERE NAME = ? AND YEAR = ?",
+                               (media.get_name(), str(media.year)))
+            cursor.execute("INSERT INTO DOUBAN_MEDIAS(NAME, YEAR, TYPE, RATING, IMAGE, STATE) VALUES (?, ?, ?, ?, ?, ?)",
+                           (media.get_name(), str(media.year), media.type.value, str(media.vote_average),
+                            str(media.poster_path), state))
+    except Exception as e:
+        log.error("【DB】保存豆瓣数据出错：%s" % str(e))
+        return False
+    return True
 
 
 # 标记豆瓣数据的状态
 def update_douban_media_state(media, state):
-    sql = "UPDATE DOUBAN_MEDIAS SET STATE = '%s' WHERE NAME = '%s' AND YEAR = '%s'" % (state, media.title, media.year)
-    return update_by_sql(sql)
+    sql = "UPDATE DOUBAN_MEDIAS SET STATE = ? WHERE NAME = ? AND YEAR = ?"
+    return update_by_sql(sql, (state, media.title, str(media.year)))
 
 
 # 查询未检索的豆瓣数据
 def get_douban_search_state(title, year):
-    sql = "SELECT STATE FROM DOUBAN_MEDIAS WHERE NAME = '%s' AND YEAR = '%s'" % (title, year)
-    return select_by_sql(sql)
+    sql = "SELECT STATE FROM DOUBAN_MEDIAS WHERE NAME = ? AND YEAR = ?"
+    return select_by_sql(sql, (title, str(year)))
 
 
 # 查询识别转移记录
@@ -186,67 +198,129 @@ def is_transfer_history_exists(file_path, file_name, title, se):
     file_name = file_name or ""
     title = title or ""
     se = se or ""
-    sql = "SELECT COUNT(1) FROM TRANSFER_HISTORY WHERE FILE_PATH='%s' AND FILE_NAME='%s' AND TITLE='%s' AND SE='%s'" % (file_path, file_name, title, se)
-    ret = select_by_sql(sql)
+    sql = "SELECT COUNT(1) FROM TRANSFER_HISTORY WHERE FILE_PATH = ? AND FILE_NAME = ? AND TITLE = ? AND SE = ?"
+    ret = select_by_sql(sql, (file_path, file_name, title, se))
     if ret and ret[0][0] > 0:
         return True
     else:
         return False
 
 
-# 插入识别转移记录
-def insert_transfer_history(in_from, rmt_mode, in_path, dest, media_info):
-    if not media_info or not media_info.tmdb_info:
-        return
-    if in_path:
-        in_path = os.path.normpath(in_path)
-    else:
+# 批量插入识别转移记录，dest_medias为 (目的路径, 媒体信息) 列表，已有相同记录的不重复插入，在一个事务中提交
+def insert_transfer_history(in_from, rmt_mode, in_path, dest_medias):
+    if not in_path or not dest_medias:
         return False
-    if not dest:
-        dest = ""
+    in_path = os.path.normpath(in_path)
     file_path = os.path.dirname(in_path)
-    file_path = file_path.replace("'", "''")
     file_name = os.path.basename(in_path)
-    file_name = file_name.replace("'", "''")
-    if is_transfer_history_exists(file_path, file_name, media_info.title, media_info.get_season_string()):
-        return True
     timestr = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
-    sql = "INSERT INTO TRANSFER_HISTORY(SOURCE, MODE, TYPE, FILE_PATH, FILE_NAME, TITLE, CATEGORY, YEAR, SE, DEST, DATE) VALUES ('%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s')" % (
-        in_from.value, rmt_mode.value, media_info.type.value, file_path, file_name, media_info.title, media_info.category, media_info.year, media_info.get_season_string(), dest, timestr)
-    return update_by_sql(sql)
-
-
-# 查询识别转移记录
-def get_transfer_history(search, page, rownum):
+    sql = "INSERT INTO TRANSFER_HISTORY(SOURCE, MODE, TYPE, FILE_PATH, FILE_NAME, TITLE, CATEGORY, YEAR, SE, DEST, DATE) " \
+          "SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS " \
+          "(SELECT 1 FROM TRANSFER_HISTORY WHERE FILE_PATH = ? AND FILE_NAME = ? AND TITLE = ? AND SE = ?)"
+    params_list = []
+    for dest, media_info in dest_medias:
+        if not media_info or not media_info.tmdb_info:
+            continue
+        title = str(media_info.title or "")
+        se = media_info.get_season_string() or ""
+        params_list.append((in_from.value, rmt_mode.value, media_info.type.value, file_path, file_name, title,
+                            str(media_info.category), str(media_info.year), se, dest or "", timestr,
+                            file_path, file_name, title, se))
+    ret = update_by_sql_many(sql, params_list)
+    clear_transfer_history_count()
+    return ret
+
+
+# 查询识别转移记录，传入上一页最后一条记录的时间和ID时从该位置向后翻页，否则按页码翻页，返回总数及当页记录
+def get_transfer_history(search, page, rownum, last_date=None, last_id=None):
+    rownum = int(rownum)
     if page == 1:
         begin_pos = 0
     else:
         begin_pos = (page-1) * rownum
+    seek_flag = last_date is not None and last_id is not None
+    if seek_flag:
+        begin_pos = 0
 
+    where_sqls = []
+    params = []
     if search:
-        count_sql = f"SELECT COUNT(1) FROM TRANSFER_HISTORY WHERE FILE_NAME LIKE '%{search}%' OR TITLE LIKE '%{search}%'"
-        sql = f"SELECT SOURCE, MODE, TYPE, FILE_NAME, TITLE, CATEGORY, YEAR, SE, DEST, DATE, ID FROM TRANSFER_HISTORY WHERE FILE_NAME LIKE '%{search}%' OR TITLE LIKE '%{search}%' ORDER BY DATE DESC LIMIT {rownum} OFFSET {begin_pos}"
+        # 全文索引以三个字为单位切分，太短的关键字只能模糊匹配
+        if len(search) >= 3 and is_history_fts_enabled():
+            match_sql = "SELECT rowid FROM TRANSFER_HISTORY_FTS WHERE TRANSFER_HISTORY_FTS MATCH ?"
+            where_sqls.append("ID IN (%s)" % match_sql)
+            params.append('"%s"' % search.replace('"', '""'))
+        else:
+            match_sql = "SELECT 1 FROM TRANSFER_HISTORY WHERE (FILE_NAME LIKE ? OR TITLE LIKE ?)"
+            search_str = "%%%s%%" % search
+            where_sqls.append("(FILE_NAME LIKE ? OR TITLE LIKE ?)")
+            params.extend([search_str, search_str])
+        count = get_transfer_history_count(match_sql, params)
+    else:
+        count = get_transfer_history_count(None, [])
+    # 按时间及ID的索引从上一页的位置向后查询，全文检索与模糊匹配使用同样的排序
+    if seek_flag:
+        where_sqls.append("(DATE, ID) < (?, ?)")
+        params = params + [last_date, int(last_id)]
+    sql = "SELECT SOURCE, MODE, TYPE, FILE_NAME, TITLE, CATEGORY, YEAR, SE, DEST, DATE, ID FROM TRANSFER_HISTORY"
+    if where_sqls:
+        sql = "%s WHERE %s" % (sql, " AND ".join(where_sqls))
+    sql = "%s ORDER BY DATE DESC, ID DESC LIMIT ? OFFSET ?" % sql
+    return [(count,)], select_by_sql(sql, params + [rownum, begin_pos])
+
+
+# 是否已建立识别转移历史的全文索引
+def is_history_fts_enabled():
+    global _history_fts_enabled
+    if _history_fts_enabled is None:
+        _history_fts_enabled = DBHelper().is_table_exists("TRANSFER_HISTORY_FTS")
+    return _history_fts_enabled
+
+
+# 查询识别转移记录的总数，结果缓存一段时间，数量只用于分页显示，允许短时间内不准确
+# 有查询条件时最多只数到上限，避免常见关键字匹配大量记录时计数太慢；match_sql为None时统计全部记录
+def get_transfer_history_count(match_sql, params):
+    cache_key = (match_sql, tuple(params))
+    with lock:
+        cache_item = _history_count_cache.get(cache_key)
+    if cache_item and time.time() - cache_item[0] < HISTORY_COUNT_CACHE_TTL:
+        return cache_item[1]
+    if match_sql:
+        sql = "SELECT COUNT(1) FROM (%s LIMIT %s)" % (match_sql, HISTORY_COUNT_LIMIT)
     else:
-        count_sql = f"SELECT COUNT(1) FROM TRANSFER_HISTORY"
-        sql = f"SELECT SOURCE, MODE, TYPE, FILE_NAME, TITLE, CATEGORY, YEAR, SE, DEST, DATE, ID FROM TRANSFER_HISTORY ORDER BY DATE DESC LIMIT {rownum} OFFSET {begin_pos}"
-    return select_by_sql(count_sql), select_by_sql(sql)
+        sql = "SELECT COUNT(1) FROM TRANSFER_HISTORY"
+    ret = select_by_sql(sql, params)
+    count = ret[0][0] if ret else 0
+    with lock:
+        if len(_history_count_cache) >= HISTORY_COUNT_CACHE_SIZE:
+            _history_count_cache.clear()
+        _history_count_cache[cache_key] = (time.time(), count)
+    return count
+
+
+# 识别转移记录有增删时清除总数缓存
+def clear_transfer_history_count():
+    with lock:
+        _history_count_cache.clear()
 
 
 # 根据logid查询PATH
 def get_transfer_path_by_id(logid):
-    sql = f"SELECT FILE_PATH, FILE_NAME, DEST, TITLE, CATEGORY, YEAR, SE, TYPE FROM TRANSFER_HISTORY WHERE ID={logid}"
-    return select_by_sql(sql)
+    sql = "SELECT FILE_PATH, FILE_NAME, DEST, TITLE, CATEGORY, YEAR, SE, TYPE FROM TRANSFER_HISTORY WHERE ID = ?"
+    return select_by_sql(sql, (logid,))
 
 
 # 根据logid删除记录
 def delete_transfer_log_by_id(logid):
-    sql = f"DELETE FROM TRANSFER_HISTORY WHERE ID={logid}"
-    return update_by_sql(sql)
+    sql = "DELETE FROM TRANSFER_HISTORY WHERE ID = ?"
+    ret = update_by_sql(sql, (logid,))
+    clear_transfer_history_count()
+    return ret
 
 
 # 查询未识别的记录列表
 def get_transfer_unknown_paths():
-    sql = f"SELECT PATH, DEST FROM TRANSFER_UNKNOWN WHERE STATE='N'"
+    sql = "SELECT PATH, DEST FROM TRANSFER_UNKNOWN WHERE STATE = 'N'"
     return select_by_sql(sql)
 
 
@@ -255,8 +329,8 @@ def update_transfer_unknown_state(path):
     if not path:
         return False
     path = os.path.normpath(path)
-    sql = f"UPDATE TRANSFER_UNKNOWN SET STATE='Y' WHERE PATH='{path}'"
-    return update_by_sql(sql)
+    sql = "UPDATE TRANSFER_UNKNOWN SET STATE = 'Y' WHERE PATH = ?"
+    return update_by_sql(sql, (path,))
 
 
 # 删除未识别记录
@@ -264,8 +338,8 @@ def delete_transfer_unknown(path):
     if not path:
         return False
     path = os.path.normpath(path)
-    sql = f"DELETE FROM TRANSFER_UNKNOWN WHERE PATH='{path}'"
-    return update_by_sql(sql)
+    sql = "DELETE FROM TRANSFER_UNKNOWN WHERE PATH = ?"
+    return update_by_sql(sql, (path,))
 
 
 # 查询未识别记录是否存在
@@ -273,8 +347,8 @@ def is_transfer_unknown_exists(path):
     if not path:
         return False
     path = os.path.normpath(path)
-    sql = f"SELECT COUNT(1) FROM TRANSFER_UNKNOWN WHERE PATH='{path}'"
-    ret = select_by_sql(sql)
+    sql = "SELECT COUNT(1) FROM TRANSFER_UNKNOWN WHERE PATH = ?"
+    ret = select_by_sql(sql, (path,))
     if ret and ret[0][0] > 0:
         return True
     else:
@@ -295,8 +369,8 @@ def insert_transfer_unknown(path, dest):
     else:
         if not dest:
             dest = ""
-        sql = f"INSERT INTO TRANSFER_UNKNOWN(PATH, DEST, STATE) VALUES('{path}', '{dest}', 'N')"
-        return update_by_sql(sql)
+        sql = "INSERT INTO TRANSFER_UNKNOWN(PATH, DEST, STATE) VALUES (?, ?, 'N')"
+        return update_by_sql(sql, (path, dest))
 
 
 # 查询是否为黑名单
@@ -304,8 +378,8 @@ def is_transfer_in_blacklist(path):
     if not path:
         return False
     path = os.path.normpath(path)
-    sql = f"SELECT COUNT(1) FROM TRANSFER_BLACKLIST WHERE PATH='{path}'"
-    ret = select_by_sql(sql)
+    sql = "SELECT COUNT(1) FROM TRANSFER_BLACKLIST WHERE PATH = ?"
+    ret = select_by_sql(sql, (path,))
     if ret and ret[0][0] > 0:
         return True
     else:
@@ -320,5 +394,68 @@ def insert_transfer_blacklist(path):
     if is_transfer_in_blacklist(path):
         return False
     else:
-        sql = f"INSERT INTO TRANSFER_BLACKLIST(PATH) VALUES('{path}')"
-        return update_by_sql(sql)
+        sql = "INSERT INTO TRANSFER_BLACKLIST(PATH) VALUES (?)"
+        return update_by_sql(sql, (path,))
+
+
+# 查询目的文件的复制进度
+def get_transfer_journal(dest):
+    sql = "SELECT SRC, SRC_SIZE, SRC_MTIME, COPIED FROM TRANSFER_JOURNAL WHERE DEST = ?"
+    ret = select_by_sql(sql, (dest,))
+    if not ret:
+        return {}
+    return {'src': ret[0][0], 'src_size': ret[0][1], 'src_mtime': ret[0][2], 'copied': ret[0][3]}
+
+
+# 保存目的文件的复制进度
+def update_transfer_journal(dest, src, src_size, src_mtime, copied):
+    sql = "INSERT OR REPLACE INTO TRANSFER_JOURNAL(DEST, SRC, SRC_SIZE, SRC_MTIME, COPIED, UPDATE_TIME) VALUES (?, ?, ?, ?, ?, ?)"
+    return update_by_sql(sql, (dest, src, int(src_size), src_mtime, int(copied),
+                               time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))))
+
+
+# 删除目的文件的复制进度
+def delete_transfer_journal(dest):
+    return update_by_sql("DELETE FROM TRANSFER_JOURNAL WHERE DEST = ?", (dest,))
+
+
+# 查询超过保留天数未更新的复制进度，返回目的文件列表
+def get_expired_transfer_journals(days):
+    timestr = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - days * 86400))
+    ret = select_by_sql("SELECT DEST FROM TRANSFER_JOURNAL WHERE UPDATE_TIME < ?", (timestr,))
+    if not ret:
+        return []
+    return [item[0] for item in ret]
+
+
+# 保存一次检索的结果，结果为JSON字符串
+def insert_search_session(search_id, owner, keyword, results, update_time):
+    sql = "INSERT OR REPLACE INTO SEARCH_SESSIONS(SEARCH_ID, OWNER, KEYWORD, RESULTS, UPDATE_TIME) VALUES (?, ?, ?, ?, ?)"
+    return update_by_sql(sql, (search_id, owner, keyword, results, update_time))
+
+
+# 按检索ID查询检索结果，返回 (检索ID, 用户, 关键字, 结果, 时间)
+def get_search_session(search_id):
+    sql = "SELECT SEARCH_ID, OWNER, KEYWORD, RESULTS, UPDATE_TIME FROM SEARCH_SESSIONS WHERE SEARCH_ID = ?"
+    ret = select_by_sql(sql, (search_id,))
+    if not ret:
+        return None
+    return ret[0]
+
+
+# 查询最近的一次检索结果，指定用户时只查该用户的
+def get_last_search_session(owner=None):
+    if owner:
+        sql = "SELECT SEARCH_ID, OWNER, KEYWORD, RESULTS, UPDATE_TIME FROM SEARCH_SESSIONS WHERE OWNER = ? ORDER BY UPDATE_TIME DESC LIMIT 1"
+        ret = select_by_sql(sql, (owner,))
+    else:
+        sql = "SELECT SEARCH_ID, OWNER, KEYWORD, RESULTS, UPDATE_TIME FROM SEARCH_SESSIONS ORDER BY UPDATE_TIME DESC LIMIT 1"
+        ret = select_by_sql(sql)
+    if not ret:
+        return None
+    return ret[0]
+
+
+# 删除指定时间之前的检索结果
+def delete_expired_search_sessions(before_time):
+    return update_by_sql("DELETE FROM SEARCH_SESSIONS WHERE UPDATE_TIME < ?", (before_time,))
@@ -1,5 +1,8 @@
 import re
 
+# 拆分token的分隔符
+SPLIT_RE = re.compile(r'\.|\s+|\(|\)|\[|]|-|\+|【|】|/|～|;|&|\||#|_|「|」|（|）')
+
 
 class Tokens:
     __text = ""
@@ -12,7 +15,7 @@ class Tokens:
         self.load_text(text)
 
     def load_text(self, text):
-        splited_text = re.split(r'\.|\s+|\(|\)|\[|]|-|\+|【|】|/|～|;|&|\||#|_|「|」|（|）', text)
+        splited_text = SPLIT_RE.split(text)
         for sub_text in splited_text:
             if sub_text:
                 self.__tokens.append(sub_text)
@@ -1,15 +1,19 @@
 import time
 from datetime import datetime
-import requests
+from threading import Lock
+
 import log
-from config import RMT_FAVTYPE, Config
+from config import RMT_FAVTYPE, Config, EMBY_INDEX_PAGE_SIZE, EMBY_INDEX_REFRESH_INTERVAL, \
+    EMBY_INDEX_FULL_REFRESH_INTERVAL
 from message.send import Message
 from rmt.filetransfer import FileTransfer
 from rmt.metainfo import MetaInfo
 from utils.functions import get_local_time, get_location, singleton
+from utils.http_utils import RequestUtils
 from utils.types import MediaType
 
 PLAY_LIST = []
+lock = Lock()
 
 
 @singleton
@@ -18,6 +22,18 @@ class Emby:
     __apikey = None
     __host = None
     __library_info = []
+    # 媒体库索引：({标题: {年份: 名称}}, {SeriesId: (标题, 年份)}, {标题: {年份: {季: 集的集合}}})
+    # 更新时生成新的索引整体替换，查询时不会看到更新了一半的索引
+    __index = None
+    # 索引上次更新及全量更新的时间，以及更新失败的时间
+    __index_time = None
+    __index_full_time = None
+    __index_fail_time = None
+    # 是否正在更新索引，同时只有一个线程更新，其它线程使用旧的索引
+    __index_updating = False
+    # 收到媒体库变化事件后需要增量或全量更新
+    __index_dirty = False
+    __index_full_dirty = False
 
     def __init__(self):
         self.message = Message()
@@ -42,7 +58,7 @@ class Emby:
             return []
         req_url = "%semby/Library/SelectableMediaFolders?api_key=%s" % (self.__host, self.__apikey)
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 return res.json()
             else:
@@ -58,7 +74,7 @@ class Emby:
             return 0
         req_url = "%semby/Users/Query?api_key=%s" % (self.__host, self.__apikey)
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 return res.json().get("TotalRecordCount")
             else:
@@ -75,7 +91,7 @@ class Emby:
         req_url = "%semby/System/ActivityLog/Entries?api_key=%s&Limit=%s" % (self.__host, self.__apikey, num)
         ret_array = []
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 ret_json = res.json()
                 items = ret_json.get('Items')
@@ -106,7 +122,7 @@ class Emby:
             return {}
         req_url = "%semby/Items/Counts?api_key=%s" % (self.__host, self.__apikey)
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 return res.json()
             else:
@@ -116,6 +132,132 @@ class Emby:
             log.error("【EMBY】连接Items/Counts出错：" + str(e))
             return {}
 
+    # 标题统一格式后作为索引的KEY
+    @staticmethod
+    def __get_index_title(title):
+        return str(title).strip().lower()
+
+    # 分页获取Emby中某类型的所有媒体，传入min_date_saved时只获取该时间之后有变化的，出错返回None
+    def __get_emby_items(self, item_type, min_date_saved=None):
+        ret_items = []
+        start_index = 0
+        while True:
+            req_url = "%semby/Items?IncludeItemTypes=%s&Fields=ProductionYear&Recursive=true&StartIndex=%s&Limit=%s&api_key=%s" % (
+                self.__host, item_type, start_index, EMBY_INDEX_PAGE_SIZE, self.__apikey)
+            if min_date_saved:
+                req_url = "%s&MinDateLastSaved=%s" % (req_url, min_date_saved)
+            try:
+                res = RequestUtils().request("get", req_url)
+                if not res:
+                    log.error("【EMBY】Items 未获取到返回数据")
+                    return None
+                res_json = res.json()
+            except Exception as e:
+                log.error("【EMBY】连接Items出错：" + str(e))
+                return None
+            res_items = res_json.get("Items") or []
+            ret_items.extend(res_items)
+            start_index = start_index + len(res_items)
+            if not res_items or start_index >= res_json.get("TotalRecordCount", 0):
+                break
+        return ret_items
+
+    # 生成更新后的媒体库索引，全量时重建，否则在旧索引的副本上合并index_time之后有变化的媒体，出错返回None
+    # 只修改复制出来的字典，不改动正在使用的旧索引
+    def __update_library_index(self, full, index, index_time):
+        min_date_saved = None
+        if not full:
+            # 往前多取一分钟，避免时间误差漏掉
+            min_date_saved = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(index_time - 60))
+        series_items = self.__get_emby_items("Series", min_date_saved)
+        movie_items = self.__get_emby_items("Movie", min_date_saved)
+        episode_items = self.__get_emby_items("Episode", min_date_saved)
+        if series_items is None or movie_items is None or episode_items is None:
+            return None
+        if full:
+            index_movies, index_series, index_tvs = {}, {}, {}
+        else:
+            index_movies, index_series, index_tvs = [dict(item) for item in index]
+        # 已复制过的下级字典
+        copied = set()
+        for item in series_items:
+            index_series[item.get("Id")] = (self.__get_index_title(item.get("Name")), str(item.get("ProductionYear")))
+        for item in movie_items:
+            title = self.__get_index_title(item.get("Name"))
+            if ("movie", title) not in copied:
+                index_movies[title] = dict(index_movies.get(title) or {})
+                copied.add(("movie", title))
+            index_movies[title][str(item.get("ProductionYear"))] = item.get("Name")
+        for item in episode_items:
+            series = index_series.get(item.get("SeriesId"))
+            season = item.get("ParentIndexNumber")
+            episode = item.get("IndexNumber")
+            if not series or season is None or episode is None:
+                continue
+            if ("tv", series[0]) not in copied:
+                index_tvs[series[0]] = dict(index_tvs.get(series[0]) or {})
+                copied.add(("tv", series[0]))
+            if ("tv", series) not in copied:
+                index_tvs[series[0]][series[1]] = dict(index_tvs[series[0]].get(series[1]) or {})
+                copied.add(("tv", series))
+            # 生成新的集合替换，不修改旧索引中的集合
+            seasons = index_tvs[series[0]][series[1]]
+            seasons[int(season)] = seasons.get(int(season), set()).union(
+                range(int(episode), int(item.get("IndexNumberEnd") or episode) + 1))
+        log.info("【EMBY】媒体库索引%s更新完成，电影 %s 部，电视剧 %s 部" % (
+            "全量" if full else "增量", len(index_movies), len(index_series)))
+        return index_movies, index_series, index_tvs
+
+    # 按需更新媒体库索引，返回索引是否可用，不可用时逐个查询Emby
+    # 只在锁内判断是否需要更新及替换索引，从Emby分页获取数据时不占用锁
+    def __check_library_index(self):
+        if not self.__host or not self.__apikey:
+            return False
+        with lock:
+            now = time.time()
+            if self.__index_updating:
+                return self.__index is not None
+            if self.__index_fail_time and now - self.__index_fail_time < EMBY_INDEX_REFRESH_INTERVAL:
+                return self.__index is not None
+            if self.__index is None \
+                    or self.__index_full_dirty \
+                    or now - self.__index_full_time > EMBY_INDEX_FULL_REFRESH_INTERVAL:
+                full = True
+            elif self.__index_dirty or now - self.__index_time > EMBY_INDEX_REFRESH_INTERVAL:
+                full = False
+            else:
+                return True
+            self.__index_updating = True
+            index, index_time = self.__index, self.__index_time
+            # 更新期间收到的变化事件重新标记，下次再更新
+            dirty, full_dirty = self.__index_dirty, self.__index_full_dirty
+            self.__index_dirty = False
+            if full:
+                self.__index_full_dirty = False
+        new_index = None
+        try:
+            new_index = self.__update_library_index(full, index, index_time)
+        except Exception as e:
+            log.error("【EMBY】更新媒体库索引出错：" + str(e))
+        with lock:
+            self.__index_updating = False
+            if new_index is None:
+                self.__index_fail_time = now
+                self.__index_dirty = self.__index_dirty or dirty
+                self.__index_full_dirty = self.__index_full_dirty or full_dirty
+            else:
+                self.__index = new_index
+                self.__index_time = now
+                if full:
+                    self.__index_full_time = now
+            return self.__index is not None
+
+    # 媒体库有变化时标记索引需要更新，删除媒体时需要全量更新
+    def set_library_index_dirty(self, full=False):
+        self.__index_dirty = True
+        if full:
+            self.__index_full_dirty = True
+
     # 根据名称查询Emby中剧集的SeriesId
     def get_emby_series_id_by_name(self, name, year):
         if not self.__host or not self.__apikey:
@@ -123,7 +265,7 @@ class Emby:
         req_url = "%semby/Items?IncludeItemTypes=Series&Fields=ProductionYear&StartIndex=0&Recursive=true&SearchTerm=%s&Limit=10&IncludeSearchTypes=false&api_key=%s" % (
             self.__host, name, self.__apikey)
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 res_items = res.json().get("Items")
                 if res_items:
@@ -140,10 +282,20 @@ class Emby:
     def get_emby_movies(self, title, year=None):
         if not self.__host or not self.__apikey:
             return []
+        if self.__check_library_index():
+            years = self.__index[0].get(self.__get_index_title(title))
+            if not years:
+                return []
+            if not year:
+                movie_year, movie_name = next(iter(years.items()))
+                return [{'title': movie_name, 'year': movie_year}]
+            if str(year) in years:
+                return [{'title': years.get(str(year)), 'year': str(year)}]
+            return []
         req_url = "%semby/Items?IncludeItemTypes=Movie&Fields=ProductionYear&StartIndex=0&Recursive=true&SearchTerm=%s&Limit=10&IncludeSearchTypes=false&api_key=%s" % (
             self.__host, title, self.__apikey)
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 res_items = res.json().get("Items")
                 if res_items:
@@ -163,6 +315,14 @@ class Emby:
     def get_emby_tv_episodes(self, title, year=None, season=None):
         if not self.__host or not self.__apikey:
             return []
+        if self.__check_library_index():
+            years = self.__index[2].get(self.__get_index_title(title))
+            if not years:
+                return []
+            seasons = years.get(str(year)) if year else next(iter(years.values()))
+            if not seasons:
+                return []
+            return sorted(seasons.get(int(season or 1), []))
         # 电视剧
         item_id = self.get_emby_series_id_by_name(title, year)
         if not item_id:
@@ -173,7 +333,7 @@ class Emby:
         req_url = "%semby/Shows/%s/Episodes?Season=%s&api_key=%s" % (
             self.__host, item_id, season, self.__apikey)
         try:
-            res_json = requests.get(req_url, timeout=10)
+            res_json = RequestUtils().request("get", req_url)
             if res_json:
                 res_items = res_json.json().get("Items")
                 exists_episodes = []
@@ -222,7 +382,7 @@ class Emby:
             return None
         req_url = "%semby/Items/%s/RemoteImages?api_key=%s" % (self.__host, item_id, self.__apikey)
         try:
-            res = requests.get(req_url, timeout=10)
+            res = RequestUtils().request("get", req_url)
             if res:
                 images = res.json().get("Images")
                 for image in images:
@@ -242,7 +402,7 @@ class Emby:
             return False
         req_url = "%semby/Items/%s/Refresh?Recursive=true&api_key=%s" % (self.__host, item_id, self.__apikey)
         try:
-            res = requests.post(req_url)
+            res = RequestUtils().request("post", req_url)
             if res:
                 return True
         except Exception as e:
@@ -256,7 +416,7 @@ class Emby:
             return False
         req_url = "%semby/Library/Refresh?api_key=%s" % (self.__host, self.__apikey)
         try:
-            res = requests.post(req_url)
+            res = RequestUtils().request("post", req_url)
             if res:
                 return True
         except Exception as e:
@@ -278,6 +438,7 @@ class Emby:
             if library_id and library_id not in library_ids:
                 library_ids.append(library_id)
         # 开始刷新媒体库
+        self.set_library_index_dirty()
         if "/" in library_ids:
             self.refresh_emby_root_library()
             return
@@ -368,6 +529,10 @@ class EmbyEvent:
             if self.action == 'webhooktest':
                 log.info("【EMBY】system.webhooktest")
             return
+        # 媒体库变化事件，更新媒体库索引
+        if self.category == 'library':
+            self.emby.set_library_index_dirty(full=(self.action == 'deleted'))
+            return
         # 播放事件
         webhook_ignore = self.message.get_webhook_ignore()
         if self.category == 'playback':
@@ -5,7 +5,7 @@ import shutil
 from math import floor
 
 from flask import Flask, request, json, render_template, make_response, redirect, url_for
-from flask_login import LoginManager, UserMixin, login_user, login_required
+from flask_login import LoginManager, UserMixin, login_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 
 import log
@@ -20,10 +20,13 @@ from scheduler.pt_signin import PTSignin
 from scheduler.pt_transfer import PTTransfer
 from scheduler.rss_download import RSSDownloader
 from message.send import Message
+from monitor.media_sync import Sync
 
 from config import WECHAT_MENU, PT_TRANSFER_INTERVAL
 from utils.functions import get_used_of_partition, str_filesize, str_timelong
-from utils.sqls import get_jackett_result_by_id, get_jackett_results, get_movie_keys, get_tv_keys, insert_movie_key, \
+from utils.meta_helper import MetaHelper
+from utils.search_helper import SearchHelper
+from utils.sqls import get_movie_keys, get_tv_keys, insert_movie_key, \
     insert_tv_key, delete_all_tv_keys, delete_all_movie_keys, get_transfer_history, get_transfer_unknown_paths, \
     update_transfer_unknown_state, delete_transfer_unknown, get_transfer_path_by_id, insert_transfer_blacklist, \
     delete_transfer_log_by_id
@@ -68,6 +71,8 @@ def create_flask_app(config):
     DoubanSyncClient = DoubanSync()
     JackettClient = Jackett()
     FileTransferClient = FileTransfer()
+    SyncClient = Sync()
+    SearchHelperClient = SearchHelper()
 
     # 根据用户名获得用户记录
     def get_user(user_name):
@@ -216,6 +221,11 @@ def create_flask_app(config):
             # 总空间 格式化
             TotalSpace = "{:,} TB".format(round(TotalSpace / 1024 / 1024 / 1024 / 1024, 2))
 
+        # TMDB缓存统计
+        MetaStats = MetaHelper().get_meta_stats()
+        # 名称解析缓存统计
+        ParseStats = MetaInfo.get_parse_cache_info()
+
         return render_template("index.html",
                                EmbySucess=EmbySucess,
                                MediaCount={'MovieCount': MovieCount, 'SeriesCount': SeriesCount,
@@ -226,6 +236,8 @@ def create_flask_app(config):
                                TotalSpace=TotalSpace,
                                UsedSapce=UsedSapce,
                                UsedPercent=UsedPercent,
+                               MetaStats=MetaStats,
+                               ParseStats=ParseStats,
                                AppVersion=APP_VERSION
                                )
 
@@ -233,8 +245,9 @@ def create_flask_app(config):
     @App.route('/search', methods=['POST', 'GET'])
     @login_required
     def search():
-        # 查询结果
-        res = get_jackett_results()
+        # 查询结果，未指定检索ID时显示当前用户最近一次的检索
+        sid = request.args.get("sid")
+        _, res = SearchHelperClient.get_jackett_results(sid, current_user.username)
         return render_template("search.html",
                                Count=len(res),
                                Items=res,
@@ -324,6 +337,8 @@ def create_flask_app(config):
         DownloadCount = 0
         Client, Torrents = DownloaderClient.get_pt_torrents()
         DispTorrents = []
+        # 下载中的种子
+        DownloadingTorrents = []
         for torrent in Torrents:
             if Client == DownloaderType.QB:
                 if torrent.get('state') not in ['downloading', 'forcedDL', 'pausedDL', 'stalledDL']:
@@ -364,10 +379,14 @@ def create_flask_app(config):
 
             if not name:
                 continue
-            # 识别
-            media_info = MediaClient.get_media_info(name)
+            DownloadingTorrents.append((key, name, speed, state, progress))
+
+        # 批量识别
+        MediaInfos = MediaClient.get_media_infos([torrent[1] for torrent in DownloadingTorrents])
+        for (key, name, speed, state, progress), media_info in zip(DownloadingTorrents, MediaInfos):
             if not media_info:
-                continue
+                # 识别出错时只显示解析的名称
+                media_info = MetaInfo(name)
             if not media_info.tmdb_info:
                 year = media_info.year
                 if year:
@@ -555,7 +574,12 @@ def create_flask_app(config):
             CurrentPage = 1
         else:
             CurrentPage = int(CurrentPage)
-        totalCount, historys = get_transfer_history(SearchStr, CurrentPage, PageNum)
+        # 下一页时带上本页最后一条记录的位置，直接从该位置向后查询
+        LastDate = request.args.get("lastdate")
+        LastId = request.args.get("lastid")
+        if not LastDate or not LastId or not LastId.isdigit():
+            LastDate = LastId = None
+        totalCount, historys = get_transfer_history(SearchStr, CurrentPage, PageNum, LastDate, LastId)
         if totalCount:
             totalCount = totalCount[0][0]
         else:
@@ -651,14 +675,15 @@ def create_flask_app(config):
             if cmd == "search":
                 # 开始检索
                 search_word = data.get("search_word")
+                sid = None
                 if search_word:
-                    search_medias_for_web(search_word)
-                return {"retcode": 0}
+                    sid = search_medias_for_web(search_word, current_user.username)
+                return {"retcode": 0, "sid": sid}
 
             # 添加下载
             if cmd == "download":
                 dl_id = data.get("id")
-                results = get_jackett_result_by_id(dl_id)
+                results = SearchHelperClient.get_jackett_result_by_id(dl_id)
                 for res in results:
                     if res[7] == "TV":
                         mtype = MediaType.TV
@@ -806,6 +831,10 @@ def create_flask_app(config):
                 else:
                     return {"retcode": 2, "retmsg": ret_msg}
 
+            # 查询目录监控转移队列的状态
+            if cmd == "sync_info":
+                return {"retcode": 0, "info": SyncClient.get_queue_info()}
+
             # 读取配置文件
             if cmd == "load_config":
                 cfg = open(config.get_config_path(), mode="r", encoding="utf8")